@@ -1,6 +1,9 @@
 """Command line program for applying QQ-scaling adjustment factors."""
 
+import os
 import yaml
+import shutil
+import tempfile
 import logging
 import argparse
 from datetime import datetime
@@ -10,6 +13,8 @@ import numpy as np
 import xarray as xr
 import xclim as xc
 from xclim import sdba
+from xclim.core.formatting import update_history
+from xclim.core.units import units2pint
 import dask.diagnostics
 
 import utils
@@ -103,6 +108,435 @@ def amend_attributes(ds, input_var, input_attrs, metadata_file):
     return ds, output_var
 
 
+def qdm_adjust_kernel(sim, af, group_index, ngroups, af_position, quantiles, interp, kind):
+    """Apply adjustment factors to numpy data.
+
+    Parameters
+    ----------
+    sim : numpy ndarray
+        Data to be adjusted (time is the last axis)
+    af : numpy ndarray
+        Adjustment factors with dimensions (..., group, quantiles)
+    group_index : numpy ndarray
+        Group index (0, 1, 2, ...) for each time step (for ranking the data)
+    ngroups : int
+        Number of groups
+    af_position : numpy ndarray
+        Fractional index along the af group axis for each time step
+        (the af group axis is treated as cyclic)
+    quantiles : numpy ndarray
+        Quantiles corresponding to the af quantile axis
+    interp : {'nearest', 'linear'}
+        Method for interpolation of adjustment factors
+    kind : {'+', '*'}
+        Adjustment kind
+
+    Returns
+    -------
+    numpy ndarray
+    """
+
+    sim_q = np.empty(sim.shape, dtype=np.result_type(sim.dtype, np.float32))
+    for group in range(ngroups):
+        times = group_index == group
+        sim_q[..., times] = utils.percentile_ranks(sim[..., times])
+
+    return apply_af(sim, sim_q, af, af_position, quantiles, interp, kind)
+
+
+def streaming_adjust_kernel(
+    sim, group_index, af_position, summary_values, summary_counts, af, quantiles, interp, kind
+):
+    """Apply adjustment factors to one time chunk of numpy data.
+
+    The data are ranked using quantile summaries of the full time series
+    (see utils.get_quantile_summary) instead of being sorted,
+    so time is a broadcast (rather than core) dimension:
+    group_index and af_position are broadcast against sim
+    and the other arrays can have a length one time axis before their core dimensions.
+    """
+
+    group_index = group_index.reshape(-1)
+    if summary_values.ndim == sim.ndim + 2:
+        summary_values = summary_values[..., 0, :, :]
+    if summary_counts.ndim == sim.ndim + 1:
+        summary_counts = summary_counts[..., 0, :]
+    if af.ndim == sim.ndim + 2:
+        af = af[..., 0, :, :]
+    sim_q = utils.summary_ranks(sim, summary_values, summary_counts, group_index)
+
+    return apply_af(sim, sim_q, af, af_position, quantiles, interp, kind)
+
+
+def apply_af(sim, sim_q, af, af_position, quantiles, interp, kind):
+    """Apply adjustment factors to numpy data with known percentile ranks (sim_q).
+
+    See qdm_adjust_kernel for a description of the arguments.
+    The calculation is done in the precision of sim and af
+    (i.e. float32 data with float32 adjustment factors stay float32).
+    """
+
+    dtype = np.result_type(sim.dtype, af.dtype, np.float32)
+    sim_q = sim_q.astype(dtype, copy=False)
+    quantiles = quantiles.astype(dtype)
+    missing = np.isnan(sim_q)
+    sim_q = np.where(missing, quantiles[0], sim_q)
+
+    naf_groups, nquantiles = af.shape[-2:]
+    af = af.reshape(af.shape[:-2] + (naf_groups * nquantiles,))
+    if interp == 'nearest':
+        midpoints = (quantiles[1:] + quantiles[:-1]) / 2
+        q_index = np.searchsorted(midpoints, sim_q, side='left')
+        g_index = np.rint(af_position).astype(int) % naf_groups
+        sim_af = np.take_along_axis(af, g_index * nquantiles + q_index, axis=-1)
+    elif interp == 'linear':
+        q_lower = np.clip(np.searchsorted(quantiles, sim_q, side='right') - 1, 0, nquantiles - 2)
+        q_weight = (sim_q - quantiles[q_lower]) / (quantiles[q_lower + 1] - quantiles[q_lower])
+        q_weight = np.clip(q_weight, 0, 1)
+        g_floor = np.floor(af_position)
+        g_weight = (af_position - g_floor).astype(dtype)
+        g_lower = g_floor.astype(int) % naf_groups
+        g_upper = (g_lower + 1) % naf_groups
+        sim_af = 0
+        for g_index, g_w in [(g_lower, 1 - g_weight), (g_upper, g_weight)]:
+            for q_index, q_w in [(q_lower, 1 - q_weight), (q_lower + 1, q_weight)]:
+                corner = np.take_along_axis(af, g_index * nquantiles + q_index, axis=-1)
+                sim_af = sim_af + g_w * q_w * corner
+    else:
+        raise ValueError(f'Invalid interpolation method: {interp}')
+    sim_af = np.where(missing, np.nan, sim_af)
+
+    if kind == '+':
+        scen = sim + sim_af
+    elif kind == '*':
+        scen = sim * sim_af
+    else:
+        raise ValueError(f'Invalid adjustment kind: {kind}')
+
+    return scen
+
+
+def surface_position(times, surface_dayofyear):
+    """Get the fractional index along the af_surface day of year axis for each time step.
+
+    Each date is mapped to its day of year in a leap year
+    (days beyond the end of a month in that year, e.g. 30 February, are moved back)
+    and the day of year axis is treated as cyclic.
+    """
+
+    month_starts = np.array([0, 31, 60, 91, 121, 152, 182, 213, 244, 274, 305, 335])
+    month_lengths = np.array([31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+    months = np.asarray(times.month) - 1
+    days = np.minimum(np.asarray(times.day), month_lengths[months])
+    dayofyear = month_starts[months] + days
+
+    surface_dayofyear = np.asarray(surface_dayofyear, dtype=float)
+    nsurface = len(surface_dayofyear)
+    cyclic_dayofyear = np.concatenate(
+        [[surface_dayofyear[-1] - 366], surface_dayofyear, [surface_dayofyear[0] + 366]]
+    )
+    cyclic_index = np.arange(-1, nsurface + 1)
+
+    return np.interp(dayofyear, cyclic_dayofyear, cyclic_index)
+
+
+def qdm_adjust(da, qm, interp='nearest', summary=None):
+    """Apply quantile delta mapping adjustment factors.
+
+    Equivalent to qm.adjust(da, extrapolation='constant', interp=interp)
+    for nearest and linear interpolation, except that the percentile rank
+    of each value is calculated with a single sort per group
+    and the adjustment factors are gathered (nearest) or interpolated (linear)
+    along the quantile axis, fully vectorised over time.
+
+    If qm.ds contains an af_surface that was smoothed with the
+    requested interp method (see train.get_af_surface),
+    the adjustment factors are looked up from that surface instead.
+
+    If quantile summaries of da are provided (see utils.get_quantile_summary),
+    the data are ranked using those summaries and processed one time chunk at a time
+    (i.e. da does not need to be in a single time chunk).
+
+    Parameters
+    ----------
+    da : xarray DataArray
+        Data to be adjusted
+    qm : xclim.sdba.QuantileDeltaMapping
+        Trained adjustment object
+    interp : {'nearest', 'linear', 'cubic'}, default 'nearest'
+        Method for interpolation of adjustment factors
+        (cubic requires an af_surface)
+    summary : tuple, optional
+        Quantile summary values and counts for da
+
+    Returns
+    -------
+    xarray DataArray
+
+    Notes
+    -----
+    With monthly grouping and linear interpolation,
+    xclim smooths the (quantile, month) adjustment factor field
+    by triangulation (scipy.interpolate.griddata),
+    whereas here the interpolation is bilinear with cyclic months.
+    """
+
+    if units2pint(da) != units2pint(qm.train_units):
+        da = xc.units.convert_units_to(da, qm.train_units)
+    sim_attrs = da.attrs
+
+    timescale = 'annual' if qm.group.prop == 'group' else 'monthly'
+    group_index, group_coords = utils.get_group_index(da['time'], timescale)
+    ngroups = len(group_coords['month']) if group_coords else 1
+    times = da.indexes['time']
+    if has_af_surface(qm.ds, interp):
+        af = qm.ds['af_surface']
+        af_dim = 'surface_dayofyear'
+        quantiles = af['surface_quantiles'].values
+        af = af.rename({'surface_quantiles': 'quantiles'})
+        af_position = surface_position(times, af[af_dim].values)
+        kernel_interp = 'linear'
+    else:
+        if interp not in ['nearest', 'linear']:
+            raise ValueError(f'No af_surface for interpolation method: {interp}')
+        af = qm.ds['af']
+        af_dim = 'month' if group_coords else 'group'
+        if af_dim not in af.dims:
+            af = af.expand_dims(af_dim)
+        quantiles = af['quantiles'].values
+        if group_coords and (interp == 'linear'):
+            af_position = np.asarray(times.month - 1.5 + times.day / times.days_in_month)
+        else:
+            af_position = group_index.astype(float)
+        kernel_interp = interp
+    af = af.drop_vars(['quantiles', af_dim], errors='ignore')
+    # (packed cells already share an index; see utils.match_cells)
+    coord_dims = [dim for dim in da.dims if dim != 'cell']
+    af = af.assign_coords({dim: da[dim] for dim in af.dims if dim in coord_dims})
+
+    if summary is None:
+        scen = xr.apply_ufunc(
+            qdm_adjust_kernel,
+            da,
+            af,
+            kwargs={
+                'group_index': group_index,
+                'ngroups': ngroups,
+                'af_position': af_position,
+                'quantiles': quantiles,
+                'interp': kernel_interp,
+                'kind': qm.kind,
+            },
+            input_core_dims=[['time'], [af_dim, 'quantiles']],
+            output_core_dims=[['time']],
+            dask='parallelized',
+            output_dtypes=[np.result_type(da.dtype, af.dtype)],
+        )
+    else:
+        summary_values, summary_counts = summary
+        summary_values = summary_values.drop_vars('levels', errors='ignore')
+        summary_values = summary_values.assign_coords(
+            {dim: da[dim] for dim in summary_values.dims if dim in coord_dims}
+        )
+        summary_counts = summary_counts.assign_coords(
+            {dim: da[dim] for dim in summary_counts.dims if dim in coord_dims}
+        )
+        time_index = xr.Dataset(
+            {
+                'group_index': ('time', group_index),
+                'af_position': ('time', af_position),
+            }
+        )
+        if da.chunks:
+            time_index = time_index.chunk({'time': da.chunksizes['time']})
+        scen = xr.apply_ufunc(
+            streaming_adjust_kernel,
+            da.transpose(..., 'time'),
+            time_index['group_index'],
+            time_index['af_position'],
+            summary_values,
+            summary_counts,
+            af,
+            kwargs={
+                'quantiles': quantiles,
+                'interp': kernel_interp,
+                'kind': qm.kind,
+            },
+            input_core_dims=[[], [], [], ['group', 'levels'], ['group'], [af_dim, 'quantiles']],
+            output_core_dims=[[]],
+            dask='parallelized',
+            output_dtypes=[np.result_type(da.dtype, af.dtype)],
+        )
+
+    infostr = f"{str(qm)}.adjust(sim, extrapolation='constant', interp={interp!r})"
+    scen.attrs.update(sim_attrs)
+    scen.attrs['history'] = update_history(f'Bias-adjusted with {infostr}', da)
+    scen.attrs['bias_adjustment'] = infostr
+    scen.attrs['units'] = qm.train_units
+
+    return scen.rename('scen')
+
+
+def has_af_surface(ds_adjust, interp):
+    """Check if an adjustment factor dataset has an af_surface for the interp method."""
+
+    if 'af_surface' not in ds_adjust:
+        return False
+
+    return ds_adjust['af_surface'].attrs.get('interp') == interp
+
+
+def match_grids(ds, var, ds_adjust, spatial_grid='input'):
+    """Regrid the input data or adjustment factors (if necessary) so they share a spatial grid.
+
+    Parameters
+    ----------
+    ds : xarray Dataset
+        Data to be adjusted
+    var : str or list
+        Variable/s to be adjusted (i.e. in ds)
+    ds_adjust : xarray Dataset
+        Adjustment factors calculated using train.train
+    spatial_grid : {'input', 'af'}, default 'input'
+        Spatial grid for output data (choices are input data or adjustment factor grid)
+
+    Returns
+    -------
+    ds : xarray Dataset
+    ds_adjust : xarray Dataset
+    """
+
+    if len(ds_adjust['lat']) != len(ds['lat']):
+        if spatial_grid == 'input':
+            logging.info('Regridding adjustment factors to input data grid')
+            ds_adjust = utils.regrid(ds_adjust, ds)
+        elif spatial_grid == 'af':
+            logging.info('Regridding input data to adjustment factor grid')
+            ds = utils.regrid(ds, ds_adjust, variable=var)
+    assert len(ds_adjust['lat']) == len(ds['lat'])
+    assert len(ds_adjust['lon']) == len(ds['lon'])
+
+    return ds, ds_adjust
+
+
+def align_af_chunks(ds_adjust, da):
+    """Chunk adjustment factors to match the spatial chunks of the data to be adjusted.
+
+    If ds_adjust has not been loaded (e.g. it was opened with xr.open_dataset)
+    each chunk is read straight from disk by the task that uses it,
+    rather than the whole adjustment factor dataset being loaded
+    and embedded in the dask graph.
+
+    Parameters
+    ----------
+    ds_adjust : xarray Dataset
+        Adjustment factors calculated using train.train
+    da : xarray DataArray
+        Data to be adjusted
+
+    Returns
+    -------
+    xarray Dataset
+    """
+
+    if not da.chunks:
+        return ds_adjust
+    spatial_chunks = {dim: da.chunksizes[dim] for dim in ['lat', 'lon', 'cell'] if dim in ds_adjust.dims}
+    other_dims = [dim for dim in ds_adjust.dims if dim not in spatial_chunks]
+    ds_adjust = ds_adjust.chunk({**spatial_chunks, **{dim: -1 for dim in other_dims}})
+
+    return ds_adjust
+
+
+def get_timescale(ds_adjust):
+    """Get the time grouping (monthly or annual) of an adjustment factor dataset."""
+
+    qm = sdba.QuantileDeltaMapping.from_dataset(ds_adjust[['af', 'hist_q']])
+
+    return 'annual' if qm.group.prop == 'group' else 'monthly'
+
+
+def get_target_cdf(ds, var, timescale='monthly', ssr=False, nlevels=201):
+    """Calculate a frozen empirical CDF of the target data.
+
+    The CDF is a quantile summary for each grid cell and month (or year)
+    (see utils.get_quantile_summary), so it is small enough to save to file
+    and later data can be ranked against it (see adjust) without
+    reading the baseline period again.
+
+    Parameters
+    ----------
+    ds : xarray Dataset
+        Target data for the baseline period
+    var : str
+        Variable (i.e. in ds)
+    timescale : {'monthly', 'annual'}, default 'monthly'
+        Time grouping (must match the adjustment factors)
+    ssr : bool, default False
+        Perform singularity stochastic removal
+    nlevels : int, default 201
+        Number of probability levels in the CDF
+
+    Returns
+    -------
+    xarray Dataset
+        cdf_values (..., group, levels) and cdf_counts (..., group)
+    """
+
+    if ssr:
+        da = utils.apply_ssr(ds[var])
+    else:
+        da = ds[var]
+    values, counts = utils.get_quantile_summary(da, nlevels=nlevels, timescale=timescale)
+    ds_cdf = xr.Dataset({'cdf_values': values, 'cdf_counts': counts})
+    ds_cdf.attrs = {
+        'variable': var,
+        'units': da.attrs['units'],
+        'timescale': timescale,
+        'rank_error_bound': values.attrs['rank_error_bound'],
+        'baseline_period_start': str(da['time'].dt.strftime('%Y-%m-%d').values[0]),
+        'baseline_period_end': str(da['time'].dt.strftime('%Y-%m-%d').values[-1]),
+    }
+    ds_cdf['cdf_values'].attrs = {'units': da.attrs['units']}
+
+    return ds_cdf
+
+
+def align_target_cdf(ds_cdf, da, timescale='monthly'):
+    """Check a frozen target CDF against the data to be adjusted.
+
+    Parameters
+    ----------
+    ds_cdf : xarray Dataset
+        Frozen target CDF (see get_target_cdf)
+    da : xarray DataArray
+        Data to be adjusted
+    timescale : {'monthly', 'annual'}, default 'monthly'
+        Time grouping of the adjustment factors
+
+    Returns
+    -------
+    values : xarray DataArray
+        CDF values chunked to match the spatial chunks of da
+    counts : xarray DataArray
+        CDF counts chunked to match the spatial chunks of da
+    """
+
+    if ds_cdf.attrs['timescale'] != timescale:
+        raise ValueError(f'Invalid target CDF timescale: {ds_cdf.attrs["timescale"]} (expected {timescale})')
+    if ds_cdf.attrs['units'] != da.attrs['units']:
+        raise ValueError(f'Invalid target CDF units: {ds_cdf.attrs["units"]} (expected {da.attrs["units"]})')
+    if ('cell' in da.dims) and ('cell' not in ds_cdf.dims):
+        ds_cdf = utils.match_cells(ds_cdf, da)
+        ds_cdf['cdf_counts'] = ds_cdf['cdf_counts'].fillna(0).astype(int)
+    for dim in ds_cdf['cdf_counts'].dims:
+        if (dim != 'group') and (ds_cdf.sizes[dim] != da.sizes.get(dim)):
+            raise ValueError(f'Invalid target CDF: {dim} does not match the data to be adjusted')
+    ds_cdf = align_af_chunks(ds_cdf[['cdf_values', 'cdf_counts']], da)
+
+    return ds_cdf['cdf_values'], ds_cdf['cdf_counts']
+
+
 def adjust(
     ds,
     var,
@@ -115,6 +549,9 @@ def adjust(
     valid_min=None,
     valid_max=None,
     output_tslice=None,
+    stream=False,
+    stream_nlevels=201,
+    target_cdf=None,
 ):
     """Apply qq-scale adjustment factors.
 
@@ -143,13 +580,25 @@ def adjust(
     output_tslice : list, optional
         Return a time slice of the adjusted data
         Format: ['YYYY-MM-DD', 'YYYY-MM-DD']
-        
+    stream : bool, default False
+        Process the data one time chunk at a time in two passes
+        (the first pass calculates quantile summaries used to rank the data)
+    stream_nlevels : int, default 201
+        Number of probability levels in the quantile summaries
+    target_cdf : xarray Dataset, optional
+        Frozen CDF of a baseline target period (see get_target_cdf)
+        used to rank the data instead of the distribution of ds itself
+        (the data are then processed one time chunk at a time as for stream)
+
     Returns
     -------
     xarray Dataset    
     """
 
-    ds_adjust = ds_adjust[['af', 'hist_q']]
+    if 'af_surface' in ds_adjust:
+        ds_adjust = ds_adjust[['af', 'hist_q', 'af_surface']]
+    else:
+        ds_adjust = ds_adjust[['af', 'hist_q']]
     af_units = ds_adjust['hist_q'].attrs['units']
     infile_units = ds[var].attrs['units']    
     assert infile_units == af_units, \
@@ -158,15 +607,13 @@ def adjust(
     dims = ds[var].dims
     on_spatial_grid = ('lat' in dims) and ('lon' in dims)
     if on_spatial_grid:
-        if len(ds_adjust['lat']) != len(ds['lat']):
-            if spatial_grid == 'input':
-                logging.info('Regridding adjustment factors to input data grid')
-                ds_adjust = utils.regrid(ds_adjust, ds)
-            elif spatial_grid == 'af':
-                logging.info('Regridding input data to adjustment factor grid')
-                ds = utils.regrid(ds, ds_adjust, variable=var)
-        assert len(ds_adjust['lat']) == len(ds['lat'])
-        assert len(ds_adjust['lon']) == len(ds['lon'])
+        ds, ds_adjust = match_grids(ds, var, ds_adjust, spatial_grid=spatial_grid)
+        ds_adjust = align_af_chunks(ds_adjust, ds[var])
+    elif 'cell' in dims:
+        if spatial_grid != 'input':
+            raise ValueError(f'Invalid spatial grid for packed input data: {spatial_grid}')
+        ds_adjust = utils.match_cells(ds_adjust, ds[var])
+        ds_adjust = align_af_chunks(ds_adjust, ds[var])
 
     qm = sdba.QuantileDeltaMapping.from_dataset(ds_adjust)
     hist_q_shape = qm.ds['hist_q'].shape
@@ -183,38 +630,68 @@ def adjust(
     else:
         da = ds[var]
 
-    if max_af:
-        ds_adjust['af'] = ds_adjust['af'].where(ds_adjust['af'] < max_af, max_af)
+    with utils.profile_stage('kernel'):
+        if max_af:
+            ds_adjust['af'] = ds_adjust['af'].where(ds_adjust['af'] < max_af, max_af)
+            if 'af_surface' in ds_adjust:
+                ds_adjust['af_surface'] = ds_adjust['af_surface'].where(ds_adjust['af_surface'] < max_af, max_af)
 
-    qq = qm.adjust(da, extrapolation='constant', interp=interp)
-    qq = qq.rename(var)
-    if on_spatial_grid:
-        qq['lat'] = ds['lat']
-        qq['lon'] = ds['lon']
-        qq = qq.transpose('lat', 'lon', ...)
-    qq = qq.transpose('time', ...) 
+        if has_af_surface(ds_adjust, interp):
+            logging.info(f'Using precomputed {interp} adjustment factor surface')
+        if stream or (target_cdf is not None):
+            if not (has_af_surface(ds_adjust, interp) or interp in ['nearest', 'linear']):
+                raise ValueError(f'Streaming adjustment is not available for interp={interp}')
+            timescale = 'annual' if qm.group.prop == 'group' else 'monthly'
+        if target_cdf is not None:
+            logging.info('Ranking the input data against the frozen target CDF')
+            summary = align_target_cdf(target_cdf, da, timescale=timescale)
+            qq = qdm_adjust(da, qm, interp=interp, summary=summary)
+        elif stream:
+            logging.info('Pass one: calculating quantile summaries of the input data')
+            summary = utils.get_quantile_summary(da, nlevels=stream_nlevels, timescale=timescale)
+            summary = utils.persist_collections(*summary)
+            logging.info('Pass two: applying adjustment factors')
+            qq = qdm_adjust(da, qm, interp=interp, summary=summary)
+        elif has_af_surface(ds_adjust, interp):
+            qq = qdm_adjust(da, qm, interp=interp)
+        elif interp in ['nearest', 'linear']:
+            qq = qdm_adjust(da, qm, interp=interp)
+        else:
+            qq = qm.adjust(da, extrapolation='constant', interp=interp)
+        qq = qq.rename(var)
+        if on_spatial_grid:
+            qq['lat'] = ds['lat']
+            qq['lon'] = ds['lon']
+            qq = qq.transpose('lat', 'lon', ...)
+        qq = qq.transpose('time', ...) 
 
-    if ssr:
-        qq = utils.reverse_ssr(qq)
-        
-    if (valid_min is not None) or (valid_max is not None):
-        qq = qq.clip(min=valid_min, max=valid_max, keep_attrs=True) 
-
-    qq = qq.to_dataset()    
-    if ref_time:
-        new_start_date = ds_adjust.attrs['reference_period_start'] 
-        time_adjustment = np.datetime64(new_start_date) - qq['time'][0]
-        qq['time'] = qq['time'] + time_adjustment
-
-    if output_tslice:
-        start_date, end_date = output_tslice
-        qq = qq.sel({'time': slice(start_date, end_date)})
-
-    qq.attrs['xclim'] = qq[var].attrs['history']
-    del qq[var].attrs['history']
-    del qq[var].attrs['bias_adjustment']
-    with suppress(KeyError):
-        del qq[var].attrs['cell_methods']
+    with utils.profile_stage('postprocess'):
+        if ssr:
+            qq = utils.reverse_ssr(qq)
+
+        if (valid_min is not None) or (valid_max is not None):
+            qq = qq.clip(min=valid_min, max=valid_max, keep_attrs=True) 
+
+        qq = qq.to_dataset()    
+        if ref_time:
+            new_start_date = ds_adjust.attrs['reference_period_start'] 
+            time_adjustment = np.datetime64(new_start_date) - qq['time'][0]
+            qq['time'] = qq['time'] + time_adjustment
+
+        if output_tslice:
+            start_date, end_date = output_tslice
+            qq = qq.sel({'time': slice(start_date, end_date)})
+
+        # (sizing the graph walks every task, so only do it when it will be logged)
+        if qq.chunks and logging.getLogger().isEnabledFor(logging.INFO):
+            ntasks, graph_nbytes = utils.get_graph_size(qq)
+            logging.info(f'Graph size: {ntasks} tasks, {dask.utils.format_bytes(graph_nbytes)} of embedded data')
+
+        qq.attrs['xclim'] = qq[var].attrs['history']
+        del qq[var].attrs['history']
+        del qq[var].attrs['bias_adjustment']
+        with suppress(KeyError):
+            del qq[var].attrs['cell_methods']
 
     return qq
 
@@ -223,56 +700,190 @@ def main(args):
     """Run the program."""
 
     dask.diagnostics.ProgressBar().register()
-    ds = utils.read_data(
-        args.infiles,
-        args.var,
-        time_bounds=args.adjustment_tbounds,
-        isel_hour=args.isel_hour,
-        input_units=args.input_units,
-        output_units=args.output_units,
-        use_cftime=False,
-        valid_min=args.valid_min,
-        valid_max=args.valid_max,
-    )
-
-    ds_adjust = xr.open_dataset(args.adjustment_file)
-
-    qq = adjust(
-        ds,
-        args.var,
-        ds_adjust,
-        spatial_grid=args.spatial_grid,
-        interp=args.interp,
-        ssr=args.ssr,
-        max_af=args.max_af,
-        ref_time=args.ref_time,
-        valid_min=args.valid_min,
-        valid_max=args.valid_max,
-        output_tslice=args.output_tslice,
-    )
-    qq, output_var = amend_attributes(qq, args.var, ds.attrs, args.outfile_attrs)
-
-    infile_logs = {}
-    if 'history' in ds_adjust.attrs:
-        infile_logs[args.adjustment_file] = ds_adjust.attrs['history']
-    if args.keep_history and ('history' in ds.attrs):
-        infile_logs[args.infiles[0]] = ds.attrs['history']
-    if args.short_history:
-        unique_dirnames = utils.get_unique_dirnames(args.infiles)
+    if args.profile:
+        utils.start_profile('adjust.py')
+    if args.split_by and (args.tile_size or args.async_write):
+        raise ValueError('Invalid arguments: --split_by cannot be used with --tile_size or --async_write')
+    if args.sparse and (args.tile_size or args.async_write):
+        raise ValueError('Invalid arguments: --sparse cannot be used with --tile_size or --async_write')
+    if args.tile_size and (args.target_cdf or args.save_target_cdf):
+        raise ValueError('Invalid arguments: --tile_size cannot be used with --target_cdf or --save_target_cdf')
+    stream = args.stream or bool(args.target_cdf) or bool(args.save_target_cdf)
+    if args.stream and not (args.target_cdf or args.save_target_cdf or args.tile_size):
+        # The quantile summaries from the first pass are written to a temporary file
+        # and read back chunk by chunk in the second pass (as for --save_target_cdf)
+        # so they don't have to fit in memory
+        stream_dir = tempfile.mkdtemp(
+            prefix='qqscale_stream_', dir=os.path.dirname(os.path.abspath(args.outfile))
+        )
     else:
-        unique_dirnames = []
-    qq.attrs['history'] = utils.get_new_log(
-        infile_logs=infile_logs,
-        wildcard_prefixes=unique_dirnames,
-    )
+        stream_dir = None
+    try:
+        variables = args.var.split(',')
+        var_options = utils.get_variable_options(
+            variables,
+            {
+                'input_units': args.input_units,
+                'output_units': args.output_units,
+                'ssr': args.ssr,
+                'max_af': args.max_af,
+                'valid_min': args.valid_min,
+                'valid_max': args.valid_max,
+            },
+            options_file=args.variable_options,
+        )
+        if args.af_store:
+            af_store_keys = args.adjustment_file.split(',')
+            if len(af_store_keys) != len(variables):
+                raise ValueError('Invalid arguments: adjustment_file must list an af store key for each variable')
+            adjustment_files = {
+                var: utils.get_af_store_file(args.af_store, key) for var, key in zip(variables, af_store_keys)
+            }
+        else:
+            adjustment_files = {
+                var: utils.get_variable_outfile(args.adjustment_file, var, variables) for var in variables
+            }
+        ds_adjust = {var: xr.open_dataset(adjustment_files[var]) for var in variables}
+        if args.compute_dtype:
+            ds_adjust = {var: utils.cast_float_vars(ds_adjust[var], args.compute_dtype) for var in variables}
+        if stream:
+            chunk_operation = 'adjust_stream'
+        elif args.interp == 'nearest':
+            chunk_operation = 'adjust'
+        else:
+            chunk_operation = 'adjust_linear'
+        read_options = {}
+        for option in ['input_units', 'output_units', 'valid_min', 'valid_max']:
+            read_options[option] = {var: var_options[var][option] for var in variables}
+        ds = utils.read_data(
+            args.infiles,
+            variables,
+            time_bounds=args.adjustment_tbounds,
+            isel_hour=args.isel_hour,
+            use_cftime=False,
+            time_chunk_size=args.time_chunk_size if stream else None,
+            memory_per_worker=args.memory_per_worker,
+            chunk_operation=chunk_operation,
+            nquantiles=max([len(ds_adjust[var]['quantiles']) for var in variables]),
+            sparse=args.sparse,
+            sparse_mask_dir=args.sparse_mask_dir,
+            compute_dtype=args.compute_dtype,
+            **read_options,
+        )
 
-    encoding = utils.get_outfile_encoding(
-        qq,
-        output_var,
-        time_units=args.output_time_units,
-        compress=args.compress,
-    )
-    qq.to_netcdf(args.outfile, encoding=encoding)
+        adjust_kwargs = {
+            'spatial_grid': args.spatial_grid,
+            'interp': args.interp,
+            'ref_time': args.ref_time,
+            'output_tslice': args.output_tslice,
+            'stream': args.stream,
+            'stream_nlevels': args.stream_nlevels,
+        }
+        writes = []
+        outfiles = []
+        for var in variables:
+            for option in ['ssr', 'max_af', 'valid_min', 'valid_max']:
+                adjust_kwargs[option] = var_options[var][option]
+            # The input data are only regridded once (for the first variable)
+            # because regridding to the grid they are already on is skipped
+            if ('lat' in ds.dims) and ('lon' in ds.dims):
+                ds, ds_adjust_input = match_grids(ds, variables, ds_adjust[var], spatial_grid=args.spatial_grid)
+            else:
+                ds_adjust_input = ds_adjust[var]
+            if args.save_target_cdf or stream_dir:
+                if args.save_target_cdf:
+                    cdf_file = utils.get_variable_outfile(args.save_target_cdf, var, variables)
+                else:
+                    logging.info('Pass one: calculating quantile summaries of the input data')
+                    cdf_file = os.path.join(stream_dir, f'{var}_summary.nc')
+                ds_cdf = get_target_cdf(
+                    ds,
+                    var,
+                    timescale=get_timescale(ds_adjust[var]),
+                    ssr=var_options[var]['ssr'],
+                    nlevels=args.stream_nlevels,
+                )
+                if args.save_target_cdf:
+                    cdf_encoding = utils.get_outfile_encoding(ds_cdf, 'cdf_values', compress=True)
+                else:
+                    cdf_encoding = None
+                utils.write_outfile(ds_cdf, cdf_file, cdf_encoding)
+            elif args.target_cdf:
+                cdf_file = utils.get_variable_outfile(args.target_cdf, var, variables)
+            if args.save_target_cdf or args.target_cdf or stream_dir:
+                adjust_kwargs['target_cdf'] = xr.open_dataset(cdf_file)
+                if args.compute_dtype:
+                    adjust_kwargs['target_cdf'] = utils.cast_float_vars(adjust_kwargs['target_cdf'], args.compute_dtype)
+            if args.tile_size:
+                tile_results = utils.process_tiles(
+                    adjust,
+                    {'ds': ds, 'ds_adjust': ds_adjust_input},
+                    args.tile_size,
+                    nworkers=args.tile_workers,
+                    var=var,
+                    **adjust_kwargs,
+                )
+                tile, qq_tile = next(tile_results)
+                spatial_coords = {'lat': ds['lat'], 'lon': ds['lon']}
+                qq = utils.get_tile_template(qq_tile, spatial_coords, args.tile_size)
+            else:
+                qq = adjust(ds, var, ds_adjust_input, **adjust_kwargs)
+            with utils.profile_stage('postprocess'):
+                qq, output_var = amend_attributes(qq, var, ds.attrs, args.outfile_attrs)
+
+                infile_logs = {}
+                if 'history' in ds_adjust[var].attrs:
+                    infile_logs[adjustment_files[var]] = ds_adjust[var].attrs['history']
+                if args.keep_history and ('history' in ds.attrs):
+                    infile_logs[args.infiles[0]] = ds.attrs['history']
+                if args.short_history:
+                    unique_dirnames = utils.get_unique_dirnames(args.infiles)
+                else:
+                    unique_dirnames = []
+                qq.attrs['history'] = utils.get_new_log(
+                    infile_logs=infile_logs,
+                    wildcard_prefixes=unique_dirnames,
+                )
+
+            encoding = utils.get_outfile_encoding(
+                qq,
+                output_var,
+                time_units=args.output_time_units,
+                compress=args.compress,
+                output_format=args.output_format,
+            )
+            outfile = utils.get_variable_outfile(args.outfile, var, variables)
+            if args.split_by == 'year':
+                for year_outfile, qq_year in utils.split_by_year(qq, outfile).items():
+                    writes.append((qq_year, year_outfile, encoding))
+                    outfiles.append(year_outfile)
+            elif args.tile_size:
+                with utils.profile_stage('write'):
+                    utils.create_tiled_outfile(qq, outfile, encoding, output_format=args.output_format)
+                    qq_tile = qq_tile.rename({var: output_var})
+                    utils.write_tile(outfile, qq_tile, tile, output_format=args.output_format)
+                    for tile, qq_tile in tile_results:
+                        qq_tile = qq_tile.rename({var: output_var})
+                        utils.write_tile(outfile, qq_tile, tile, output_format=args.output_format)
+            elif args.async_write:
+                utils.write_outfile_async(
+                    qq,
+                    outfile,
+                    encoding,
+                    output_format=args.output_format,
+                    queue_size=args.write_queue_size,
+                )
+            else:
+                writes.append((qq, outfile, encoding))
+            if args.split_by != 'year':
+                outfiles.append(outfile)
+        utils.write_outfiles(writes, output_format=args.output_format)
+    finally:
+        # Also remove the quantile summaries if the adjustment fails
+        if stream_dir:
+            shutil.rmtree(stream_dir, ignore_errors=True)
+    if args.profile:
+        utils.write_profile_report(outfiles[0])
 
 
 if __name__ == '__main__':
@@ -283,12 +894,36 @@ if __name__ == '__main__':
     )
                           
     parser.add_argument("infiles", type=str, nargs='*', help="input data (to be adjusted)")           
-    parser.add_argument("var", type=str, help="variable to process")
-    parser.add_argument("adjustment_file", type=str, help="adjustment factor file")
-    parser.add_argument("outfile", type=str, help="output file")
+    parser.add_argument(
+        "var",
+        type=str,
+        help="variable to process (or a comma separated list of variables)",
+    )
+    parser.add_argument(
+        "adjustment_file",
+        type=str,
+        help="adjustment factor file (must include {var} if there are multiple variables) or af store key/s (with --af_store)",
+    )
+    parser.add_argument(
+        "outfile",
+        type=str,
+        help="output file (must include {var} if there are multiple variables and {year} with --split_by year)",
+    )
 
     parser.add_argument("--input_units", type=str, default=None, help="input data units")
     parser.add_argument("--output_units", type=str, default=None, help="output data units")
+    parser.add_argument(
+        "--af_store",
+        type=str,
+        default=None,
+        help="Read the adjustment factors from this store (adjustment_file is then a comma separated list of store keys)",
+    )
+    parser.add_argument(
+        "--variable_options",
+        type=str,
+        default=None,
+        help="YAML file of per-variable units, ssr, max_af and valid min/max options (see utils.get_variable_options)",
+    )
     parser.add_argument(
         "--isel_hour",
         type=int,
@@ -343,6 +978,75 @@ if __name__ == '__main__':
         default=False,
         help='Perform Singularity Stochastic Removal',
     )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        default=False,
+        help="Process the input data in time chunks (two passes instead of a single time chunk)",
+    )
+    parser.add_argument(
+        "--time_chunk_size",
+        type=int,
+        default=1825,
+        help="Number of time steps in each time chunk (for --stream)",
+    )
+    parser.add_argument(
+        "--stream_nlevels",
+        type=int,
+        default=201,
+        help="Number of probability levels in the quantile summaries used by --stream",
+    )
+    parser.add_argument(
+        "--save_target_cdf",
+        type=str,
+        default=None,
+        help="Save the CDF of the input data for each grid cell and month to this file (for later use with --target_cdf)",
+    )
+    parser.add_argument(
+        "--target_cdf",
+        type=str,
+        default=None,
+        help="Rank the input data against a CDF saved by --save_target_cdf (instead of the CDF of the input data)",
+    )
+    parser.add_argument(
+        "--sparse",
+        action="store_true",
+        default=False,
+        help="Only process the grid cells with valid (non-NaN) data (e.g. land points)",
+    )
+    parser.add_argument(
+        "--sparse_mask_dir",
+        type=str,
+        default=None,
+        help="Save the valid cell mask found by --sparse to this directory and reuse it in later runs on the same grid",
+    )
+    parser.add_argument(
+        "--compute_dtype",
+        type=str,
+        choices=('float32', 'float64'),
+        default=None,
+        help="Data type for the calculations (default is the input data type; float32 halves the memory per chunk)",
+    )
+    parser.add_argument(
+        "--tile_size",
+        type=int,
+        nargs=2,
+        metavar=('NLAT', 'NLON'),
+        default=None,
+        help="Process the lat/lon domain in tiles of this size (in a pool of worker processes)",
+    )
+    parser.add_argument(
+        "--tile_workers",
+        type=int,
+        default=1,
+        help="Number of worker processes (for --tile_size)",
+    )
+    parser.add_argument(
+        "--memory_per_worker",
+        type=str,
+        default=None,
+        help="Memory available to process each data chunk (e.g. 4GB), used to choose lat/lon chunk sizes",
+    )
     parser.add_argument(
         "--valid_min",
         type=float,
@@ -367,6 +1071,31 @@ if __name__ == '__main__':
         default=None,
         help='YAML file with outfile attributes',
     )
+    parser.add_argument(
+        "--split_by",
+        type=str,
+        choices=('year',),
+        default=None,
+        help="Write a separate output file for each year (outfile must include a {year} placeholder)",
+    )
+    parser.add_argument(
+        "--async_write",
+        action="store_true",
+        default=False,
+        help="Compute the output in bands of latitude and write each band while the next is computed",
+    )
+    parser.add_argument(
+        "--write_queue_size",
+        type=int,
+        default=2,
+        help="Maximum number of computed bands waiting to be written (with --async_write)",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        default=False,
+        help="Write the time, memory and dask tasks used by each processing stage to <outfile>.profile.json",
+    )
     parser.add_argument(
         "--verbose",
         action="store_true",
@@ -379,6 +1108,13 @@ if __name__ == '__main__':
         default=False,
         help="compress the output data file"
     )
+    parser.add_argument(
+        "--output_format",
+        type=str,
+        choices=('netcdf', 'zarr'),
+        default='netcdf',
+        help="Output file format",
+    )
     parser.add_argument(
         "--keep_history",
         action="store_true",
@@ -391,9 +1127,18 @@ if __name__ == '__main__':
         default=False,
         help="Use wildcards to shorten the file lists in output_file history attribute",
     )
+    utils.add_dask_arguments(parser)
     args = parser.parse_args()
     log_level = logging.INFO if args.verbose else logging.WARNING
     logging.basicConfig(level=log_level)
+    client = utils.start_dask(
+        args.scheduler,
+        n_workers=args.n_workers,
+        threads_per_worker=args.threads_per_worker,
+        memory_limit=args.memory_limit,
+        scheduler_address=args.scheduler_address,
+    )
     with dask.diagnostics.ResourceProfiler() as rprof:
         main(args)
     utils.profiling_stats(rprof)
+    utils.stop_dask(client)
@@ -0,0 +1,418 @@
+"""Command line program for benchmarking the train, adjust, quantiles, regrid and read_data steps.
+
+The precision benchmark compares float32 and float64 processing (see --compute_dtype).
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import logging
+import platform
+import resource
+import tempfile
+import multiprocessing
+from queue import Empty
+from datetime import datetime
+
+import git
+import numpy as np
+import pandas as pd
+import xarray as xr
+import xclim as xc
+import dask
+import dask.array
+import dask.utils
+
+import utils
+import train
+import adjust
+import quantiles
+
+
+SCALES = {
+    'point': None,
+    '10x10': (10, 10),
+    '100x100': (100, 100),
+    'agcd': (691, 886),
+}
+
+BENCHMARKS = ['read_data', 'train', 'adjust', 'quantiles', 'regrid', 'precision']
+
+
+def make_synthetic_data(nyears, start_year, grid_shape=None, warming=0.0, seed=0):
+    """Create a synthetic daily temperature dataset.
+
+    The data have a seasonal cycle, random noise and a linear warming trend.
+    They are generated with dask, so datasets larger than memory
+    can be written to file chunk by chunk.
+
+    Parameters
+    ----------
+    nyears : int
+        Number of years
+    start_year : int
+        First year
+    grid_shape : tuple, optional
+        Number of latitudes and longitudes (default is a single point with no spatial dimensions)
+    warming : float, default 0.0
+        Warming (in degrees) added by the end of the dataset
+    seed : int, default 0
+        Random number generator seed
+
+    Returns
+    -------
+    xarray Dataset
+    """
+
+    times = pd.date_range(f'{start_year}-01-01', f'{start_year + nyears - 1}-12-31', freq='D')
+    seasonal_cycle = -13 * np.cos(2 * np.pi * times.dayofyear.values / 365) + 20
+    trend = warming * np.arange(times.size) / times.size
+    baseline = (seasonal_cycle + trend).astype(np.float32)
+    coords = {'time': times}
+    if grid_shape:
+        nlat, nlon = grid_shape
+        coords['lat'] = np.linspace(-44, -10, nlat) if nlat > 1 else np.array([-27.0])
+        coords['lon'] = np.linspace(112, 154, nlon) if nlon > 1 else np.array([133.0])
+        shape = (times.size, nlat, nlon)
+        chunks = (times.size, max(1, int(2e7 // (times.size * nlon))), nlon)
+        baseline = baseline[:, np.newaxis, np.newaxis]
+    else:
+        shape = (times.size,)
+        chunks = (times.size,)
+    noise = dask.array.random.RandomState(seed).random_sample(shape, chunks=chunks).astype(np.float32)
+    data = baseline + 2 * noise
+    da = xr.DataArray(
+        data,
+        dims=list(coords.keys()),
+        coords=coords,
+        attrs={'units': 'C', 'standard_name': 'air_temperature'},
+    )
+
+    return da.to_dataset(name='tasmax')
+
+
+def write_inputs(workdir, scale, nyears):
+    """Write the synthetic hist, ref and target files for a scale (if they don't already exist).
+
+    Returns
+    -------
+    dict
+        File name for each input dataset
+    """
+
+    grid_shape = SCALES[scale]
+    infiles = {}
+    settings = {'hist': (1990, 0.0, 1), 'ref': (2050, 2.0, 2), 'target': (1990, 0.0, 3)}
+    for name, (start_year, warming, seed) in settings.items():
+        infile = os.path.join(workdir, f'{name}_{scale}_{nyears}years.nc')
+        if not os.path.isfile(infile):
+            logging.info(f'Writing {infile}')
+            ds = make_synthetic_data(
+                nyears, start_year, grid_shape=grid_shape, warming=warming, seed=seed
+            )
+            ds.to_netcdf(infile)
+        infiles[name] = infile
+
+    return infiles
+
+
+def read_input(infile, grid_shape, memory_per_worker, chunk_operation, compute_dtype=None):
+    """Read a synthetic input file the way the command line programs do."""
+
+    ds = utils.read_data(
+        [infile],
+        'tasmax',
+        memory_per_worker=memory_per_worker if grid_shape else None,
+        chunk_operation=chunk_operation,
+        # The synthetic hist and ref data have the same length (see train.get_chunk_time_scale)
+        chunk_time_scale=2 if chunk_operation == 'train' else 1,
+        compute_dtype=compute_dtype,
+    )
+
+    return ds
+
+
+def train_and_adjust(infiles, grid_shape, memory_per_worker, compute_dtype=None):
+    """Calculate adjustment factors and return the (lazy) adjusted data."""
+
+    ds_hist = read_input(infiles['hist'], grid_shape, memory_per_worker, 'train', compute_dtype)
+    ds_ref = read_input(infiles['ref'], grid_shape, memory_per_worker, 'train', compute_dtype)
+    ds_adjust = train.train(ds_hist, ds_ref, 'tasmax', 'tasmax', 'additive', time_grouping='monthly')
+    ds_adjust = ds_adjust.compute()
+    ds_target = read_input(infiles['target'], grid_shape, memory_per_worker, 'adjust', compute_dtype)
+
+    return adjust.adjust(ds_target, 'tasmax', ds_adjust)
+
+
+def run_benchmark(benchmark, infiles, grid_shape, memory_per_worker, compute_dtype=None):
+    """Run a single benchmark.
+
+    Only the benchmarked step is timed
+    (e.g. the adjustment factors for the adjust benchmark are calculated beforehand).
+    The precision benchmark times a float32 adjustment
+    and reports its difference from the float64 adjustment.
+
+    Returns
+    -------
+    dict
+        Wall time (seconds) and, for the precision benchmark,
+        the maximum and mean absolute difference between the float32 and float64 results
+    """
+
+    result = {}
+    if benchmark == 'read_data':
+        start = time.perf_counter()
+        read_input(infiles['hist'], grid_shape, memory_per_worker, 'quantiles', compute_dtype).load()
+    elif benchmark == 'train':
+        ds_hist = read_input(infiles['hist'], grid_shape, memory_per_worker, 'train', compute_dtype)
+        ds_ref = read_input(infiles['ref'], grid_shape, memory_per_worker, 'train', compute_dtype)
+        start = time.perf_counter()
+        train.train(ds_hist, ds_ref, 'tasmax', 'tasmax', 'additive', time_grouping='monthly').compute()
+    elif benchmark == 'adjust':
+        qq = train_and_adjust(infiles, grid_shape, memory_per_worker, compute_dtype)
+        start = time.perf_counter()
+        qq.compute()
+    elif benchmark == 'quantiles':
+        ds = read_input(infiles['hist'], grid_shape, memory_per_worker, 'quantiles', compute_dtype)
+        start = time.perf_counter()
+        quantiles.quantiles(ds, 'tasmax', 100).compute()
+    elif benchmark == 'precision':
+        expected = train_and_adjust(infiles, grid_shape, memory_per_worker, 'float64')['tasmax'].values
+        qq = train_and_adjust(infiles, grid_shape, memory_per_worker, 'float32')
+        start = time.perf_counter()
+        actual = qq['tasmax'].values
+        result['time'] = time.perf_counter() - start
+        difference = np.abs(actual.astype(np.float64) - expected)
+        result['max_abs_diff'] = float(np.nanmax(difference))
+        result['mean_abs_diff'] = float(np.nanmean(difference))
+        return result
+    elif benchmark == 'regrid':
+        if not grid_shape:
+            raise ValueError('Invalid scale for regrid benchmark: point')
+        ds = read_input(infiles['hist'], grid_shape, memory_per_worker, 'quantiles', compute_dtype)
+        ds_grid = ds.isel({'lat': slice(None, None, 2), 'lon': slice(None, None, 2)})
+        start = time.perf_counter()
+        utils.regrid(ds, ds_grid, variable='tasmax', cache_dir='').compute()
+    else:
+        raise ValueError(f'Invalid benchmark: {benchmark}')
+    result['time'] = time.perf_counter() - start
+
+    return result
+
+
+def benchmark_process(benchmark, infiles, grid_shape, memory_per_worker, nworkers, compute_dtype, queue):
+    """Run a benchmark in a child process and put the results in a queue.
+
+    Running each benchmark in its own process means
+    the peak resident set size (RSS) only includes that benchmark.
+    """
+
+    result = {}
+    try:
+        with dask.config.set(scheduler='threads', num_workers=nworkers):
+            result.update(run_benchmark(benchmark, infiles, grid_shape, memory_per_worker, compute_dtype))
+    except Exception as error:
+        result['error'] = f'{type(error).__name__}: {error}'
+    # ru_maxrss is in kilobytes on Linux (bytes on macOS)
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result['peak_rss'] = maxrss if sys.platform == 'darwin' else maxrss * 1024
+    queue.put(result)
+
+
+def get_result(process, queue):
+    """Wait for the results of a benchmark process.
+
+    Returns an error result if the process dies without reporting
+    (e.g. if it is killed for running out of memory).
+    """
+
+    while True:
+        try:
+            result = queue.get(timeout=1)
+            break
+        except Empty:
+            if not process.is_alive():
+                result = {'error': f'Benchmark process exited with code {process.exitcode}'}
+                break
+    process.join()
+
+    return result
+
+
+def get_metadata(args):
+    """Record the software versions and settings used for a set of benchmarks."""
+
+    try:
+        repo = git.Repo(sys.path[0])
+        commit = str(repo.head.commit)
+    except (git.exc.InvalidGitRepositoryError, git.exc.NoSuchPathError, ValueError):
+        commit = None
+    metadata = {
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'commit': commit,
+        'host': platform.node(),
+        'cpu_count': os.cpu_count(),
+        'python_version': platform.python_version(),
+        'numpy_version': np.__version__,
+        'xarray_version': xr.__version__,
+        'dask_version': dask.__version__,
+        'xclim_version': xc.__version__,
+        'nyears': args.nyears,
+        'memory_per_worker': args.memory_per_worker,
+        'nworkers': args.nworkers,
+        'compute_dtype': args.compute_dtype,
+    }
+
+    return metadata
+
+
+def compare_results(results, baseline_results):
+    """Log the change in wall time and peak memory relative to a baseline."""
+
+    baseline = {
+        (result['benchmark'], result['scale']): result for result in baseline_results['results']
+    }
+    for result in results['results']:
+        key = (result['benchmark'], result['scale'])
+        if (key not in baseline) or ('time' not in result) or ('time' not in baseline[key]):
+            continue
+        time_ratio = result['time'] / baseline[key]['time']
+        rss_ratio = result['peak_rss'] / baseline[key]['peak_rss']
+        print(
+            f'{result["benchmark"]} ({result["scale"]}): '
+            f'time {baseline[key]["time"]:.2f}s -> {result["time"]:.2f}s ({time_ratio:.2f}x), '
+            f'peak RSS {dask.utils.format_bytes(baseline[key]["peak_rss"])} -> '
+            f'{dask.utils.format_bytes(result["peak_rss"])} ({rss_ratio:.2f}x)'
+        )
+
+
+def main(args):
+    """Run the program."""
+
+    workdir = args.workdir if args.workdir else tempfile.mkdtemp(prefix='qqscale_benchmark_')
+    os.makedirs(workdir, exist_ok=True)
+    context = multiprocessing.get_context('fork' if sys.platform == 'linux' else 'spawn')
+    results = {'metadata': get_metadata(args), 'results': []}
+    for scale in args.scales:
+        infiles = write_inputs(workdir, scale, args.nyears)
+        grid_shape = SCALES[scale]
+        for benchmark in args.benchmarks:
+            if (benchmark == 'regrid') and not grid_shape:
+                continue
+            logging.info(f'Running {benchmark} benchmark ({scale})')
+            queue = context.Queue()
+            process = context.Process(
+                target=benchmark_process,
+                args=(
+                    benchmark,
+                    infiles,
+                    grid_shape,
+                    args.memory_per_worker,
+                    args.nworkers,
+                    args.compute_dtype,
+                    queue,
+                ),
+            )
+            process.start()
+            result = get_result(process, queue)
+            result.update({
+                'benchmark': benchmark,
+                'scale': scale,
+                'nlat': grid_shape[0] if grid_shape else 1,
+                'nlon': grid_shape[1] if grid_shape else 1,
+                'nyears': args.nyears,
+            })
+            if 'error' in result:
+                logging.warning(f'{benchmark} benchmark ({scale}) failed: {result["error"]}')
+            else:
+                logging.info(
+                    f'{benchmark} ({scale}): {result["time"]:.2f}s, '
+                    f'peak RSS {dask.utils.format_bytes(result["peak_rss"])}'
+                )
+                if benchmark == 'precision':
+                    logging.info(
+                        f'float32 vs float64 ({scale}): max difference {result["max_abs_diff"]:.2e}, '
+                        f'mean difference {result["mean_abs_diff"]:.2e}'
+                    )
+            results['results'].append(result)
+
+    with open(args.outfile, 'w') as writer:
+        json.dump(results, writer, indent=2)
+    if args.compare:
+        with open(args.compare, 'r') as reader:
+            baseline_results = json.load(reader)
+        compare_results(results, baseline_results)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        argument_default=argparse.SUPPRESS,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("outfile", type=str, help="output JSON file for the benchmark results")
+    parser.add_argument(
+        "--scales",
+        type=str,
+        nargs='*',
+        choices=list(SCALES.keys()),
+        default=['point', '10x10'],
+        help="Synthetic data sizes: a single point or lat x lon grids (agcd is 691 x 886)",
+    )
+    parser.add_argument(
+        "--benchmarks",
+        type=str,
+        nargs='*',
+        choices=BENCHMARKS,
+        default=BENCHMARKS,
+        help="Steps to benchmark",
+    )
+    parser.add_argument(
+        "--nyears",
+        type=int,
+        default=30,
+        help="Number of years of daily data in each synthetic dataset",
+    )
+    parser.add_argument(
+        "--workdir",
+        type=str,
+        default=None,
+        help="Directory for the synthetic input files (reused if they already exist; default is a new temporary directory)",
+    )
+    parser.add_argument(
+        "--memory_per_worker",
+        type=str,
+        default='1GB',
+        help="Memory available to process each data chunk (see utils.get_chunk_plan)",
+    )
+    parser.add_argument(
+        "--nworkers",
+        type=int,
+        default=1,
+        help="Number of dask threads",
+    )
+    parser.add_argument(
+        "--compute_dtype",
+        type=str,
+        choices=('float32', 'float64'),
+        default=None,
+        help="Data type for the calculations (default is the input data type; the precision benchmark compares the two)",
+    )
+    parser.add_argument(
+        "--compare",
+        type=str,
+        default=None,
+        help="JSON file of baseline benchmark results (e.g. from a previous commit) to compare against",
+    )
+    parser.add_argument(
+        "--verbose",
+        action="store_true",
+        default=False,
+        help='Set logging level to INFO',
+    )
+    args = parser.parse_args()
+    log_level = logging.INFO if args.verbose else logging.WARNING
+    logging.basicConfig(level=log_level)
+    main(args)
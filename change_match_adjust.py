@@ -45,30 +45,38 @@ def main(args):
     """Run the program."""
 
     dask.diagnostics.ProgressBar().register()
+    if args.profile:
+        utils.start_profile('change_match_adjust.py')
     ds_qdc = utils.read_data(
         args.qdc_file,
         args.qdc_var,
     )
-    ds_adjust = xr.open_dataset(args.adjustment_file)
-
-    ds_qdc_adjusted = change_match_adjust(
-        ds_qdc,
-        args.qdc_var,
-        ds_adjust[args.qdc_var],
-        args.scaling,
-    )
-
-    infile_logs = {
-        args.qdc_file: ds_qdc.attrs['history'],
-        args.adjustment_file: ds_adjust.attrs['history'],
-    }
-    ds_qdc_adjusted.attrs['history'] = utils.get_new_log(infile_logs=infile_logs)
+    with utils.profile_stage('read'):
+        ds_adjust = xr.open_dataset(args.adjustment_file)
+
+    with utils.profile_stage('kernel'):
+        ds_qdc_adjusted = change_match_adjust(
+            ds_qdc,
+            args.qdc_var,
+            ds_adjust[args.qdc_var],
+            args.scaling,
+        )
+
+    with utils.profile_stage('postprocess'):
+        infile_logs = {
+            args.qdc_file: ds_qdc.attrs['history'],
+            args.adjustment_file: ds_adjust.attrs['history'],
+        }
+        ds_qdc_adjusted.attrs['history'] = utils.get_new_log(infile_logs=infile_logs)
     encoding = utils.get_outfile_encoding(
         ds_qdc_adjusted,
         args.qdc_var,
-        time_units=args.output_time_units
+        time_units=args.output_time_units,
+        output_format=args.output_format,
     )
-    ds_qdc_adjusted.to_netcdf(args.outfile, encoding=encoding)
+    utils.write_outfile(ds_qdc_adjusted, args.outfile, encoding, output_format=args.output_format)
+    if args.profile:
+        utils.write_profile_report(args.outfile)
 
 
 if __name__ == '__main__':
@@ -94,13 +102,35 @@ if __name__ == '__main__':
         default=None,
         help="""Time units for output file (e.g. 'days_since_1950-01-01')""",
     )
+    parser.add_argument(
+        "--output_format",
+        type=str,
+        choices=('netcdf', 'zarr'),
+        default='netcdf',
+        help="Output file format",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        default=False,
+        help="Write the time, memory and dask tasks used by each processing stage to <outfile>.profile.json",
+    )
     parser.add_argument(
         "--verbose",
         action="store_true",
         default=False,
         help='Set logging level to INFO',
     )
+    utils.add_dask_arguments(parser)
     args = parser.parse_args()
     log_level = logging.INFO if args.verbose else logging.WARNING
     logging.basicConfig(level=log_level)
+    client = utils.start_dask(
+        args.scheduler,
+        n_workers=args.n_workers,
+        threads_per_worker=args.threads_per_worker,
+        memory_limit=args.memory_limit,
+        scheduler_address=args.scheduler_address,
+    )
     main(args)
+    utils.stop_dask(client)
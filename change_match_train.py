@@ -74,6 +74,8 @@ def main(args):
     """Run the program."""
 
     dask.diagnostics.ProgressBar().register()
+    if args.profile:
+        utils.start_profile('change_match_train.py')
     ds_qdc = utils.read_data(
         args.qdc_file,
         args.qdc_var,
@@ -100,25 +102,29 @@ def main(args):
         input_units=args.input_target_units,
         output_units=units,
     )
-    ds_af = change_match_train(
-        ds_qdc,
-        args.qdc_var,
-        ds_hist[args.hist_var],
-        ds_ref[args.ref_var],
-        ds_target[args.target_var],
-        args.scaling,
-    )
-
-    if args.short_history:
-        unique_dirnames = utils.get_unique_dirnames(
-            args.hist_files + args.ref_files + args.target_files
+    with utils.profile_stage('kernel'):
+        ds_af = change_match_train(
+            ds_qdc,
+            args.qdc_var,
+            ds_hist[args.hist_var],
+            ds_ref[args.ref_var],
+            ds_target[args.target_var],
+            args.scaling,
         )
-    else:
-        unique_dirnames = []
-    ds_af.attrs['history'] = utils.get_new_log(wildcard_prefixes=unique_dirnames)
 
-    encoding = utils.get_outfile_encoding(ds_af, args.qdc_var)
-    ds_af.to_netcdf(args.outfile, encoding=encoding)
+    with utils.profile_stage('postprocess'):
+        if args.short_history:
+            unique_dirnames = utils.get_unique_dirnames(
+                args.hist_files + args.ref_files + args.target_files
+            )
+        else:
+            unique_dirnames = []
+        ds_af.attrs['history'] = utils.get_new_log(wildcard_prefixes=unique_dirnames)
+
+    encoding = utils.get_outfile_encoding(ds_af, args.qdc_var, output_format=args.output_format)
+    utils.write_outfile(ds_af, args.outfile, encoding, output_format=args.output_format)
+    if args.profile:
+        utils.write_profile_report(args.outfile)
 
 
 if __name__ == '__main__':
@@ -221,6 +227,19 @@ if __name__ == '__main__':
         default='additive',
         help="scaling method",
     )
+    parser.add_argument(
+        "--output_format",
+        type=str,
+        choices=('netcdf', 'zarr'),
+        default='netcdf',
+        help="Output file format",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        default=False,
+        help="Write the time, memory and dask tasks used by each processing stage to <outfile>.profile.json",
+    )
     parser.add_argument(
         "--verbose",
         action="store_true",
@@ -233,7 +252,16 @@ if __name__ == '__main__':
         default=False,
         help="Use wildcards to shorten the file lists in output_file history attribute",
     )
+    utils.add_dask_arguments(parser)
     args = parser.parse_args()
     log_level = logging.INFO if args.verbose else logging.WARNING
     logging.basicConfig(level=log_level)
+    client = utils.start_dask(
+        args.scheduler,
+        n_workers=args.n_workers,
+        threads_per_worker=args.threads_per_worker,
+        memory_limit=args.memory_limit,
+        scheduler_address=args.scheduler_address,
+    )
     main(args)
+    utils.stop_dask(client)
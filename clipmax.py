@@ -10,20 +10,25 @@ import xarray as xr
 import utils
 
 
-def main(args):
-    """Run the program."""
+def clipmax(ds, var, max_ds, maxvar):
+    """Clip the maximum values of a dataset.
 
-    dask.diagnostics.ProgressBar().register()
+    Parameters
+    ----------
+    ds : xarray Dataset
+        Data to be clipped
+    var : str
+        Variable to be clipped (i.e. in ds)
+    max_ds : xarray Dataset
+        Maximum valid values (same time axis length as ds)
+    maxvar : str
+        Variable in max_ds
 
-    ds = xr.open_dataset(args.infile, decode_times=False)
+    Returns
+    -------
+    ds : xarray Dataset
+    """
 
-    max_ds = utils.read_data(
-        args.maxfiles,
-        args.maxvar,
-        time_bounds=args.maxtbounds,
-        output_units=ds[args.var].attrs['units'],
-        use_cftime=False,
-    )
     if len(ds['lat']) != len(max_ds['lat']):
         logging.info('Regridding max data to match input data')
         max_ds = utils.regrid(max_ds, ds)
@@ -33,24 +38,52 @@ def main(args):
         max_ds['lat'] = ds['lat']
         max_ds['lon'] = ds['lon']
     max_ds['time'] = ds['time']
-    max_da = max_ds[args.maxvar]
+    max_da = max_ds[maxvar]
 
-    ds[args.var] = xr.apply_ufunc(dask.array.minimum, ds[args.var], max_da, keep_attrs=True, dask='allowed')
+    ds[var] = xr.apply_ufunc(dask.array.minimum, ds[var], max_da, keep_attrs=True, dask='allowed')
 
-    infile_logs = {}
-    if 'history' in ds.attrs:
-        infile_logs[args.infile] = ds.attrs['history']
-    if args.short_history:
-        unique_dirnames = utils.get_unique_dirnames(args.maxfiles)
-    else:
-        unique_dirnames = []
-    ds.attrs['history'] = utils.get_new_log(
-        infile_logs=infile_logs,
-        wildcard_prefixes=unique_dirnames,
+    return ds
+
+
+def main(args):
+    """Run the program."""
+
+    dask.diagnostics.ProgressBar().register()
+    if args.profile:
+        utils.start_profile('clipmax.py')
+
+    with utils.profile_stage('read'):
+        ds = xr.open_dataset(args.infile, decode_times=False)
+
+    max_ds = utils.read_data(
+        args.maxfiles,
+        args.maxvar,
+        time_bounds=args.maxtbounds,
+        output_units=ds[args.var].attrs['units'],
+        use_cftime=False,
     )
+    with utils.profile_stage('kernel'):
+        ds = clipmax(ds, args.var, max_ds, args.maxvar)
 
-    encoding = utils.get_outfile_encoding(ds, args.var, compress=args.compress)
-    ds.to_netcdf(args.outfile, encoding=encoding)
+    with utils.profile_stage('postprocess'):
+        infile_logs = {}
+        if 'history' in ds.attrs:
+            infile_logs[args.infile] = ds.attrs['history']
+        if args.short_history:
+            unique_dirnames = utils.get_unique_dirnames(args.maxfiles)
+        else:
+            unique_dirnames = []
+        ds.attrs['history'] = utils.get_new_log(
+            infile_logs=infile_logs,
+            wildcard_prefixes=unique_dirnames,
+        )
+
+    encoding = utils.get_outfile_encoding(
+        ds, args.var, compress=args.compress, output_format=args.output_format
+    )
+    utils.write_outfile(ds, args.outfile, encoding, output_format=args.output_format)
+    if args.profile:
+        utils.write_profile_report(args.outfile)
 
 
 if __name__ == '__main__':
@@ -88,12 +121,34 @@ if __name__ == '__main__':
         default=False,
         help="compress the output data file"
     )
+    parser.add_argument(
+        "--output_format",
+        type=str,
+        choices=('netcdf', 'zarr'),
+        default='netcdf',
+        help="Output file format",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        default=False,
+        help="Write the time, memory and dask tasks used by each processing stage to <outfile>.profile.json",
+    )
     parser.add_argument(
         "--short_history",
         action='store_true',
         default=False,
         help="Use wildcards to shorten the maxfile list in the outfile history attribute",
     )
+    utils.add_dask_arguments(parser)
     args = parser.parse_args()
     logging.basicConfig(level=logging.INFO)
+    client = utils.start_dask(
+        args.scheduler,
+        n_workers=args.n_workers,
+        threads_per_worker=args.threads_per_worker,
+        memory_limit=args.memory_limit,
+        scheduler_address=args.scheduler_address,
+    )
     main(args)
+    utils.stop_dask(client)
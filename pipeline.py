@@ -0,0 +1,746 @@
+"""Command line program for running the train, adjust, change match and clip steps in a single dask graph."""
+
+import logging
+import argparse
+
+import dask.diagnostics
+
+import utils
+import train
+import adjust
+import change_match_train
+import change_match_adjust
+import clipmax
+
+
+def pipeline(
+    ds_hist,
+    ds_ref,
+    ds_target,
+    hist_var,
+    ref_var,
+    target_var,
+    scaling,
+    time_grouping=None,
+    nquantiles=100,
+    train_spatial_grid='hist',
+    adjust_spatial_grid='input',
+    ssr=False,
+    af_surface=None,
+    af_surface_shape=(200, 73),
+    quantile_method='exact',
+    sketch_nlevels=201,
+    interp='nearest',
+    max_af=None,
+    ref_time=False,
+    valid_min=None,
+    valid_max=None,
+    output_tslice=None,
+    stream=False,
+    stream_nlevels=201,
+    change_match=False,
+    max_ds=None,
+    maxvar=None,
+):
+    """Chain the qq-scaling steps without writing intermediate files.
+
+    Parameters
+    ----------
+    ds_hist : xarray Dataset
+        Historical data
+    ds_ref : xarray Dataset
+        Reference data
+    ds_target : xarray Dataset
+        Data to be adjusted
+    hist_var : str
+        Historical variable (i.e. in ds_hist)
+    ref_var : str
+        Reference variable (i.e. in ds_ref)
+    target_var : str
+        Variable to be adjusted (i.e. in ds_target)
+    scaling : {'additive', 'multiplicative'}
+        Scaling method
+    time_grouping : {'monthly', '3monthly'} default None
+        Time period grouping (default is no grouping)
+    nquantiles : int, default 100
+        Number of quantiles to process
+    train_spatial_grid : {'hist', 'ref'}, default 'hist'
+        Spatial grid for the adjustment factors (see train.train)
+    adjust_spatial_grid : {'input', 'af'}, default 'input'
+        Spatial grid for output data (see adjust.adjust)
+    ssr : bool, default False
+        Perform singularity stochastic removal
+    af_surface : {'linear', 'cubic'}, optional
+        Precompute a smoothed adjustment factor surface for this
+        interpolation method (monthly time grouping only)
+    af_surface_shape : tuple, default (200, 73)
+        Number of quantiles and days of the year in the af_surface
+    quantile_method : {'exact', 'sketch'}, default 'exact'
+        Method for calculating the training quantiles (see train.train)
+    sketch_nlevels : int, default 201
+        Number of probability levels in the quantile summaries (for quantile_method='sketch')
+    interp : {'nearest', 'linear', 'cubic'}, default 'nearest'
+        Method for interpolation of adjustment factors
+    max_af : float, optional
+        Maximum limit for adjustment factors
+    ref_time : bool, default False
+        Adjust the output time axis so it matches the reference data
+    valid_min : float, optional
+        Minimum valid value
+    valid_max : float, optional
+        Maximum valid value
+    output_tslice : list, optional
+        Return a time slice of the adjusted data
+        Format: ['YYYY-MM-DD', 'YYYY-MM-DD']
+    stream : bool, default False
+        Adjust the target data one time chunk at a time in two passes (see adjust.adjust)
+    stream_nlevels : int, default 201
+        Number of probability levels in the quantile summaries (for stream)
+    change_match : bool, default False
+        Adjust the output so the mean change matches the model mean change
+    max_ds : xarray Dataset, optional
+        Maximum valid values (the output is clipped to these values)
+    maxvar : str, optional
+        Variable in max_ds
+
+    Returns
+    -------
+    ds_af : xarray Dataset
+        Adjustment factors (computed)
+    ds_qdc : xarray Dataset
+        Adjusted data before change matching and clipping
+        (lazy, or persisted if change_match is True)
+    ds_change_match_af : xarray Dataset
+        Change match adjustment factors (computed), or None if change_match is False
+    ds_out : xarray Dataset
+        Final output (lazy)
+
+    Notes
+    -----
+    The adjustment factors and change match adjustment factors are small,
+    so they are computed (and kept in memory) as soon as they are needed.
+    Everything else is built lazily, so the input data are only read
+    when the final output is computed.
+    The exception is change matching, which needs the time mean of the adjusted data:
+    the adjusted data are persisted first so the adjustment is only calculated once
+    (process large grids in tiles so only one tile is held in memory at a time).
+    """
+
+    logging.info('Training: calculating adjustment factors')
+    ds_af = train.train(
+        ds_hist,
+        ds_ref,
+        hist_var,
+        ref_var,
+        scaling,
+        time_grouping=time_grouping,
+        nquantiles=nquantiles,
+        spatial_grid=train_spatial_grid,
+        ssr=ssr,
+        af_surface=af_surface,
+        af_surface_shape=af_surface_shape,
+        quantile_method=quantile_method,
+        sketch_nlevels=sketch_nlevels,
+    )
+    ds_af, = utils.compute_collections(ds_af)
+
+    ds_qdc = adjust.adjust(
+        ds_target,
+        target_var,
+        ds_af,
+        spatial_grid=adjust_spatial_grid,
+        interp=interp,
+        ssr=ssr,
+        max_af=max_af,
+        ref_time=ref_time,
+        valid_min=valid_min,
+        valid_max=valid_max,
+        output_tslice=output_tslice,
+        stream=stream,
+        stream_nlevels=stream_nlevels,
+    )
+
+    ds_change_match_af = None
+    if change_match:
+        logging.info('Persisting the adjusted data')
+        ds_qdc, = utils.persist_collections(ds_qdc)
+        logging.info('Change matching: calculating mean change adjustment factors')
+        with utils.profile_stage('kernel'):
+            ds_change_match_af = change_match_train.change_match_train(
+                ds_qdc,
+                target_var,
+                ds_hist[hist_var],
+                ds_ref[ref_var],
+                ds_target[target_var],
+                scaling,
+            )
+        ds_change_match_af, = utils.compute_collections(ds_change_match_af)
+        with utils.profile_stage('kernel'):
+            ds_out = change_match_adjust.change_match_adjust(
+                ds_qdc,
+                target_var,
+                ds_change_match_af[target_var],
+                scaling,
+            )
+    else:
+        ds_out = ds_qdc
+
+    if max_ds is not None:
+        with utils.profile_stage('kernel'):
+            ds_out = clipmax.clipmax(ds_out.copy(), target_var, max_ds, maxvar)
+
+    return ds_af, ds_qdc, ds_change_match_af, ds_out
+
+
+def pipeline_output(**kwargs):
+    """Run the pipeline and only return the final output (e.g. for utils.process_tiles)."""
+
+    ds_af, ds_qdc, ds_change_match_af, ds_out = pipeline(**kwargs)
+
+    return ds_out
+
+
+def main(args):
+    """Run the program."""
+
+    dask.diagnostics.ProgressBar().register()
+    if args.profile:
+        utils.start_profile('pipeline.py')
+    intermediate_files = args.af_file or args.qdc_file or args.change_match_af_file
+    if args.tile_size and intermediate_files:
+        raise ValueError(
+            'Invalid arguments: --tile_size cannot be used with --af_file, --qdc_file or --change_match_af_file'
+        )
+    if args.tile_size and args.sparse:
+        raise ValueError('Invalid arguments: --sparse cannot be used with --tile_size')
+    if args.quantile_method == 'sketch':
+        train_chunk_operation = 'train_sketch'
+        train_chunk_time_scales = {'hist': 1, 'ref': 1}
+    else:
+        train_chunk_operation = 'train_window' if args.time_grouping == '3monthly' else 'train'
+        train_chunk_time_scales = {
+            'hist': train.get_chunk_time_scale(args.hist_time_bounds, args.ref_time_bounds),
+            'ref': train.get_chunk_time_scale(args.ref_time_bounds, args.hist_time_bounds),
+        }
+    if args.stream:
+        adjust_chunk_operation = 'adjust_stream'
+    elif args.interp == 'nearest':
+        adjust_chunk_operation = 'adjust'
+    else:
+        adjust_chunk_operation = 'adjust_linear'
+    read_kwargs = {
+        'isel_hour': args.isel_hour,
+        'output_units': args.output_units,
+        'valid_min': args.valid_min,
+        'valid_max': args.valid_max,
+        'memory_per_worker': args.memory_per_worker,
+        'nquantiles': args.nquantiles,
+        'sparse': args.sparse,
+        'sparse_mask_dir': args.sparse_mask_dir,
+        'compute_dtype': args.compute_dtype,
+    }
+    ds_hist = utils.read_data(
+        args.hist_files,
+        args.hist_var,
+        time_bounds=args.hist_time_bounds,
+        input_units=args.input_hist_units,
+        time_chunk_size=args.time_chunk_size if args.quantile_method == 'sketch' else None,
+        chunk_operation=train_chunk_operation,
+        chunk_time_scale=train_chunk_time_scales['hist'],
+        **read_kwargs,
+    )
+    calendar_hist = type(ds_hist['time'].values[0])
+    ds_ref = utils.read_data(
+        args.ref_files,
+        args.ref_var,
+        time_bounds=args.ref_time_bounds,
+        input_units=args.input_ref_units,
+        output_calendar=calendar_hist,
+        time_chunk_size=args.time_chunk_size if args.quantile_method == 'sketch' else None,
+        chunk_operation=train_chunk_operation,
+        chunk_time_scale=train_chunk_time_scales['ref'],
+        **read_kwargs,
+    )
+    ds_target = utils.read_data(
+        args.target_files,
+        args.target_var,
+        time_bounds=args.target_time_bounds,
+        input_units=args.input_target_units,
+        use_cftime=False,
+        time_chunk_size=args.time_chunk_size if args.stream else None,
+        chunk_operation=adjust_chunk_operation,
+        **read_kwargs,
+    )
+    if args.max_files:
+        max_ds = utils.read_data(
+            args.max_files,
+            args.max_var,
+            time_bounds=args.max_time_bounds,
+            output_units=ds_target[args.target_var].attrs['units'],
+            use_cftime=False,
+        )
+    else:
+        max_ds = None
+
+    pipeline_kwargs = {
+        'hist_var': args.hist_var,
+        'ref_var': args.ref_var,
+        'target_var': args.target_var,
+        'scaling': args.scaling,
+        'time_grouping': args.time_grouping,
+        'nquantiles': args.nquantiles,
+        'train_spatial_grid': args.train_spatial_grid,
+        'adjust_spatial_grid': args.adjust_spatial_grid,
+        'ssr': args.ssr,
+        'af_surface': args.af_surface,
+        'af_surface_shape': args.af_surface_shape,
+        'quantile_method': args.quantile_method,
+        'sketch_nlevels': args.sketch_nlevels,
+        'interp': args.interp,
+        'max_af': args.max_af,
+        'ref_time': args.ref_time,
+        'valid_min': args.valid_min,
+        'valid_max': args.valid_max,
+        'output_tslice': args.output_tslice,
+        'stream': args.stream,
+        'stream_nlevels': args.stream_nlevels,
+        'change_match': args.change_match,
+        'maxvar': args.max_var,
+    }
+    if args.tile_size:
+        # Every step is applied tile by tile,
+        # so the input datasets must share a lat/lon grid
+        datasets = {'ds_hist': ds_hist, 'ds_ref': ds_ref, 'ds_target': ds_target}
+        if max_ds is not None:
+            datasets['max_ds'] = max_ds
+        for ds in datasets.values():
+            if (len(ds['lat']) != len(ds_target['lat'])) or (len(ds['lon']) != len(ds_target['lon'])):
+                raise ValueError('Invalid arguments: --tile_size requires all the input data to be on the same grid')
+        tile_results = utils.process_tiles(
+            pipeline_output,
+            datasets,
+            args.tile_size,
+            nworkers=args.tile_workers,
+            **pipeline_kwargs,
+        )
+        tile, ds_tile = next(tile_results)
+        spatial_coords = {'lat': ds_target['lat'], 'lon': ds_target['lon']}
+        ds_out = utils.get_tile_template(ds_tile, spatial_coords, args.tile_size)
+        ds_af = ds_qdc = ds_change_match_af = None
+    else:
+        ds_af, ds_qdc, ds_change_match_af, ds_out = pipeline(
+            ds_hist,
+            ds_ref,
+            ds_target,
+            max_ds=max_ds,
+            **pipeline_kwargs,
+        )
+
+    with utils.profile_stage('postprocess'):
+        if args.short_history:
+            unique_dirnames = utils.get_unique_dirnames(
+                args.hist_files + args.ref_files + args.target_files
+            )
+        else:
+            unique_dirnames = []
+        new_log = utils.get_new_log(wildcard_prefixes=unique_dirnames)
+
+    if args.af_file:
+        ds_af.attrs['history'] = new_log
+        utils.write_outfile(ds_af, args.af_file, output_format=args.output_format)
+    if args.change_match_af_file and (ds_change_match_af is not None):
+        ds_change_match_af.attrs['history'] = new_log
+        utils.write_outfile(ds_change_match_af, args.change_match_af_file, output_format=args.output_format)
+
+    outfiles = {args.outfile: ds_out}
+    if args.qdc_file:
+        outfiles[args.qdc_file] = ds_qdc
+    writes = []
+    for outfile, ds in outfiles.items():
+        with utils.profile_stage('postprocess'):
+            if args.outfile_attrs:
+                ds, output_var = adjust.amend_attributes(
+                    ds, args.target_var, ds_target.attrs, args.outfile_attrs
+                )
+            else:
+                output_var = args.target_var
+            ds.attrs['history'] = new_log
+        encoding = utils.get_outfile_encoding(
+            ds,
+            output_var,
+            time_units=args.output_time_units,
+            compress=args.compress,
+            output_format=args.output_format,
+        )
+        writes.append((ds, outfile, encoding))
+    logging.info(f'Writing {", ".join(outfiles)}')
+    if args.tile_size:
+        ds_out, outfile, encoding = writes[0]
+        with utils.profile_stage('write'):
+            utils.create_tiled_outfile(ds_out, outfile, encoding, output_format=args.output_format)
+            ds_tile = ds_tile.rename({args.target_var: output_var})
+            utils.write_tile(outfile, ds_tile, tile, output_format=args.output_format)
+            for tile, ds_tile in tile_results:
+                ds_tile = ds_tile.rename({args.target_var: output_var})
+                utils.write_tile(outfile, ds_tile, tile, output_format=args.output_format)
+    else:
+        utils.write_outfiles(writes, output_format=args.output_format)
+    if args.profile:
+        utils.write_profile_report(args.outfile)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        argument_default=argparse.SUPPRESS,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("hist_var", type=str, help="historical variable to process")
+    parser.add_argument("ref_var", type=str, help="reference variable to process")
+    parser.add_argument("target_var", type=str, help="target variable to process")
+    parser.add_argument("outfile", type=str, help="output file")
+    parser.add_argument(
+        "--hist_files",
+        type=str,
+        nargs='*',
+        required=True,
+        help="historical data files"
+    )
+    parser.add_argument(
+        "--ref_files",
+        type=str,
+        nargs='*',
+        required=True,
+        help="reference data files"
+    )
+    parser.add_argument(
+        "--target_files",
+        type=str,
+        nargs='*',
+        required=True,
+        help="target data files (i.e. the data to be adjusted)"
+    )
+    parser.add_argument(
+        "--isel_hour",
+        type=int,
+        default=None,
+        help="select a single hour from the input files"
+    )
+    parser.add_argument(
+        "--hist_time_bounds",
+        type=str,
+        nargs=2,
+        metavar=('START_DATE', 'END_DATE'),
+        required=True,
+        help="historical time bounds in YYYY-MM-DD format"
+    )
+    parser.add_argument(
+        "--ref_time_bounds",
+        type=str,
+        nargs=2,
+        metavar=('START_DATE', 'END_DATE'),
+        required=True,
+        help="reference time bounds in YYYY-MM-DD format"
+    )
+    parser.add_argument(
+        "--target_time_bounds",
+        type=str,
+        nargs=2,
+        metavar=('START_DATE', 'END_DATE'),
+        default=None,
+        help="target time bounds in YYYY-MM-DD format"
+    )
+    parser.add_argument(
+        "--input_hist_units",
+        type=str,
+        default=None,
+        help="input historical data units"
+    )
+    parser.add_argument(
+        "--input_ref_units",
+        type=str,
+        default=None,
+        help="input reference data units"
+    )
+    parser.add_argument(
+        "--input_target_units",
+        type=str,
+        default=None,
+        help="input target data units"
+    )
+    parser.add_argument(
+        "--output_units",
+        type=str,
+        default=None,
+        help="output data units"
+    )
+    parser.add_argument(
+        "--scaling",
+        type=str,
+        choices=('additive', 'multiplicative'),
+        default='additive',
+        help="scaling method",
+    )
+    parser.add_argument(
+        "--nquantiles",
+        type=int,
+        default=100,
+        help="Number of quantiles to process",
+    )
+    parser.add_argument(
+        "--time_grouping",
+        type=str,
+        choices=('monthly', '3monthly'),
+        default=None,
+        help="Time period grouping",
+    )
+    parser.add_argument(
+        "--train_spatial_grid",
+        type=str,
+        choices=('hist', 'ref'),
+        default='hist',
+        help="Spatial grid for the adjustment factors (hist or ref grid)",
+    )
+    parser.add_argument(
+        "--adjust_spatial_grid",
+        type=str,
+        choices=('input', 'af'),
+        default='input',
+        help="Spatial grid for output data (target data or adjustment factor grid)",
+    )
+    parser.add_argument(
+        "--ssr",
+        action="store_true",
+        default=False,
+        help='Apply Singularity Stochastic Removal to input data',
+    )
+    parser.add_argument(
+        "--quantile_method",
+        type=str,
+        choices=('exact', 'sketch'),
+        default='exact',
+        help=(
+            "Calculate exact quantiles or approximate quantiles from streamed quantile summaries "
+            "(slower; for time series that don't fit in memory)"
+        ),
+    )
+    parser.add_argument(
+        "--sketch_nlevels",
+        type=int,
+        default=201,
+        help="Number of probability levels in the quantile summaries (for --quantile_method sketch)",
+    )
+    parser.add_argument(
+        "--af_surface",
+        type=str,
+        choices=('linear', 'cubic'),
+        default=None,
+        help="Precompute a smoothed adjustment factor surface for this interpolation method",
+    )
+    parser.add_argument(
+        "--af_surface_shape",
+        type=int,
+        nargs=2,
+        metavar=('NQUANTILES', 'NDAYS'),
+        default=(200, 73),
+        help="Number of quantiles and days of the year in the af_surface",
+    )
+    parser.add_argument(
+        "--interp",
+        type=str,
+        choices=('nearest', 'linear', 'cubic'),
+        default='nearest',
+        help="Method for interpolation of adjustment factors",
+    )
+    parser.add_argument(
+        "--max_af",
+        type=float,
+        default=None,
+        help="Maximum limit for adjustment factors",
+    )
+    parser.add_argument(
+        "--ref_time",
+        action="store_true",
+        default=False,
+        help='Shift output time axis to match reference dataset',
+    )
+    parser.add_argument(
+        "--output_tslice",
+        type=str,
+        nargs=2,
+        metavar=('START_DATE', 'END_DATE'),
+        default=None,
+        help="return a time slice of the adjusted data [use YYYY-MM-DD format]"
+    )
+    parser.add_argument(
+        "--valid_min",
+        type=float,
+        default=None,
+        help="Minimum valid value",
+    )
+    parser.add_argument(
+        "--valid_max",
+        type=float,
+        default=None,
+        help="Maximum valid value",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        default=False,
+        help="Adjust the target data in time chunks (two passes instead of a single time chunk)",
+    )
+    parser.add_argument(
+        "--time_chunk_size",
+        type=int,
+        default=1825,
+        help="Number of time steps in each time chunk (for --quantile_method sketch and --stream)",
+    )
+    parser.add_argument(
+        "--stream_nlevels",
+        type=int,
+        default=201,
+        help="Number of probability levels in the quantile summaries used by --stream",
+    )
+    parser.add_argument(
+        "--memory_per_worker",
+        type=str,
+        default=None,
+        help="Memory available to process each data chunk (e.g. 4GB), used to choose lat/lon chunk sizes",
+    )
+    parser.add_argument(
+        "--sparse",
+        action="store_true",
+        default=False,
+        help="Only process the grid cells with valid (non-NaN) data (e.g. land points)",
+    )
+    parser.add_argument(
+        "--sparse_mask_dir",
+        type=str,
+        default=None,
+        help="Save the valid cell mask found by --sparse to this directory and reuse it in later runs on the same grid",
+    )
+    parser.add_argument(
+        "--compute_dtype",
+        type=str,
+        choices=('float32', 'float64'),
+        default=None,
+        help="Data type for the calculations (default is the input data type; float32 halves the memory per chunk)",
+    )
+    parser.add_argument(
+        "--tile_size",
+        type=int,
+        nargs=2,
+        metavar=('NLAT', 'NLON'),
+        default=None,
+        help="Process the lat/lon domain in tiles of this size (in a pool of worker processes)",
+    )
+    parser.add_argument(
+        "--tile_workers",
+        type=int,
+        default=1,
+        help="Number of worker processes (for --tile_size)",
+    )
+    parser.add_argument(
+        "--change_match",
+        action="store_true",
+        default=False,
+        help="Match the mean change of the output to the model mean change",
+    )
+    parser.add_argument(
+        "--max_files",
+        type=str,
+        nargs='*',
+        default=None,
+        help="data files containing maximum valid values (the output is clipped to these values)"
+    )
+    parser.add_argument(
+        "--max_var",
+        type=str,
+        default=None,
+        help="variable in max_files"
+    )
+    parser.add_argument(
+        "--max_time_bounds",
+        type=str,
+        nargs=2,
+        metavar=('START_DATE', 'END_DATE'),
+        default=None,
+        help="time period to extract from the max_files [use YYYY-MM-DD format]"
+    )
+    parser.add_argument(
+        "--af_file",
+        type=str,
+        default=None,
+        help="also write the adjustment factors to this file",
+    )
+    parser.add_argument(
+        "--qdc_file",
+        type=str,
+        default=None,
+        help="also write the adjusted data (before change matching and clipping) to this file",
+    )
+    parser.add_argument(
+        "--change_match_af_file",
+        type=str,
+        default=None,
+        help="also write the change match adjustment factors to this file",
+    )
+    parser.add_argument(
+        "--output_time_units",
+        type=str,
+        default=None,
+        help="""Time units for output file (e.g. 'days_since_1950-01-01')""",
+    )
+    parser.add_argument(
+        "--outfile_attrs",
+        type=str,
+        default=None,
+        help='YAML file with outfile attributes',
+    )
+    parser.add_argument(
+        "--output_format",
+        type=str,
+        choices=('netcdf', 'zarr'),
+        default='netcdf',
+        help="Output file format",
+    )
+    parser.add_argument(
+        "--compress",
+        action="store_true",
+        default=False,
+        help="compress the output data file"
+    )
+    parser.add_argument(
+        "--short_history",
+        action='store_true',
+        default=False,
+        help="Use wildcards to shorten the file lists in output_file history attribute",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        default=False,
+        help="Write the time, memory and dask tasks used by each processing stage to <outfile>.profile.json",
+    )
+    parser.add_argument(
+        "--verbose",
+        action="store_true",
+        default=False,
+        help='Set logging level to INFO',
+    )
+    utils.add_dask_arguments(parser)
+    args = parser.parse_args()
+    log_level = logging.INFO if args.verbose else logging.WARNING
+    logging.basicConfig(level=log_level)
+    client = utils.start_dask(
+        args.scheduler,
+        n_workers=args.n_workers,
+        threads_per_worker=args.threads_per_worker,
+        memory_limit=args.memory_limit,
+        scheduler_address=args.scheduler_address,
+    )
+    with dask.diagnostics.ResourceProfiler() as rprof:
+        main(args)
+    utils.profiling_stats(rprof)
+    utils.stop_dask(client)
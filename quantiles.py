@@ -9,7 +9,7 @@ import xclim as xc
 import utils
 
 
-def quantiles(ds, var, nquantiles):
+def quantiles(ds, var, nquantiles, ssr=False):
     """Calculate quantiles for each month.
 
     Parameters
@@ -20,18 +20,36 @@ def quantiles(ds, var, nquantiles):
         Variable (in ds) 
     nquantiles : int
         Number of quantiles to calculate
+    ssr : bool, default False
+        Perform singularity stochastic removal
 
     Returns
     -------
     ds_q : xarray Dataset
         Quantiles for each month
+
+    Notes
+    -----
+    The time grouping, SSR setting, time period and calendar are recorded
+    in the global attributes, so the output can be used in place of
+    the historical or reference data in train.py (see train.check_quantiles).
     """
 
     invar_attrs = ds[var].attrs
+    if ssr:
+        da = utils.apply_ssr(ds[var])
+    else:
+        da = ds[var]
     quantile_array = xc.sdba.utils.equally_spaced_nodes(nquantiles)
-    da_q = utils.get_quantiles(ds[var], quantile_array, timescale='monthly')
+    da_q = utils.get_quantiles(da, quantile_array, timescale='monthly')
     ds_q = da_q.to_dataset(name=var)    
     ds_q[var].attrs = invar_attrs
+    times = ds['time'].dt.strftime('%Y-%m-%d').values
+    ds_q.attrs['time_grouping'] = 'monthly'
+    ds_q.attrs['ssr'] = int(ssr)
+    ds_q.attrs['quantile_period_start'] = times[0]
+    ds_q.attrs['quantile_period_end'] = times[-1]
+    ds_q.attrs['calendar'] = ds['time'].dt.calendar
 
     return ds_q
 
@@ -40,16 +58,28 @@ def main(args):
     """Run the program."""
 
     dask.diagnostics.ProgressBar().register()
+    if args.profile:
+        utils.start_profile('quantiles.py')
     ds = utils.read_data(
         args.infiles,
         args.var,
         time_bounds=args.time_bounds,
         input_units=args.input_units,
         output_units=args.output_units,
+        memory_per_worker=args.memory_per_worker,
+        chunk_operation='quantiles',
+        nquantiles=args.nquantiles,
+        sparse=args.sparse,
+        sparse_mask_dir=args.sparse_mask_dir,
+        compute_dtype=args.compute_dtype,
     )
-    ds_q = quantiles(ds, args.var, args.nquantiles)
-    ds_q.attrs['history'] = utils.get_new_log()
-    ds_q.to_netcdf(args.outfile)
+    with utils.profile_stage('kernel'):
+        ds_q = quantiles(ds, args.var, args.nquantiles, ssr=args.ssr)
+    with utils.profile_stage('postprocess'):
+        ds_q.attrs['history'] = utils.get_new_log()
+    utils.write_outfile(ds_q, args.outfile, output_format=args.output_format)
+    if args.profile:
+        utils.write_profile_report(args.outfile)
 
 
 if __name__ == '__main__':
@@ -74,6 +104,59 @@ if __name__ == '__main__':
         metavar=('START_DATE', 'END_DATE'),
         help="time bounds in YYYY-MM-DD format"
     )
+    parser.add_argument(
+        "--ssr",
+        action="store_true",
+        default=False,
+        help='Perform Singularity Stochastic Removal (e.g. for quantiles used by train.py --ssr)',
+    )
+    parser.add_argument(
+        "--memory_per_worker",
+        type=str,
+        default=None,
+        help="Memory available to process each data chunk (e.g. 4GB), used to choose lat/lon chunk sizes",
+    )
+    parser.add_argument(
+        "--sparse",
+        action="store_true",
+        default=False,
+        help="Only process the grid cells with valid (non-NaN) data (e.g. land points)",
+    )
+    parser.add_argument(
+        "--sparse_mask_dir",
+        type=str,
+        default=None,
+        help="Save the valid cell mask found by --sparse to this directory and reuse it in later runs on the same grid",
+    )
+    parser.add_argument(
+        "--compute_dtype",
+        type=str,
+        choices=('float32', 'float64'),
+        default=None,
+        help="Data type for the calculations (default is the input data type; float32 halves the memory per chunk)",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        default=False,
+        help="Write the time, memory and dask tasks used by each processing stage to <outfile>.profile.json",
+    )
+    parser.add_argument(
+        "--output_format",
+        type=str,
+        choices=('netcdf', 'zarr'),
+        default='netcdf',
+        help="Output file format",
+    )
+    utils.add_dask_arguments(parser)
     args = parser.parse_args()
     logging.basicConfig(level=logging.INFO)
+    client = utils.start_dask(
+        args.scheduler,
+        n_workers=args.n_workers,
+        threads_per_worker=args.threads_per_worker,
+        memory_limit=args.memory_limit,
+        scheduler_address=args.scheduler_address,
+    )
     main(args)
+    utils.stop_dask(client)
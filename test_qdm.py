@@ -1,14 +1,22 @@
 """Test quantile delta mapping"""
 
+import os
+import argparse
+
 import pytest
 
 import numpy as np
 import pandas as pd
 import xarray as xr
+from xclim import sdba
 
 import train
 import quantiles
 import adjust
+import change_match_train
+import change_match_adjust
+import pipeline
+import utils
 
 
 @pytest.fixture
@@ -135,7 +143,198 @@ def test_training(ds_adjust):
         expected_result[50:, month] = perturbation
 
     assert np.allclose(expected_result, actual_result)
-        
+
+
+@pytest.mark.parametrize("precomputed", ['hist', 'ref', 'both'])
+def test_train_precomputed_quantiles(ds_hist, ds_ref, ds_adjust, precomputed):
+    """Test training with quantiles precomputed by quantiles.py.
+
+    Output should match training with the hist and ref data.
+    """
+
+    ds_hist_q = quantiles.quantiles(ds_hist, 'tasmax', 100) if precomputed in ['hist', 'both'] else None
+    ds_ref_q = quantiles.quantiles(ds_ref, 'tasmax', 100) if precomputed in ['ref', 'both'] else None
+    actual_result = train.train(
+        None if precomputed in ['hist', 'both'] else ds_hist,
+        None if precomputed in ['ref', 'both'] else ds_ref,
+        'tasmax',
+        'tasmax',
+        scaling='additive',
+        nquantiles=100,
+        time_grouping='monthly',
+        ds_hist_q=ds_hist_q,
+        ds_ref_q=ds_ref_q,
+    )
+
+    np.testing.assert_allclose(actual_result['af'].values, ds_adjust['af'].values)
+    np.testing.assert_allclose(actual_result['hist_q'].values, ds_adjust['hist_q'].values)
+    assert actual_result.attrs['reference_period_start'] == ds_adjust.attrs['reference_period_start']
+    with pytest.raises(ValueError):
+        train.train(
+            ds_hist, ds_ref, 'tasmax', 'tasmax', 'additive', nquantiles=50,
+            time_grouping='monthly', ds_hist_q=ds_hist_q, ds_ref_q=ds_ref_q,
+        )
+
+
+@pytest.mark.parametrize("time_grouping", ['monthly', '3monthly', None])
+@pytest.mark.parametrize("kind", ['+', '*'])
+def test_qdm_train(ds_hist, ds_ref, time_grouping, kind):
+    """Test native training kernel.
+
+    Output should be identical to xclim's QuantileDeltaMapping.train.
+    (The hist and ref data cover different periods, so with 3monthly grouping
+    this checks that the rolling window straddles the boundary between
+    the two periods in the same way as xclim, which rolls the window
+    along the union of the hist and ref time axes.)
+    """
+
+    groups = {
+        'monthly': sdba.Grouper('time.month'),
+        '3monthly': sdba.Grouper('time.month', window=3),
+        None: sdba.Grouper('time'),
+    }
+    group = groups[time_grouping]
+    da_ref = ds_ref['tasmax']
+    actual_result = train.qdm_train(
+        da_ref, ds_hist['tasmax'], group, kind, nquantiles=100
+    )
+    expected_result = sdba.QuantileDeltaMapping.train(
+        da_ref, ds_hist['tasmax'], nquantiles=100, group=group, kind=kind
+    ).ds.squeeze()
+
+    for var in ['af', 'hist_q']:
+        expected_da = expected_result[var].transpose(*actual_result[var].dims)
+        np.testing.assert_array_equal(actual_result[var].values, expected_da.values)
+    assert actual_result.attrs['adj_params'] == expected_result.attrs['adj_params']
+
+
+@pytest.mark.parametrize("time_grouping", ['monthly', None])
+def test_qdm_train_sketch(ds_hist, ds_ref, time_grouping):
+    """Test approximate training from quantile sketches.
+
+    Each sketch hist_q value should lie between the exact quantiles
+    either side of its quantile by the reported rank error bound.
+    """
+
+    group = sdba.Grouper('time.month') if time_grouping else sdba.Grouper('time')
+    da_hist = ds_hist['tasmax'].chunk({'time': 1825})
+    da_ref = ds_ref['tasmax'].chunk({'time': 1825})
+    actual_result = train.qdm_train(da_ref, da_hist, group, '+', nquantiles=100, sketch_nlevels=201)
+    expected_result = train.qdm_train(
+        da_ref.chunk({'time': -1}), da_hist.chunk({'time': -1}), group, '+', nquantiles=100
+    )
+
+    error_bound = actual_result.attrs['rank_error_bound']
+    assert 0 < error_bound < 0.05
+    quantiles = actual_result['quantiles'].values
+    lower_q = np.clip(quantiles - error_bound, 0, 1)
+    upper_q = np.clip(quantiles + error_bound, 0, 1)
+    months = range(1, 13) if time_grouping else [None]
+    for month in months:
+        if month:
+            hist_data = ds_hist['tasmax'][ds_hist['time'].dt.month == month].values
+            hist_q = actual_result['hist_q'].sel({'month': month}).values
+        else:
+            hist_data = ds_hist['tasmax'].values
+            hist_q = actual_result['hist_q'].values
+        assert np.all(hist_q >= np.quantile(hist_data, lower_q))
+        assert np.all(hist_q <= np.quantile(hist_data, upper_q))
+    af_difference = np.abs(actual_result['af'].values - expected_result['af'].values)
+    assert np.median(af_difference) < 0.05
+
+
+@pytest.mark.parametrize("interp", ['nearest', 'linear'])
+def test_qdm_adjust(ds_hist, ds_ref, ds_target, interp):
+    """Test native adjustment kernel.
+
+    Output should match xclim's QuantileDeltaMapping.adjust.
+    (No time grouping is used because with monthly grouping xclim uses
+    two dimensional griddata interpolation, which breaks ties arbitrarily
+    for nearest interpolation and uses a triangulation for linear interpolation.)
+    """
+
+    qm = sdba.QuantileDeltaMapping.train(
+        ds_ref['tasmax'], ds_hist['tasmax'], nquantiles=100, group='time', kind='+'
+    )
+    actual_result = adjust.qdm_adjust(ds_target['tasmax'], qm, interp=interp)
+    expected_result = qm.adjust(ds_target['tasmax'], extrapolation='constant', interp=interp)
+
+    np.testing.assert_allclose(actual_result.values, expected_result.values, rtol=1e-12)
+    assert actual_result.attrs['bias_adjustment'] == expected_result.attrs['bias_adjustment']
+
+
+def test_qdm_adjust_monthly_linear(ds_hist, ds_ref, ds_target):
+    """Test native monthly linear adjustment against xclim.
+
+    xclim interpolates the (quantile, month) adjustment factors on a triangulation,
+    whereas the native kernel interpolates bilinearly,
+    so the results are only identical where the two agree.
+    Both are weighted averages of the adjustment factors at the corners of a grid cell,
+    so they can differ by at most the range of the factors at those corners.
+    """
+
+    qm = sdba.QuantileDeltaMapping.train(
+        ds_ref['tasmax'], ds_hist['tasmax'], nquantiles=100, group='time.month', kind='+'
+    )
+    actual_result = adjust.qdm_adjust(ds_target['tasmax'], qm, interp='linear')
+    expected_result = qm.adjust(ds_target['tasmax'], extrapolation='constant', interp='linear')
+
+    af = qm.ds['af'].transpose('month', 'quantiles').values
+    af = np.concatenate([af, af[:1]])
+    corners = np.stack([af[:-1, :-1], af[1:, :-1], af[:-1, 1:], af[1:, 1:]])
+    max_cell_range = (corners.max(axis=0) - corners.min(axis=0)).max()
+    difference = np.abs(actual_result.values - expected_result.values)
+    assert np.median(difference) < 1e-10
+    assert np.mean(difference > 1e-6) < 0.05
+    assert difference.max() <= max_cell_range
+
+
+@pytest.mark.parametrize("interp", ['nearest', 'linear'])
+def test_adjust_stream(ds_target, ds_adjust, interp):
+    """Test streaming (two pass) adjustment.
+
+    Output should be close to the adjustment of a single time chunk.
+    The approximate ranks occasionally select a neighbouring adjustment factor,
+    which can differ by up to 10 times the month number around the median (see ds_ref),
+    so the test counts large differences rather than taking the mean.
+    """
+
+    expected_result = adjust.adjust(ds_target, 'tasmax', ds_adjust, interp=interp)
+    actual_result = adjust.adjust(
+        ds_target.chunk({'time': 1825}), 'tasmax', ds_adjust, interp=interp, stream=True
+    )
+
+    assert actual_result['tasmax'].chunksizes['time'][0] == 1825
+    difference = np.abs(actual_result['tasmax'].values - expected_result['tasmax'].values)
+    assert np.median(difference) < 1e-6
+    assert np.mean(difference > 0.5) < 0.02
+
+
+def test_adjust_target_cdf(ds_target, ds_adjust):
+    """Test adjustment against a frozen target CDF.
+
+    Adjusting a single year against the CDF of the full target period
+    should match that year of the full adjustment against the same CDF
+    and be close to the standard adjustment
+    (apart from occasional neighbouring adjustment factors, as for test_adjust_stream).
+    """
+
+    ds_cdf = adjust.get_target_cdf(ds_target, 'tasmax', timescale=adjust.get_timescale(ds_adjust))
+    ds_cdf = ds_cdf.compute()
+    expected_result = adjust.adjust(ds_target, 'tasmax', ds_adjust)
+    full_result = adjust.adjust(ds_target, 'tasmax', ds_adjust, target_cdf=ds_cdf)
+    year = slice('2010-01-01', '2010-12-31')
+    year_result = adjust.adjust(ds_target.sel({'time': year}), 'tasmax', ds_adjust, target_cdf=ds_cdf)
+
+    np.testing.assert_allclose(year_result['tasmax'].values, full_result['tasmax'].sel({'time': year}).values)
+    difference = np.abs(full_result['tasmax'].values - expected_result['tasmax'].values)
+    assert np.median(difference) < 1e-6
+    assert np.mean(difference > 0.5) < 0.02
+
+    ds_cdf.attrs['timescale'] = 'annual'
+    with pytest.raises(ValueError):
+        adjust.adjust(ds_target, 'tasmax', ds_adjust, target_cdf=ds_cdf)
+
 
 @pytest.mark.parametrize("month", [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12])
 def test_adjustment(qq_q, ref_q, ds_adjust, month):
@@ -158,3 +357,185 @@ def test_adjustment(qq_q, ref_q, ds_adjust, month):
     
 
     
+
+
+@pytest.mark.parametrize("surface_shape,mean_tolerance", [((1000, 366), 0.03), ((200, 73), 0.2)])
+@pytest.mark.parametrize("interp", ['linear', 'cubic'])
+def test_qdm_adjust_surface(ds_hist, ds_ref, ds_target, interp, surface_shape, mean_tolerance):
+    """Test adjustment with a precomputed adjustment factor surface.
+
+    Output should be close to xclim's QuantileDeltaMapping.adjust
+    with monthly grouping (the surface is a daily lookup table
+    of the same interpolation).
+    The example adjustment factors jump by up to 120C at the median,
+    so the lookup differs near the jumps and the mean difference
+    is larger for the (coarser) default surface shape.
+    """
+
+    qm = sdba.QuantileDeltaMapping.train(
+        ds_ref['tasmax'], ds_hist['tasmax'], nquantiles=100, group='time.month', kind='+'
+    )
+    ds_surface = qm.ds.copy()
+    nquantiles, ndays = surface_shape
+    ds_surface['af_surface'] = train.get_af_surface(qm.ds, interp, nquantiles=nquantiles, ndays=ndays)
+    qm_surface = sdba.QuantileDeltaMapping.from_dataset(ds_surface)
+    actual_result = adjust.qdm_adjust(ds_target['tasmax'], qm_surface, interp=interp)
+    expected_result = qm.adjust(ds_target['tasmax'], extrapolation='constant', interp=interp)
+
+    difference = np.abs(actual_result.values - expected_result.values)
+    assert np.median(difference) < 0.01
+    assert np.mean(difference) < mean_tolerance
+
+
+def test_pipeline(ds_hist, ds_ref, ds_target):
+    """Test the fused pipeline.
+
+    Output should match running the train, adjust and change match steps one after the other.
+    """
+
+    ds_target['tasmax'].attrs.update({'long_name': 'maximum temperature', 'standard_name': 'air_temperature'})
+    ds_af, ds_qdc, ds_change_match_af, actual_result = pipeline.pipeline(
+        ds_hist, ds_ref, ds_target, 'tasmax', 'tasmax', 'tasmax', 'additive',
+        time_grouping='monthly', change_match=True,
+    )
+    expected_af = train.train(ds_hist, ds_ref, 'tasmax', 'tasmax', 'additive', time_grouping='monthly')
+    expected_qdc = adjust.adjust(ds_target, 'tasmax', expected_af)
+    expected_change_match_af = change_match_train.change_match_train(
+        expected_qdc, 'tasmax', ds_hist['tasmax'], ds_ref['tasmax'], ds_target['tasmax'], 'additive'
+    )
+    expected_result = change_match_adjust.change_match_adjust(
+        expected_qdc, 'tasmax', expected_change_match_af['tasmax'], 'additive'
+    )
+
+    np.testing.assert_array_equal(ds_af['af'].values, expected_af['af'].values)
+    np.testing.assert_array_equal(ds_qdc['tasmax'].values, expected_qdc['tasmax'].values)
+    np.testing.assert_allclose(actual_result['tasmax'].values, expected_result['tasmax'].values)
+    assert np.isclose(
+        actual_result['tasmax'].mean() - ds_target['tasmax'].mean(),
+        ds_ref['tasmax'].mean() - ds_hist['tasmax'].mean(),
+    )
+
+
+def test_read_manifest(tmp_path):
+    """Test reading a batch training manifest.
+
+    Single files should be converted to file lists and invalid keys rejected.
+    """
+
+    manifest_file = tmp_path / 'manifest.yml'
+    manifest_file.write_text(
+        "- hist_files: [hist1.nc, hist2.nc]\n"
+        "  ref_files: ref.nc\n"
+        "  output_file: af.nc\n"
+    )
+    manifest = train.read_manifest(str(manifest_file))
+
+    assert manifest == [{'hist_files': ['hist1.nc', 'hist2.nc'], 'ref_files': ['ref.nc'], 'output_file': 'af.nc'}]
+    manifest_file.write_text("- hist_file: hist.nc\n  ref_files: ref.nc\n  output_file: af.nc\n")
+    with pytest.raises(KeyError):
+        train.read_manifest(str(manifest_file))
+
+
+def test_adjust_af_chunks(ds_target, ds_adjust, tmp_path):
+    """Test lazy adjustment factor loading.
+
+    Lazily opened adjustment factors should be chunked like the
+    target data (rather than embedded in the dask graph) without changing the result.
+    """
+
+    spatial_coords = {'lat': [-30.0, -29.0, -28.0, -27.0], 'lon': [120.0, 121.0]}
+    ds_target = ds_target.expand_dims(spatial_coords).transpose('time', 'lat', 'lon')
+    ds_adjust = ds_adjust.expand_dims(spatial_coords)
+    af_file = str(tmp_path / 'af.nc')
+    ds_adjust.to_netcdf(af_file)
+    target_file = str(tmp_path / 'target.nc')
+    ds_target.to_netcdf(target_file)
+    expected_result = adjust.adjust(ds_target, 'tasmax', ds_adjust)
+    actual_result = adjust.adjust(
+        xr.open_dataset(target_file, chunks={'lat': 2}), 'tasmax', xr.open_dataset(af_file)
+    )
+
+    ntasks, graph_nbytes = utils.get_graph_size(actual_result)
+    assert graph_nbytes == 0
+    np.testing.assert_array_equal(actual_result['tasmax'].values, expected_result['tasmax'].values)
+
+
+@pytest.mark.parametrize("interp", ['nearest', 'linear'])
+def test_compute_dtype(ds_hist, ds_ref, ds_target, interp, tmp_path):
+    """Test single precision (float32) processing.
+
+    The data should stay float32 from unit conversion through to the adjusted output,
+    and the result should be close to the float64 result
+    (see the precision benchmark in benchmark.py for the size of the differences).
+    Rounding occasionally moves a target value into a neighbouring quantile,
+    which gives a large difference at that time step
+    (the ref fixture has steps of 10 degrees between months),
+    so only a small fraction of the time steps are allowed to differ by more than 1e-3.
+    """
+
+    infiles = {}
+    for name, ds in [('hist', ds_hist), ('ref', ds_ref), ('target', ds_target)]:
+        infiles[name] = str(tmp_path / f'{name}.nc')
+        ds.to_netcdf(infiles[name])
+    results = {}
+    for compute_dtype in ['float64', 'float32']:
+        ds = {
+            name: utils.read_data(
+                [infile],
+                'tasmax',
+                output_units='K',
+                valid_min=273.15,
+                compute_dtype=compute_dtype,
+            )
+            for name, infile in infiles.items()
+        }
+        ds_adjust = train.train(ds['hist'], ds['ref'], 'tasmax', 'tasmax', 'additive', time_grouping='monthly')
+        qq = adjust.adjust(ds['target'], 'tasmax', ds_adjust, interp=interp, valid_min=273.15)
+        assert ds['target']['tasmax'].dtype == compute_dtype
+        assert ds_adjust['af'].dtype == compute_dtype
+        assert qq['tasmax'].dtype == compute_dtype
+        assert qq['tasmax'].values.dtype == compute_dtype
+        results[compute_dtype] = qq['tasmax'].values
+
+    difference = np.abs(results['float32'].astype(np.float64) - results['float64'])
+    assert np.median(difference) < 1e-4
+    assert np.mean(difference > 1e-3) < 0.005
+
+
+def test_af_store_config(ds_hist, tmp_path):
+    """Test the af store configuration.
+
+    Regenerating an input file in place (with the same size)
+    should change the configuration, and the {var} placeholder of
+    each quantile file should be filled with the hist or ref variable.
+    """
+
+    infile = str(tmp_path / 'hist.nc')
+    ds_hist.to_netcdf(infile)
+    for name in ['tasmax', 'tmax']:
+        ds_hist.rename({'tasmax': name}).to_netcdf(str(tmp_path / f'q_{name}.nc'))
+    options = [
+        'hist_time_bounds',
+        'ref_time_bounds',
+        'isel_hour',
+        'lat_bounds',
+        'lon_bounds',
+        'time_grouping',
+        'nquantiles',
+        'spatial_grid',
+        'af_surface',
+        'af_surface_shape',
+        'quantile_method',
+        'sketch_nlevels',
+        'compress',
+        'compute_dtype',
+    ]
+    args = argparse.Namespace(**{option: None for option in options})
+    run = {'hist_files': [infile], 'ref_quantile_file': str(tmp_path / 'q_{var}.nc')}
+    config = train.get_af_store_config(args, run, 'tasmax', 'tmax', {})
+    assert config['ref_quantile_file'][0] == str(tmp_path / 'q_tmax.nc')
+
+    mtime = os.path.getmtime(infile)
+    os.utime(infile, (mtime + 10, mtime + 10))
+    new_config = train.get_af_store_config(args, run, 'tasmax', 'tmax', {})
+    assert utils.get_af_store_key(new_config) != utils.get_af_store_key(config)
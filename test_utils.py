@@ -0,0 +1,463 @@
+"""Test utility functions"""
+
+import os
+import json
+
+import pytest
+
+import cftime
+import dask
+import numpy as np
+import pandas as pd
+import xarray as xr
+from xclim.sdba import nbutils
+
+import utils
+
+
+@pytest.fixture
+def da_grid():
+    """Create an example gridded dataset with missing values."""
+
+    times = pd.date_range("2000-01-01", "2009-12-31", freq="D")
+    data = (
+        -13 * np.cos(2 * np.pi * times.dayofyear.values / 365)[:, np.newaxis, np.newaxis]
+        + 2 * np.random.random_sample((times.size, 3, 4))
+        + 20
+    )
+    da = xr.DataArray(
+        data,
+        dims=("time", "lat", "lon"),
+        coords={"time": times, "lat": [-30.0, -29.0, -28.0], "lon": [120.0, 121.0, 122.0, 123.0]},
+        attrs={"units": "C"},
+    )
+    da[:, 0, 0] = np.nan
+    da[::7, 1, 1] = np.nan
+    da = da.chunk({'time': -1, 'lat': 2})
+
+    return da
+
+
+@pytest.mark.parametrize("dtype", ["float32", "float64"])
+def test_get_quantiles(da_grid, dtype):
+    """Grouped quantile engine should match xclim month by month."""
+
+    da = da_grid.astype(dtype)
+    quantiles = np.linspace(0.005, 0.995, 100)
+    actual_result = utils.get_quantiles(da, quantiles, timescale='monthly')
+
+    assert actual_result.dims == ('quantiles', 'month', 'lat', 'lon')
+    for month in range(1, 13):
+        expected_result = nbutils.quantile(da[da['time'].dt.month == month], quantiles, ['time'])
+        expected_result = expected_result.transpose('quantiles', 'lat', 'lon')
+        np.testing.assert_array_equal(
+            actual_result.sel({'month': month}).values,
+            expected_result.values,
+        )
+
+
+@pytest.mark.filterwarnings('error::RuntimeWarning')
+@pytest.mark.parametrize("time_chunk_size", [365, 1825])
+def test_get_quantile_summary(da_grid, time_chunk_size):
+    """Ranks from streamed quantile summaries should be close to the exact ranks.
+
+    The all NaN grid cell shouldn't cause divide by zero warnings.
+    """
+
+    da = da_grid.chunk({'time': time_chunk_size, 'lat': -1})
+    group_index, group_coords = utils.get_group_index(da['time'], 'monthly')
+    values, counts = utils.get_quantile_summary(da, nlevels=201, timescale='monthly')
+
+    assert values.dims == ('lat', 'lon', 'group', 'levels')
+    data = da.transpose('lat', 'lon', 'time').values
+    actual_ranks = utils.summary_ranks(data, values.values, counts.values, group_index)
+    expected_ranks = np.full(data.shape, np.nan)
+    for group in range(12):
+        times = group_index == group
+        expected_ranks[..., times] = utils.percentile_ranks(data[..., times])
+
+    np.testing.assert_array_equal(np.isnan(actual_ranks), np.isnan(expected_ranks))
+    assert np.nanmax(np.abs(actual_ranks - expected_ranks)) < 0.02
+
+
+def test_get_quantile_summary_window(da_grid):
+    """The rank error bound of a windowed summary should count the window values in each group."""
+
+    values, counts = utils.get_quantile_summary(da_grid, nlevels=201, timescale='monthly', window=3)
+
+    full_cell_counts = counts.sel({'lat': -30.0, 'lon': 121.0}).values
+    month_lengths = da_grid['time'].dt.month.to_series().value_counts().sort_index().values
+    expected_counts = 3 * month_lengths
+    expected_counts[[0, -1]] -= 1
+    np.testing.assert_array_equal(full_cell_counts, expected_counts)
+    assert values.attrs['rank_error_bound'] == 0.5 / expected_counts.min() + 1 / 200
+
+
+def monthly_mean(ds):
+    """Example tile function."""
+
+    return ds.groupby('time.month').mean('time', keep_attrs=True)
+
+
+def test_process_tiles(da_grid, tmp_path):
+    """Tiled output file should match processing the whole domain at once."""
+
+    ds = da_grid.to_dataset(name='tasmax')
+    expected_result = monthly_mean(ds).compute()
+    outfile = str(tmp_path / 'tiled.nc')
+    encoding = {'tasmax': {'dtype': 'float32', '_FillValue': None}}
+    tile_results = utils.process_tiles(monthly_mean, {'ds': ds}, (2, 3), nworkers=1)
+    tile, ds_tile = next(tile_results)
+    spatial_coords = {'lat': ds['lat'], 'lon': ds['lon']}
+    ds_template = utils.get_tile_template(ds_tile, spatial_coords, (2, 3))
+    utils.create_tiled_outfile(ds_template, outfile, encoding)
+    utils.write_tile(outfile, ds_tile, tile)
+    for tile, ds_tile in tile_results:
+        utils.write_tile(outfile, ds_tile, tile)
+    actual_result = xr.open_dataset(outfile)
+
+    assert len(utils.get_tiles(ds, (2, 3))) == 4
+    assert actual_result['tasmax'].dims == expected_result['tasmax'].dims
+    assert actual_result['tasmax'].attrs['units'] == 'C'
+    np.testing.assert_allclose(
+        actual_result['tasmax'].values, expected_result['tasmax'].values, rtol=1e-6
+    )
+
+
+@pytest.mark.parametrize("output_format", ["netcdf", "zarr"])
+def test_write_outfile(da_grid, tmp_path, output_format):
+    """Output files should round trip in each format."""
+
+    if output_format == 'zarr':
+        pytest.importorskip('zarr')
+    ds = da_grid.chunk({'time': 1000, 'lat': 2}).to_dataset(name='tasmax')
+    ds.attrs['history'] = 'test'
+    outfile = str(tmp_path / f'outfile.{output_format}')
+    encoding = utils.get_outfile_encoding(ds, 'tasmax', compress=True, output_format=output_format)
+    utils.write_outfile(ds, outfile, encoding, output_format=output_format)
+    actual_result = xr.open_dataset(outfile, engine='zarr' if output_format == 'zarr' else None)
+
+    assert actual_result.attrs['history'] == 'test'
+    assert actual_result['tasmax'].dtype == 'float32'
+    np.testing.assert_allclose(actual_result['tasmax'].values, ds['tasmax'].values, rtol=1e-6)
+
+
+@pytest.mark.parametrize(
+    "memory_per_worker, expected_chunks",
+    [
+        ("500kB", {'lat': 1, 'lon': 2}),
+        ("1MB", {'lat': 1, 'lon': 4}),
+        ("1GB", {'lat': 3, 'lon': 4}),
+    ],
+)
+def test_get_chunk_plan(da_grid, memory_per_worker, expected_chunks):
+    """Chunk plan should fit the memory budget and span whole rows of longitude where possible.
+
+    (Each grid point needs about 210kB for training on 10 years of float64 hist data
+    and 10 years of ref data, i.e. a time scale of 2.)
+    """
+
+    actual_chunks = utils.get_chunk_plan(da_grid, memory_per_worker, 'train', nquantiles=100, time_scale=2)
+
+    assert actual_chunks == expected_chunks
+    with pytest.raises(ValueError):
+        utils.get_chunk_plan(da_grid, memory_per_worker, 'regrid')
+
+
+def test_regrid_cache(da_grid, tmp_path):
+    """Regridding weight files should be keyed by grid and method and pruned least recently used first."""
+
+    ds = da_grid.to_dataset(name='tasmax')
+    ds_grid = ds.isel({'lat': slice(0, 2)})
+    key = utils.get_regrid_key(ds, ds_grid, 'bilinear')
+
+    assert key == utils.get_regrid_key(ds.copy(), ds_grid, 'bilinear')
+    assert key != utils.get_regrid_key(ds, ds_grid, 'conservative')
+    assert key != utils.get_regrid_key(ds_grid, ds, 'bilinear')
+    ds['mask'] = da_grid.isel({'time': 0}, drop=True).notnull().astype(int)
+    assert key != utils.get_regrid_key(ds, ds_grid, 'bilinear')
+
+    for count, name in enumerate(['old', 'used', 'new']):
+        weights_file = tmp_path / f'{name}.nc'
+        weights_file.write_bytes(b'0' * 1000)
+        os.utime(weights_file, (count, count))
+    os.utime(tmp_path / 'used.nc')
+    utils.prune_cache(str(tmp_path), 2000, keep=str(tmp_path / 'new.nc'))
+
+    assert sorted(os.listdir(tmp_path)) == ['new.nc', 'used.nc']
+
+
+def test_get_regrid_cache_dir(monkeypatch, tmp_path):
+    """The regridding weight cache should default to the user cache directory and can be moved or turned off."""
+
+    monkeypatch.delenv('QQSCALE_REGRID_CACHE', raising=False)
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path))
+    assert utils.get_regrid_cache_dir() == str(tmp_path / 'qqscale' / 'regrid_weights')
+    monkeypatch.setenv('QQSCALE_REGRID_CACHE', str(tmp_path / 'weights'))
+    assert utils.get_regrid_cache_dir() == str(tmp_path / 'weights')
+    monkeypatch.setenv('QQSCALE_REGRID_CACHE', '')
+    assert utils.get_regrid_cache_dir() == ''
+
+
+def test_read_data_multiple_variables(da_grid, tmp_path):
+    """Reading several variables at once should match reading each variable separately."""
+
+    ds = da_grid.to_dataset(name='tasmax')
+    ds['pr'] = (da_grid.clip(min=0) * 1e-5).assign_attrs({'units': 'kg m-2 s-1'})
+    infile = str(tmp_path / 'infile.nc')
+    ds.to_netcdf(infile)
+    options = {'output_units': {'pr': 'mm day-1'}, 'valid_min': {'tasmax': 10}}
+    ds_multi = utils.read_data([infile], ['tasmax', 'pr'], **options)
+
+    for var in ['tasmax', 'pr']:
+        var_options = {key: value.get(var) for key, value in options.items()}
+        ds_single = utils.read_data([infile], var, **var_options)
+        assert ds_multi[var].attrs['units'] == ds_single[var].attrs['units']
+        np.testing.assert_array_equal(ds_multi[var].values, ds_single[var].values)
+
+
+@pytest.mark.parametrize("memory_per_worker", [None, '1MB'])
+def test_sparse_cells(da_grid, tmp_path, memory_per_worker):
+    """Quantiles of packed (sparse) data should match the full grid once written."""
+
+    da = da_grid.copy()
+    da[:, 2, :] = np.nan
+    infile = str(tmp_path / 'infile.nc')
+    da.to_dataset(name='tasmax').to_netcdf(infile)
+    read_kwargs = {'memory_per_worker': memory_per_worker, 'chunk_operation': 'quantiles'}
+    ds_dense = utils.read_data([infile], 'tasmax', **read_kwargs)
+    ds_sparse = utils.read_data([infile], 'tasmax', sparse=True, **read_kwargs)
+    quantiles = np.linspace(0.005, 0.995, 10)
+    ds_q = utils.get_quantiles(ds_sparse['tasmax'], quantiles).to_dataset(name='tasmax')
+    outfile = str(tmp_path / 'outfile.nc')
+    utils.write_outfile(ds_q, outfile, utils.get_outfile_encoding(ds_q, 'tasmax'))
+    actual_result = xr.open_dataset(outfile)['tasmax']
+    expected_result = utils.get_quantiles(ds_dense['tasmax'], quantiles)
+
+    assert ds_sparse['tasmax'].dims == ('time', 'cell')
+    assert ds_sparse.sizes['cell'] == 7
+    assert actual_result.dims == expected_result.dims
+    np.testing.assert_allclose(actual_result.values, expected_result.values, rtol=1e-6)
+    np.testing.assert_array_equal(
+        utils.unpack_cells(ds_sparse)['tasmax'].values,
+        ds_dense['tasmax'].values,
+    )
+
+
+def test_sparse_mask_dir(da_grid, tmp_path):
+    """A saved valid cell mask should be reused for the same variable and grid."""
+
+    infile = str(tmp_path / 'infile.nc')
+    da_grid.to_dataset(name='tasmax').to_netcdf(infile)
+    mask_dir = str(tmp_path / 'masks')
+    expected_result = utils.get_valid_cells(da_grid.rename('tasmax'))
+    utils.read_data([infile], 'tasmax', sparse=True, sparse_mask_dir=mask_dir)
+    mask_files = os.listdir(mask_dir)
+    mask_file = os.path.join(mask_dir, mask_files[0])
+    with xr.open_dataset(mask_file) as ds_mask:
+        ds_mask = ds_mask.load()
+    np.testing.assert_array_equal(ds_mask['mask'].values, expected_result.values)
+
+    # Removing a cell from the saved mask shows it is reused
+    ds_mask['mask'][0, 1] = 0
+    ds_mask.to_netcdf(mask_file)
+    ds_sparse = utils.read_data([infile], 'tasmax', sparse=True, sparse_mask_dir=mask_dir)
+
+    assert len(mask_files) == 1
+    assert ds_sparse.sizes['cell'] == int(expected_result.sum()) - 1
+
+
+def test_get_variable_options(tmp_path):
+    """Options file values should override the defaults for the listed variables only."""
+
+    options_file = tmp_path / 'options.yml'
+    options_file.write_text("pr:\n  scaling: multiplicative\n  ssr: True\n")
+    defaults = {'scaling': 'additive', 'ssr': False}
+    var_options = utils.get_variable_options(['tasmax', 'pr'], defaults, options_file=str(options_file))
+
+    assert var_options == {
+        'tasmax': {'scaling': 'additive', 'ssr': False},
+        'pr': {'scaling': 'multiplicative', 'ssr': True},
+    }
+    assert utils.get_variable_outfile('{var}-af.nc', 'pr', ['tasmax', 'pr']) == 'pr-af.nc'
+    with pytest.raises(ValueError):
+        utils.get_variable_outfile('af.nc', 'pr', ['tasmax', 'pr'])
+    options_file.write_text("pr:\n  interp: linear\n")
+    with pytest.raises(KeyError):
+        utils.get_variable_options(['tasmax', 'pr'], defaults, options_file=str(options_file))
+
+
+@pytest.mark.parametrize(
+    "input_calendar, output_calendar",
+    [
+        ("standard", "noleap"),
+        ("noleap", "proleptic_gregorian"),
+        ("360_day", "standard"),
+        ("julian", "all_leap"),
+        ("numpy", "360_day"),
+        ("noleap", "numpy"),
+    ],
+)
+def test_convert_calendar(input_calendar, output_calendar):
+    """Converted dates should keep their date fields and drop dates that do not exist in the output calendar."""
+
+    start_date = '1999-12-30T06:00:00'
+    if input_calendar == 'numpy':
+        times = pd.date_range(start_date, periods=800, freq='D')
+    else:
+        times = xr.cftime_range(start_date, periods=800, freq='D', calendar=input_calendar)
+    bnds = np.stack([times - pd.Timedelta(hours=6), times + pd.Timedelta(hours=18)], axis=1)
+    ds = xr.Dataset(
+        {'tasmax': ('time', np.arange(times.size)), 'time_bnds': (('time', 'bnds'), bnds)},
+        coords={'time': times},
+    )
+    ds['time'].attrs['axis'] = 'T'
+    calendar = np.datetime64 if output_calendar == 'numpy' else output_calendar
+    actual_result = utils.convert_calendar(ds, calendar)
+
+    expected_times = []
+    expected_values = []
+    for value, time in zip(ds['tasmax'].values, times):
+        try:
+            if output_calendar == 'numpy':
+                expected_time = np.datetime64(pd.Timestamp(time.year, time.month, time.day, time.hour))
+            else:
+                expected_time = cftime.datetime(
+                    time.year, time.month, time.day, time.hour, calendar=output_calendar
+                )
+        except ValueError:
+            continue
+        expected_times.append(expected_time)
+        expected_values.append(value)
+    np.testing.assert_array_equal(actual_result['time'].values, np.array(expected_times))
+    np.testing.assert_array_equal(actual_result['tasmax'].values, expected_values)
+    assert actual_result['time'].attrs['axis'] == 'T'
+    bnds_diff = actual_result['time_bnds'].values - actual_result['time'].values[:, np.newaxis]
+    assert np.all(bnds_diff[:, 0] == -pd.Timedelta(hours=6))
+    assert np.all(bnds_diff[:, 1] == pd.Timedelta(hours=18))
+
+
+def test_af_store(da_grid, tmp_path):
+    """Stored adjustment factors should be found by key and copied to the output file."""
+
+    af_store = str(tmp_path / 'store')
+    config = {'hist_files': [['/data/hist.nc', 1000]], 'scaling': 'additive', 'nquantiles': 100}
+    key = utils.get_af_store_key(config)
+    outfile = str(tmp_path / 'af.nc')
+
+    assert key == utils.get_af_store_key(dict(reversed(list(config.items()))))
+    assert key != utils.get_af_store_key({**config, 'nquantiles': 50})
+    assert not utils.fetch_from_af_store(af_store, key, outfile)
+
+    infile = str(tmp_path / 'infile.nc')
+    da_grid.to_dataset(name='af').to_netcdf(infile)
+    utils.add_to_af_store(af_store, key, infile)
+
+    assert utils.fetch_from_af_store(af_store, key, outfile)
+    xr.testing.assert_identical(xr.open_dataset(outfile), xr.open_dataset(infile))
+    with pytest.raises(ValueError):
+        utils.get_af_store_file(af_store, 'missing')
+
+
+def test_profile_report(da_grid, tmp_path):
+    """Dask tasks should be attributed to the stage that created them."""
+
+    outfile = str(tmp_path / 'output.nc')
+    utils.start_profile('test')
+    with utils.profile_stage('read'):
+        da = da_grid.chunk({'time': -1, 'lat': 1})
+    with utils.profile_stage('kernel'):
+        da_mean = da.mean('time', keep_attrs=True)
+        with utils.profile_stage('ssr'):
+            da_ssr = utils.reverse_ssr(da_mean)
+    ds = xr.Dataset({'tasmax_mean': da_mean, 'tasmax_ssr': da_ssr})
+    utils.write_outfile(ds, outfile)
+    utils.write_profile_report(outfile)
+
+    assert utils.PROFILE is None
+    with open(f'{outfile}.profile.json') as reader:
+        report = json.load(reader)
+    assert report['program'] == 'test'
+    assert report['ntasks'] > 0
+    for stage in ['read', 'kernel', 'ssr']:
+        assert report['stages'][stage]['ntasks'] > 0
+        assert report['stages'][stage]['nbytes'] > 0
+    assert report['stages']['read']['nbytes'] >= da_grid.nbytes
+    assert report['stages']['write']['wall_time'] > 0
+
+
+def test_write_outfile_processes(da_grid, tmp_path):
+    """netCDF files should be written when the processes scheduler is used."""
+
+    outfile = str(tmp_path / 'output.nc')
+    ds = da_grid.chunk({'lat': 1}).to_dataset(name='tasmax') + 1
+    with dask.config.set({'scheduler': 'processes', 'num_workers': 2, 'multiprocessing.context': 'fork'}):
+        utils.write_outfile(ds, outfile)
+    xr.testing.assert_allclose(xr.open_dataset(outfile)['tasmax'], da_grid + 1)
+
+
+
+def test_start_dask_distributed(da_grid, tmp_path):
+    """A local distributed cluster should write an output file and be shut down afterwards."""
+
+    pytest.importorskip('distributed')
+    outfile = str(tmp_path / 'output.nc')
+    ds = da_grid.chunk({'lat': 1}).to_dataset(name='tasmax') + 1
+    client = utils.start_dask('distributed', n_workers=1, threads_per_worker=1, memory_limit='1GB')
+    cluster = client.cluster
+    try:
+        utils.write_outfile(ds, outfile)
+    finally:
+        utils.stop_dask(client)
+
+    assert client.status == 'closed'
+    assert cluster.status.name == 'closed'
+    xr.testing.assert_allclose(xr.open_dataset(outfile)['tasmax'], da_grid + 1)
+
+@pytest.mark.parametrize("queue_size", [1, 2])
+@pytest.mark.parametrize("output_format", ['netcdf', 'zarr'])
+def test_write_outfile_async(da_grid, tmp_path, queue_size, output_format):
+    """Writing a dataset in bands should give the same file as writing it in one go."""
+
+    if output_format == 'zarr':
+        pytest.importorskip('zarr')
+    engine = 'zarr' if output_format == 'zarr' else None
+    ds = da_grid.chunk({'time': -1, 'lat': 1}).to_dataset(name='tasmax')
+    encoding = utils.get_outfile_encoding(ds, 'tasmax', compress=True, output_format=output_format)
+    expected_file = str(tmp_path / f'expected.{output_format}')
+    actual_file = str(tmp_path / f'actual.{output_format}')
+    utils.write_outfile(ds, expected_file, encoding, output_format=output_format)
+    with dask.config.set(num_workers=1):
+        utils.write_outfile_async(ds, actual_file, encoding, output_format=output_format, queue_size=queue_size)
+
+    xr.testing.assert_identical(
+        xr.open_dataset(actual_file, engine=engine), xr.open_dataset(expected_file, engine=engine)
+    )
+
+
+def test_split_by_year(da_grid):
+    """Each year should be assigned to its own output file."""
+
+    ds = da_grid.chunk({'time': -1}).to_dataset(name='tasmax')
+    split_datasets = utils.split_by_year(ds, 'tasmax_{year}.nc')
+
+    assert list(split_datasets.keys()) == [f'tasmax_{year}.nc' for year in range(2000, 2010)]
+    assert (split_datasets['tasmax_2004.nc']['time'].dt.year == 2004).all()
+    xr.testing.assert_identical(xr.concat(split_datasets.values(), dim='time'), ds)
+    with pytest.raises(ValueError):
+        utils.split_by_year(ds, 'tasmax.nc')
+
+
+def test_write_outfiles_split_by_year_processes(da_grid, tmp_path):
+    """Per-year netCDF files should be written band by band with the processes scheduler."""
+
+    ds = (da_grid.chunk({'time': -1, 'lat': 1}).to_dataset(name='tasmax') + 1)
+    split_datasets = utils.split_by_year(ds, str(tmp_path / 'tasmax_{year}.nc'))
+    outputs = [(ds_year, outfile, None) for outfile, ds_year in split_datasets.items()]
+    with dask.config.set({'scheduler': 'processes', 'num_workers': 2, 'multiprocessing.context': 'fork'}):
+        utils.write_outfiles(outputs)
+        with pytest.raises(ValueError):
+            utils.write_outfile(ds, str(tmp_path / 'deferred.nc'), compute=False)
+
+    for outfile, ds_year in split_datasets.items():
+        xr.testing.assert_allclose(xr.open_dataset(outfile)['tasmax'], ds_year['tasmax'])
@@ -1,15 +1,474 @@
 """Command line program for calculating QQ-scaling adjustment factors."""
 
+import os
 import argparse
 import logging
 
+import yaml
+import numpy as np
+import pandas as pd
+import xarray as xr
 import xclim as xc
 from xclim import sdba
+from xclim.core.calendar import get_calendar
+from xclim.core.units import pint2cfunits, units2pint
 import dask.diagnostics
 
 import utils
 
 
+def qdm_train_kernel(
+    hist, ref, hist_group_index, ref_group_index, ngroups, quantiles, kind, window=1, hist_positions=None, ref_positions=None
+):
+    """Calculate hist quantiles and adjustment factors for numpy data.
+
+    With a window the group indexes are for the time axis the window rolls along
+    and the positions locate the hist and ref time steps on that axis
+    (see utils.rolling_window).
+
+    Returns arrays with dimensions (..., group, quantiles).
+    """
+
+    hist_q = utils.grouped_quantiles(
+        hist, hist_group_index, ngroups, quantiles, window=window, positions=hist_positions
+    )
+    ref_q = utils.grouped_quantiles(
+        ref, ref_group_index, ngroups, quantiles, window=window, positions=ref_positions
+    )
+    if kind == '+':
+        af = ref_q - hist_q
+    elif kind == '*':
+        af = ref_q / hist_q
+    else:
+        raise ValueError(f'Invalid adjustment kind: {kind}')
+
+    return af, hist_q
+
+
+def sketch_train_kernel(hist_values, hist_counts, ref_values, ref_counts, quantiles, kind):
+    """Calculate hist quantiles and adjustment factors from quantile summaries.
+
+    Returns arrays with dimensions (..., group, quantiles).
+    """
+
+    hist_q = utils.summary_quantiles(hist_values, hist_counts, quantiles)
+    ref_q = utils.summary_quantiles(ref_values, ref_counts, quantiles)
+    if kind == '+':
+        af = ref_q - hist_q
+    elif kind == '*':
+        af = ref_q / hist_q
+    else:
+        raise ValueError(f'Invalid adjustment kind: {kind}')
+
+    return af, hist_q
+
+
+def qdm_train(da_ref, da_hist, group, kind, nquantiles=100, sketch_nlevels=None):
+    """Calculate quantile delta mapping adjustment factors.
+
+    Equivalent to sdba.QuantileDeltaMapping.train, except that each
+    spatial block of hist and ref data is read once and sorted by group
+    to calculate hist_q and af in a single blockwise pass
+    (rather than through xclim's generic grouping machinery).
+
+    Parameters
+    ----------
+    da_ref : xarray DataArray
+        Reference data
+    da_hist : xarray DataArray
+        Historical data
+    group : xclim.sdba.Grouper
+        Time grouping (time.month with an optional window, or time)
+    kind : {'+', '*'}
+        Adjustment kind
+    nquantiles : int, default 100
+        Number of quantiles to process
+    sketch_nlevels : int, optional
+        Calculate approximate quantiles from quantile summaries
+        with this number of probability levels,
+        streaming over the time chunks of da_ref and da_hist
+        (see utils.get_quantile_summary)
+
+    Returns
+    -------
+    xarray Dataset
+        Adjustment factors (af) and historical quantiles (hist_q)
+        in the same format as sdba.QuantileDeltaMapping.train
+        (plus a rank_error_bound attribute if sketch_nlevels is used)
+    """
+
+    train_units = da_ref.attrs['units']
+    if da_hist.attrs['units'] != da_ref.attrs['units']:
+        da_hist = xc.units.convert_units_to(da_hist, da_ref)
+    calendars = {get_calendar(da_ref), get_calendar(da_hist)}
+    if len(calendars) > 1:
+        raise ValueError('Inputs are defined on different calendars')
+
+    timescale = 'annual' if group.prop == 'group' else 'monthly'
+    hist_group_index, group_coords = utils.get_group_index(da_hist['time'], timescale)
+    ref_group_index, group_coords = utils.get_group_index(da_ref['time'], timescale)
+    group_dims = list(group_coords.keys())
+    ngroups = len(group_coords[group_dims[0]]) if group_dims else 1
+    quantiles = sdba.utils.equally_spaced_nodes(nquantiles).astype(da_ref.dtype)
+
+    # (packed cells already share an index; see utils.match_cells)
+    spatial_coords = {
+        dim: da_hist[dim] for dim in da_hist.dims if (dim in da_ref.dims) and (dim not in ['time', 'cell'])
+    }
+    da_ref = da_ref.assign_coords(spatial_coords)
+
+    if sketch_nlevels:
+        hist_values, hist_counts = utils.get_quantile_summary(
+            da_hist, nlevels=sketch_nlevels, timescale=timescale, window=group.window
+        )
+        ref_values, ref_counts = utils.get_quantile_summary(
+            da_ref, nlevels=sketch_nlevels, timescale=timescale, window=group.window
+        )
+        rank_error_bound = max(
+            hist_values.attrs['rank_error_bound'], ref_values.attrs['rank_error_bound']
+        )
+        logging.info(f'Quantile sketch rank error bound: {rank_error_bound:.4f}')
+        af, hist_q = xr.apply_ufunc(
+            sketch_train_kernel,
+            hist_values,
+            hist_counts,
+            ref_values,
+            ref_counts,
+            kwargs={'quantiles': quantiles, 'kind': kind},
+            input_core_dims=[['group', 'levels'], ['group'], ['group', 'levels'], ['group']],
+            output_core_dims=[['group', 'quantiles'], ['group', 'quantiles']],
+            dask='parallelized',
+            output_dtypes=[da_ref.dtype, da_hist.dtype],
+            dask_gufunc_kwargs={'output_sizes': {'quantiles': len(quantiles)}},
+        )
+    else:
+        window_kwargs = {'window': group.window}
+        if group.window > 1:
+            # xclim rolls the window along the union of the hist and ref time axes,
+            # so at the edges of each period it can include time steps from the other period
+            window_times = xr.align(da_hist['time'], da_ref['time'], join='outer')[0]['time']
+            window_index = window_times.to_index()
+            hist_group_index, group_coords = utils.get_group_index(window_times, timescale)
+            ref_group_index = hist_group_index
+            window_kwargs['hist_positions'] = window_index.get_indexer(da_hist.indexes['time'])
+            window_kwargs['ref_positions'] = window_index.get_indexer(da_ref.indexes['time'])
+        da_ref = da_ref.rename({'time': 'ref_time'})
+        af, hist_q = xr.apply_ufunc(
+            qdm_train_kernel,
+            da_hist,
+            da_ref,
+            kwargs={
+                'hist_group_index': hist_group_index,
+                'ref_group_index': ref_group_index,
+                'ngroups': ngroups,
+                'quantiles': quantiles,
+                'kind': kind,
+                **window_kwargs,
+            },
+            input_core_dims=[['time'], ['ref_time']],
+            output_core_dims=[['group', 'quantiles'], ['group', 'quantiles']],
+            dask='parallelized',
+            output_dtypes=[da_ref.dtype, da_hist.dtype],
+            dask_gufunc_kwargs={'output_sizes': {'group': ngroups, 'quantiles': len(quantiles)}},
+        )
+    ds = xr.Dataset({'af': af, 'hist_q': hist_q})
+    if sketch_nlevels:
+        ds.attrs['rank_error_bound'] = rank_error_bound
+    if group_dims:
+        ds = ds.rename({'group': group_dims[0]})
+    else:
+        ds = ds.squeeze('group', drop=True)
+    ds = ds.assign_coords({'quantiles': quantiles, **group_coords})
+
+    return get_qdm_dataset(ds, train_units, group, kind, get_calendar(da_hist))
+
+
+def get_qdm_dataset(ds, train_units, group, kind, hist_calendar):
+    """Add the attributes of an sdba.QuantileDeltaMapping training dataset.
+
+    Parameters
+    ----------
+    ds : xarray Dataset
+        Adjustment factors (af) and historical quantiles (hist_q)
+        with a quantiles dimension (and a month dimension for monthly grouping)
+    train_units : str
+        Units of the reference data
+    group : xclim.sdba.Grouper
+        Time grouping
+    kind : {'+', '*'}
+        Adjustment kind
+    hist_calendar : str
+        Calendar of the historical data
+
+    Returns
+    -------
+    xarray Dataset
+    """
+
+    af_units = pint2cfunits(units2pint(train_units))
+    group_dims = [dim for dim in ['month'] if dim in ds.dims]
+    ds = ds.transpose('quantiles', *group_dims, ...)
+    ds['af'].attrs = {
+        'units': af_units,
+        'kind': kind,
+        'standard_name': 'Adjustment factors',
+        'long_name': 'Quantile mapping adjustment factors',
+    }
+    ds['hist_q'].attrs = {
+        'units': train_units,
+        'standard_name': 'Model quantiles',
+        'long_name': 'Quantiles of model on the reference period',
+    }
+    qm = sdba.QuantileDeltaMapping(
+        _trained=True,
+        hist_calendar=hist_calendar,
+        train_units=train_units,
+        group=group,
+        kind=kind,
+    )
+    qm.set_dataset(ds)
+
+    return qm.ds
+
+
+def check_quantiles(ds_q, var, nquantiles, time_grouping=None, ssr=False, units=None):
+    """Check that precomputed quantiles (see quantiles.quantiles) match the training options.
+
+    Parameters
+    ----------
+    ds_q : xarray Dataset
+        Precomputed quantiles
+    var : str
+        Variable (i.e. in ds_q)
+    nquantiles : int
+        Number of quantiles to process
+    time_grouping : {'monthly', '3monthly'} default None
+        Time period grouping (default is no grouping)
+    ssr : bool, default False
+        Perform singularity stochastic removal
+    units : str, optional
+        Expected units
+
+    Raises
+    ------
+    ValueError
+        If the quantiles don't match
+    """
+
+    for attr in ['time_grouping', 'ssr', 'quantile_period_start', 'quantile_period_end']:
+        if attr not in ds_q.attrs:
+            raise ValueError(f'Invalid quantile file: no {attr} attribute (recalculate with quantiles.py)')
+    if ds_q.attrs['time_grouping'] != time_grouping:
+        raise ValueError(
+            f'Invalid quantile file: time grouping {ds_q.attrs["time_grouping"]} (expected {time_grouping})'
+        )
+    if bool(ds_q.attrs['ssr']) != bool(ssr):
+        raise ValueError(f'Invalid quantile file: ssr {bool(ds_q.attrs["ssr"])} (expected {bool(ssr)})')
+    expected_quantiles = sdba.utils.equally_spaced_nodes(nquantiles)
+    file_quantiles = ds_q['quantiles'].values
+    if (len(file_quantiles) != nquantiles) or not np.allclose(file_quantiles, expected_quantiles):
+        raise ValueError(f'Invalid quantile file: {len(file_quantiles)} quantiles (expected {nquantiles})')
+    file_units = ds_q[var].attrs['units']
+    if units and (units2pint(file_units) != units2pint(units)):
+        raise ValueError(f'Invalid quantile file: units {file_units} (expected {units})')
+
+
+def get_data_quantiles(da, quantiles, sketch_nlevels=None):
+    """Calculate monthly quantiles in the format of quantiles.quantiles.
+
+    Parameters
+    ----------
+    da : xarray DataArray
+        Input data
+    quantiles : numpy ndarray
+        Quantiles to calculate
+    sketch_nlevels : int, optional
+        Calculate approximate quantiles from quantile summaries
+        with this number of probability levels (see utils.get_quantile_summary)
+
+    Returns
+    -------
+    xarray DataArray
+    """
+
+    if not sketch_nlevels:
+        return utils.get_quantiles(da, quantiles, timescale='monthly')
+
+    values, counts = utils.get_quantile_summary(da, nlevels=sketch_nlevels, timescale='monthly')
+    da_q = xr.apply_ufunc(
+        utils.summary_quantiles,
+        values,
+        counts,
+        kwargs={'quantiles': quantiles},
+        input_core_dims=[['group', 'levels'], ['group']],
+        output_core_dims=[['group', 'quantiles']],
+        dask='parallelized',
+        output_dtypes=[da.dtype],
+        dask_gufunc_kwargs={'output_sizes': {'quantiles': len(quantiles)}},
+        keep_attrs=True,
+    )
+    da_q = da_q.rename({'group': 'month'})
+    da_q = da_q.assign_coords({'quantiles': quantiles, 'month': np.arange(1, 13)})
+    da_q.attrs['units'] = da.attrs['units']
+
+    return da_q
+
+
+def qdm_train_quantiles(da_ref_q, da_hist_q, group, kind, hist_calendar):
+    """Calculate quantile delta mapping adjustment factors from monthly quantiles.
+
+    Parameters
+    ----------
+    da_ref_q : xarray DataArray
+        Reference quantiles (e.g. from quantiles.quantiles)
+    da_hist_q : xarray DataArray
+        Historical quantiles (e.g. from quantiles.quantiles)
+    group : xclim.sdba.Grouper
+        Time grouping (time.month)
+    kind : {'+', '*'}
+        Adjustment kind
+    hist_calendar : str
+        Calendar of the historical data
+
+    Returns
+    -------
+    xarray Dataset
+        Adjustment factors (af) and historical quantiles (hist_q)
+        in the same format as qdm_train
+    """
+
+    train_units = da_ref_q.attrs['units']
+    if da_hist_q.attrs['units'] != train_units:
+        da_hist_q = xc.units.convert_units_to(da_hist_q, da_ref_q)
+    if not np.allclose(da_hist_q['quantiles'].values, da_ref_q['quantiles'].values):
+        raise ValueError('Historical and reference quantiles are not the same')
+    spatial_coords = {dim: da_hist_q[dim] for dim in da_hist_q.dims if dim in ['lat', 'lon']}
+    da_ref_q = da_ref_q.assign_coords({'quantiles': da_hist_q['quantiles'], **spatial_coords})
+
+    if kind == '+':
+        af = da_ref_q - da_hist_q
+    elif kind == '*':
+        af = da_ref_q / da_hist_q
+    else:
+        raise ValueError(f'Invalid adjustment kind: {kind}')
+    ds = xr.Dataset({'af': af, 'hist_q': da_hist_q})
+    ds = ds.drop_vars([coord for coord in ds.coords if coord not in ds.dims])
+
+    return get_qdm_dataset(ds, train_units, group, kind, hist_calendar)
+
+
+def get_af_surface(ds, interp, nquantiles=200, ndays=73):
+    """Precompute a smoothed adjustment factor surface.
+
+    Evaluates the (quantile, month) adjustment factor interpolation
+    that xclim performs at adjustment time (xclim.sdba.utils.interp_on_quantiles)
+    once on a regular grid of quantiles and days of the year,
+    so that adjust.py only needs a cheap table lookup.
+
+    Parameters
+    ----------
+    ds : xarray Dataset
+        Trained adjustment factors (monthly grouping)
+    interp : {'linear', 'cubic'}
+        Method for interpolation of adjustment factors
+    nquantiles : int, default 200
+        Number of quantiles in the surface
+    ndays : int, default 73
+        Number of days of the year in the surface
+
+    Returns
+    -------
+    xarray DataArray
+        Adjustment factors with dimensions (surface_quantiles, surface_dayofyear, ...)
+
+    Notes
+    -----
+    The day of year axis refers to a leap year.
+    """
+
+    if 'month' not in ds['af'].dims:
+        raise ValueError('An af_surface can only be calculated for monthly time grouping')
+
+    surface_quantiles = sdba.utils.equally_spaced_nodes(nquantiles)
+    surface_dayofyear = np.floor(1 + (np.arange(ndays) + 0.5) * 366 / ndays).astype(int)
+    dates = pd.Timestamp('2000-01-01') + pd.to_timedelta(surface_dayofyear - 1, unit='D')
+    newx = xr.DataArray(
+        np.tile(surface_quantiles, ndays),
+        dims='time',
+        coords={'time': np.repeat(dates.values, nquantiles)},
+    )
+    surface = sdba.utils.interp_on_quantiles(
+        newx,
+        ds['quantiles'],
+        ds['af'],
+        group='time.month',
+        method=interp,
+        extrapolation='constant',
+    )
+    surface = surface.transpose(..., 'time')
+    other_dims = surface.dims[:-1]
+    surface = xr.DataArray(
+        surface.data.reshape(surface.shape[:-1] + (ndays, nquantiles)),
+        dims=other_dims + ('surface_dayofyear', 'surface_quantiles'),
+        coords={dim: surface[dim] for dim in other_dims if dim in surface.coords},
+    )
+    surface = surface.assign_coords(
+        {'surface_quantiles': surface_quantiles, 'surface_dayofyear': surface_dayofyear}
+    )
+    surface = surface.transpose('surface_quantiles', 'surface_dayofyear', ...)
+    surface['surface_dayofyear'].attrs = {'long_name': 'Day of year (leap year)'}
+    surface.attrs = {
+        'units': ds['af'].attrs['units'],
+        'kind': ds['af'].attrs['kind'],
+        'interp': interp,
+        'standard_name': 'Adjustment factors',
+        'long_name': f'Quantile mapping adjustment factors ({interp} interpolation surface)',
+    }
+
+    return surface
+
+
+def match_grids(ds_hist, ds_ref, hist_var, ref_var, spatial_grid='hist'):
+    """Regrid the historical or reference data (if necessary) so they share a spatial grid.
+
+    Parameters
+    ----------
+    ds_hist : xarray Dataset
+        Historical data
+    ds_ref : xarray Dataset
+        Reference data
+    hist_var : str or list
+        Historical variable/s (i.e. in ds_hist)
+    ref_var : str or list
+        Reference variable/s (i.e. in ds_ref)
+    spatial_grid : {'hist', 'ref'}, default 'hist'
+        Spatial grid for output data (hist or ref grid)
+
+    Returns
+    -------
+    ds_hist : xarray Dataset
+    ds_ref : xarray Dataset
+    spatial_coords : dict
+        lat and lon coordinates of the output grid
+    """
+
+    if len(ds_hist['lat']) != len(ds_ref['lat']):
+        if spatial_grid == 'ref':
+            ds_hist = utils.regrid(ds_hist, ds_ref, variable=hist_var)
+            logging.info('Regridding hist data to ref grid')
+            spatial_coords = {'lat': ds_ref['lat'], 'lon': ds_ref['lon']}
+        elif spatial_grid == 'hist':
+            ds_ref = utils.regrid(ds_ref, ds_hist, variable=ref_var)
+            logging.info('Regridding ref data to hist grid')
+            spatial_coords = {'lat': ds_hist['lat'], 'lon': ds_hist['lon']}
+    else:
+        spatial_coords = {'lat': ds_ref['lat'], 'lon': ds_ref['lon']}
+    assert len(ds_hist['lat']) == len(ds_ref['lat'])
+    assert len(ds_hist['lon']) == len(ds_ref['lon'])
+
+    return ds_hist, ds_ref, spatial_coords
+
+
 def train(
     ds_hist,
     ds_ref,
@@ -19,7 +478,13 @@ def train(
     time_grouping=None,
     nquantiles=100,
     spatial_grid='hist',
-    ssr=False
+    ssr=False,
+    af_surface=None,
+    af_surface_shape=(200, 73),
+    quantile_method='exact',
+    sketch_nlevels=201,
+    ds_hist_q=None,
+    ds_ref_q=None,
 ):
     """Calculate qq-scaling adjustment factors.
 
@@ -43,136 +508,536 @@ def train(
         Spatial grid for output data (hist or ref grid)
     ssr : bool, default False
         Perform singularity stochastic removal 
+    af_surface : {'linear', 'cubic'}, optional
+        Precompute a smoothed adjustment factor surface for this
+        adjust.py interpolation method (monthly time grouping only)
+    af_surface_shape : tuple, default (200, 73)
+        Number of quantiles and days of the year in the af_surface
+    quantile_method : {'exact', 'sketch'}, default 'exact'
+        Calculate exact quantiles (requires a single time chunk)
+        or approximate quantiles from quantile summaries (streams over time chunks)
+    sketch_nlevels : int, default 201
+        Number of probability levels in the quantile summaries (for quantile_method='sketch')
+    ds_hist_q : xarray Dataset, optional
+        Precomputed historical quantiles (see quantiles.quantiles) to use instead of ds_hist
+        (ds_hist can then be None)
+    ds_ref_q : xarray Dataset, optional
+        Precomputed reference quantiles (see quantiles.quantiles) to use instead of ds_ref
+        (ds_ref can then be None)
         
     Returns
     -------
     xarray Dataset
     """
 
+    for ds_q, var in [(ds_hist_q, hist_var), (ds_ref_q, ref_var)]:
+        if ds_q is not None:
+            check_quantiles(ds_q, var, nquantiles, time_grouping=time_grouping, ssr=ssr)
+    if ds_hist_q is not None:
+        ds_hist = ds_hist_q
+    if ds_ref_q is not None:
+        ds_ref = ds_ref_q
     hist_units = ds_hist[hist_var].attrs['units']
     ref_units = ds_ref[ref_var].attrs['units']
+
+    if ('cell' in ds_hist[hist_var].dims) or ('cell' in ds_ref[ref_var].dims):
+        if spatial_grid == 'ref':
+            ds_hist = utils.match_cells(ds_hist, ds_ref, variable=hist_var)
+        else:
+            ds_ref = utils.match_cells(ds_ref, ds_hist, variable=ref_var)
     
     dims = ds_hist[hist_var].dims
     on_spatial_grid = ('lat' in dims) and ('lon' in dims)
     if on_spatial_grid:
-        if len(ds_hist['lat']) != len(ds_ref['lat']):
-            if spatial_grid == 'ref':
-                ds_hist = utils.regrid(ds_hist, ds_ref, variable=hist_var)
-                logging.info('Regridding hist data to ref grid')
-                spatial_coords = {'lat': ds_ref['lat'], 'lon': ds_ref['lon']}
-            elif spatial_grid == 'hist':
-                ds_ref = utils.regrid(ds_ref, ds_hist, variable=ref_var)
-                logging.info('Regridding ref data to hist grid')
-                spatial_coords = {'lat': ds_hist['lat'], 'lon': ds_hist['lon']}
-        else:
-            spatial_coords = {'lat': ds_ref['lat'], 'lon': ds_ref['lon']}
-        assert len(ds_hist['lat']) == len(ds_ref['lat'])
-        assert len(ds_hist['lon']) == len(ds_ref['lon'])    
+        ds_hist, ds_ref, spatial_coords = match_grids(
+            ds_hist, ds_ref, hist_var, ref_var, spatial_grid=spatial_grid
+        )
 
     scaling_methods = {'additive': '+', 'multiplicative': '*'}
 
     if time_grouping == 'monthly':
-        group = 'time.month'
+        group = sdba.Grouper('time.month')
     elif time_grouping == '3monthly':
         group = sdba.Grouper('time.month', window=3)
     else:
-        group = 'time'
+        group = sdba.Grouper('time')
 
-    if ssr:
+    if ssr and (ds_ref_q is None):
         da_ref = utils.apply_ssr(ds_ref[ref_var])
-        da_hist = utils.apply_ssr(ds_hist[hist_var])
     else:
         da_ref = ds_ref[ref_var]
+    if ssr and (ds_hist_q is None):
+        da_hist = utils.apply_ssr(ds_hist[hist_var])
+    else:
         da_hist = ds_hist[hist_var]
 
-    qm = sdba.QuantileDeltaMapping.train(
-        da_ref,
-        da_hist,
-        nquantiles=nquantiles,
-        group=group,
-        kind=scaling_methods[scaling]
-    )
-    qm.ds = qm.ds.squeeze()
-    try:
-        qm.ds = qm.ds.drop_vars('group')
-    except ValueError:
-        pass
-    qm.ds['hist_q'].attrs['units'] = hist_units
-    if on_spatial_grid:
-        qm.ds = qm.ds.assign_coords(spatial_coords) #xclim strips lat/lon attributes
-        qm.ds = qm.ds.transpose('lat', 'lon', ...)
-    if 'month' in qm.ds.dims:
-        qm.ds = qm.ds.transpose('month', ...)
-    qm.ds = qm.ds.transpose('quantiles', ...)
-    
-    hist_times = ds_hist['time'].dt.strftime('%Y-%m-%d').values
-    qm.ds.attrs['historical_period_start'] = hist_times[0]
-    qm.ds.attrs['historical_period_end'] = hist_times[-1]
-    ref_times = ds_ref['time'].dt.strftime('%Y-%m-%d').values
-    qm.ds.attrs['reference_period_start'] = ref_times[0]
-    qm.ds.attrs['reference_period_end'] = ref_times[-1]
+    if quantile_method == 'exact':
+        nlevels = None
+    elif quantile_method == 'sketch':
+        nlevels = sketch_nlevels
+    else:
+        raise ValueError(f'Invalid quantile method: {quantile_method}')
+    with utils.profile_stage('kernel'):
+        if (ds_hist_q is None) and (ds_ref_q is None):
+            ds_out = qdm_train(
+                da_ref,
+                da_hist,
+                nquantiles=nquantiles,
+                group=group,
+                kind=scaling_methods[scaling],
+                sketch_nlevels=nlevels,
+            )
+        else:
+            if ds_hist_q is None:
+                hist_calendar = get_calendar(da_hist)
+                quantiles = ds_ref_q['quantiles'].values
+                da_hist = get_data_quantiles(da_hist, quantiles, sketch_nlevels=nlevels)
+            else:
+                hist_calendar = ds_hist_q.attrs.get('calendar', 'standard')
+                quantiles = ds_hist_q['quantiles'].values
+            if ds_ref_q is None:
+                da_ref = get_data_quantiles(da_ref, quantiles, sketch_nlevels=nlevels)
+            logging.info('Calculating adjustment factors from precomputed quantiles')
+            ds_out = qdm_train_quantiles(
+                da_ref, da_hist, group, scaling_methods[scaling], hist_calendar
+            )
+        ds_out['hist_q'].attrs['units'] = hist_units
+        if on_spatial_grid:
+            ds_out = ds_out.assign_coords(spatial_coords)
+            ds_out = ds_out.transpose('lat', 'lon', ...)
+        if 'month' in ds_out.dims:
+            ds_out = ds_out.transpose('month', ...)
+        ds_out = ds_out.transpose('quantiles', ...)
+        if af_surface:
+            nquantiles_surface, ndays_surface = af_surface_shape
+            logging.info(f'Calculating {af_surface} adjustment factor surface')
+            ds_out['af_surface'] = get_af_surface(
+                ds_out, af_surface, nquantiles=nquantiles_surface, ndays=ndays_surface
+            )
+
+    with utils.profile_stage('postprocess'):
+        for period, ds_period, ds_q in [('historical', ds_hist, ds_hist_q), ('reference', ds_ref, ds_ref_q)]:
+            if ds_q is None:
+                times = ds_period['time'].dt.strftime('%Y-%m-%d').values
+                ds_out.attrs[f'{period}_period_start'] = times[0]
+                ds_out.attrs[f'{period}_period_end'] = times[-1]
+            else:
+                ds_out.attrs[f'{period}_period_start'] = ds_q.attrs['quantile_period_start']
+                ds_out.attrs[f'{period}_period_end'] = ds_q.attrs['quantile_period_end']
 
-    qm.ds.attrs['xclim_version'] = xc.__version__
+        ds_out.attrs['xclim_version'] = xc.__version__
 
-    return qm.ds 
+    return ds_out
+
+
+def read_manifest(manifest_file):
+    """Read a batch training manifest.
+
+    The manifest is a YAML file listing the historical/reference
+    file pairs to train and the output file for each pair.
+    For example:
+
+    - hist_files: [/g/data/.../tasmax_day_ACCESS-CM2_historical_r1i1p1f1_gn_1995.nc]
+      ref_files: [/g/data/.../tasmax_AGCD-CSIRO_r005_19950101-19951231_daily.nc]
+      output_file: tasmax-qdc-adjustment-factors_ACCESS-CM2_ssp370_r1i1p1f1.nc
+    - hist_files: [/g/data/.../tasmax_day_EC-Earth3_historical_r1i1p1f1_gr_1995.nc]
+      ref_files: [/g/data/.../tasmax_AGCD-CSIRO_r005_19950101-19951231_daily.nc]
+      output_file: tasmax-qdc-adjustment-factors_EC-Earth3_ssp370_r1i1p1f1.nc
+
+    A hist_quantile_file or ref_quantile_file (see quantiles.py)
+    can be given in place of the hist_files or ref_files.
+
+    Returns
+    -------
+    list of dict
+    """
+
+    with open(manifest_file, 'r') as reader:
+        manifest = yaml.load(reader, Loader=yaml.BaseLoader)
+
+    valid_keys = ['hist_files', 'ref_files', 'output_file', 'hist_quantile_file', 'ref_quantile_file']
+    for entry in manifest:
+        for key in entry.keys():
+            if key not in valid_keys:
+                raise KeyError(f"Invalid manifest key: {key}")
+        for key in ['hist_files', 'ref_files', 'output_file']:
+            quantile_key = key.replace('files', 'quantile_file')
+            if (key not in entry) and (quantile_key not in entry):
+                raise KeyError(f"Missing manifest key: {key}")
+        for key in ['hist_files', 'ref_files']:
+            if isinstance(entry.get(key), str):
+                entry[key] = [entry[key]]
+
+    return manifest
+
+
+def get_encoding(ds_out, compress=False, output_format='netcdf'):
+    """Define the output file encoding for a dataset of adjustment factors."""
+
+    encoding = {}
+    outfile_vars = list(ds_out.coords) + list(ds_out.keys())
+    for outfile_var in outfile_vars:
+        encoding[outfile_var] = {'_FillValue': None}
+    for compress_var in ['af', 'hist_q', 'af_surface']:
+        if compress_var not in ds_out:
+            continue
+        if compress:
+            encoding[compress_var].update(utils.get_compression_encoding(
+                output_format=output_format,
+                least_significant_digit=2,
+                dtype=ds_out[compress_var].dtype,
+            ))
+        elif output_format == 'zarr':
+            encoding[compress_var]['compressor'] = None
+
+    return encoding
+
+
+def get_chunk_time_scale(time_bounds, other_time_bounds):
+    """Get the chunk plan time scale for data trained together with other data.
+
+    The training kernel holds a chunk of the hist and ref data in memory together,
+    so the chunks of each are sized on their combined length
+    (estimated from the time bounds, assuming both have the same time step).
+
+    Parameters
+    ----------
+    time_bounds : list
+        Time period of the data being read [YYYY-MM-DD, YYYY-MM-DD]
+    other_time_bounds : list
+        Time period of the data it will be trained with
+
+    Returns
+    -------
+    float
+        Ratio of the combined length to the length of the data being read
+        (see utils.get_chunk_plan)
+    """
+
+    ndays, other_ndays = [
+        (pd.Timestamp(end) - pd.Timestamp(start)).days + 1 for start, end in [time_bounds, other_time_bounds]
+    ]
+
+    return (ndays + other_ndays) / ndays
+
+
+def get_af_store_config(args, run, hist_var, ref_var, var_options):
+    """Get everything that determines the adjustment factors for a variable.
+
+    The af store key (see utils.get_af_store_key) is a hash of this configuration.
+    Input files are identified by their absolute path, size and modification time
+    (so an input file that is regenerated in place invalidates the store).
+    Options that only affect how the calculation is run
+    (e.g. chunking, tiling and output format) are not included.
+
+    Parameters
+    ----------
+    args : argparse.Namespace
+        Command line arguments
+    run : dict
+        Input and output files (see read_manifest)
+    hist_var : str
+        Historical variable
+    ref_var : str
+        Reference variable
+    var_options : dict
+        Options for hist_var (see utils.get_variable_options)
+
+    Returns
+    -------
+    dict
+    """
+
+    config = {}
+    for file_type in ['hist_files', 'ref_files']:
+        config[file_type] = [
+            [os.path.abspath(infile), os.path.getsize(infile), os.path.getmtime(infile)]
+            for infile in run.get(file_type) or []
+        ]
+    for file_type, var in [('hist_quantile_file', hist_var), ('ref_quantile_file', ref_var)]:
+        if run.get(file_type):
+            infile = run[file_type].replace('{var}', var)
+            config[file_type] = [os.path.abspath(infile), os.path.getsize(infile), os.path.getmtime(infile)]
+    config['hist_var'] = hist_var
+    config['ref_var'] = ref_var
+    config.update(var_options)
+    for option in [
+        'hist_time_bounds',
+        'ref_time_bounds',
+        'isel_hour',
+        'lat_bounds',
+        'lon_bounds',
+        'time_grouping',
+        'nquantiles',
+        'spatial_grid',
+        'af_surface',
+        'af_surface_shape',
+        'quantile_method',
+        'sketch_nlevels',
+        'compress',
+    ]:
+        value = getattr(args, option)
+        config[option] = list(value) if isinstance(value, tuple) else value
+    if args.quantile_method == 'sketch':
+        config['time_chunk_size'] = args.time_chunk_size
+    if args.compute_dtype:
+        config['compute_dtype'] = args.compute_dtype
+    config['xclim_version'] = xc.__version__
+
+    return config
 
 
 def main(args):
     """Run the program."""
     
     dask.diagnostics.ProgressBar().register()
-    ds_hist = utils.read_data(
-        args.hist_files,
-        args.hist_var,
-        time_bounds=args.hist_time_bounds,
-        isel_hour=args.isel_hour,
-        input_units=args.input_hist_units,
-        output_units=args.output_units,
-        valid_min=args.valid_min,
-        valid_max=args.valid_max,
-    )
-    calendar_hist = type(ds_hist['time'].values[0])
-    ds_ref = utils.read_data(
-        args.ref_files,
-        args.ref_var,
-        time_bounds=args.ref_time_bounds,
-        isel_hour=args.isel_hour,
-        lat_bounds=args.lat_bounds,
-        lon_bounds=args.lon_bounds,
-        input_units=args.input_ref_units,
-        output_units=args.output_units,
-        output_calendar=calendar_hist,
-        valid_min=args.valid_min,
-        valid_max=args.valid_max,
-    )
-    ds_out = train(
-        ds_hist,
-        ds_ref,
-        args.hist_var,
-        args.ref_var,
-        args.scaling,
-        time_grouping=args.time_grouping,
-        nquantiles=args.nquantiles,
-        spatial_grid=args.spatial_grid,
-        ssr=args.ssr,
-    )
-
-    if args.short_history:
-        unique_dirnames = utils.get_unique_dirnames(args.hist_files + args.ref_files)
+    if args.profile:
+        utils.start_profile('train.py')
+    time_chunk_size = args.time_chunk_size if args.quantile_method == 'sketch' else None
+    if args.quantile_method == 'sketch':
+        chunk_operation = 'train_sketch'
+    elif args.time_grouping == '3monthly':
+        chunk_operation = 'train_window'
+    else:
+        chunk_operation = 'train'
+    quantile_files = args.hist_quantile_file or args.ref_quantile_file
+    if args.manifest and quantile_files:
+        raise ValueError('Invalid arguments: give quantile files for --manifest runs in the manifest')
+    if args.manifest:
+        runs = read_manifest(args.manifest)
+    elif (
+        args.output_file
+        and (args.hist_files or args.hist_quantile_file)
+        and (args.ref_files or args.ref_quantile_file)
+    ):
+        runs = [{
+            'hist_files': args.hist_files,
+            'ref_files': args.ref_files,
+            'output_file': args.output_file,
+            'hist_quantile_file': args.hist_quantile_file,
+            'ref_quantile_file': args.ref_quantile_file,
+        }]
     else:
-        unique_dirnames = []
-    ds_out.attrs['history'] = utils.get_new_log(wildcard_prefixes=unique_dirnames)
+        raise ValueError(
+            'Invalid arguments: provide --manifest or output_file, --hist_files (or --hist_quantile_file) '
+            'and --ref_files (or --ref_quantile_file)'
+        )
+    for run in runs:
+        if not (run.get('hist_quantile_file') or args.hist_time_bounds):
+            raise ValueError('Invalid arguments: --hist_time_bounds is required for hist_files')
+        if not (run.get('ref_quantile_file') or args.ref_time_bounds):
+            raise ValueError('Invalid arguments: --ref_time_bounds is required for ref_files')
+    if args.tile_size and args.sparse:
+        raise ValueError('Invalid arguments: --sparse cannot be used with --tile_size')
+    if args.tile_size and any(run.get('hist_quantile_file') or run.get('ref_quantile_file') for run in runs):
+        raise ValueError('Invalid arguments: --tile_size cannot be used with quantile files')
+    hist_vars = args.hist_var.split(',')
+    ref_vars = args.ref_var.split(',')
+    if len(hist_vars) != len(ref_vars):
+        raise ValueError('Invalid arguments: hist_var and ref_var must list the same number of variables')
+    ref_var_names = dict(zip(hist_vars, ref_vars))
+    var_options = utils.get_variable_options(
+        hist_vars,
+        {
+            'scaling': args.scaling,
+            'ssr': args.ssr,
+            'input_hist_units': args.input_hist_units,
+            'input_ref_units': args.input_ref_units,
+            'output_units': args.output_units,
+            'valid_min': args.valid_min,
+            'valid_max': args.valid_max,
+        },
+        options_file=args.variable_options,
+    )
+    hist_read_options = {}
+    ref_read_options = {}
+    for option in ['output_units', 'valid_min', 'valid_max']:
+        hist_read_options[option] = {var: var_options[var][option] for var in hist_vars}
+        ref_read_options[option] = {ref_var_names[var]: var_options[var][option] for var in hist_vars}
+    hist_read_options['input_units'] = {var: var_options[var]['input_hist_units'] for var in hist_vars}
+    ref_read_options['input_units'] = {
+        ref_var_names[var]: var_options[var]['input_ref_units'] for var in hist_vars
+    }
+    read_kwargs = {
+        'isel_hour': args.isel_hour,
+        'time_chunk_size': time_chunk_size,
+        'memory_per_worker': args.memory_per_worker,
+        'chunk_operation': chunk_operation,
+        'nquantiles': args.nquantiles,
+        'sparse': args.sparse,
+        'sparse_mask_dir': args.sparse_mask_dir,
+        'compute_dtype': args.compute_dtype,
+    }
+    if args.hist_time_bounds and args.ref_time_bounds and (args.quantile_method != 'sketch'):
+        chunk_time_scales = {
+            'hist': get_chunk_time_scale(args.hist_time_bounds, args.ref_time_bounds),
+            'ref': get_chunk_time_scale(args.ref_time_bounds, args.hist_time_bounds),
+        }
+    else:
+        # (the sketch summaries of the hist and ref data are calculated separately)
+        chunk_time_scales = {'hist': 1, 'ref': 1}
+    train_kwargs = {
+        'time_grouping': args.time_grouping,
+        'nquantiles': args.nquantiles,
+        'spatial_grid': args.spatial_grid,
+        'af_surface': args.af_surface,
+        'af_surface_shape': args.af_surface_shape,
+        'quantile_method': args.quantile_method,
+        'sketch_nlevels': args.sketch_nlevels,
+    }
 
-    encoding = {}
-    outfile_vars = list(ds_out.coords) + list(ds_out.keys())
-    for outfile_var in outfile_vars:
-        encoding[outfile_var] = {'_FillValue': None}
-    if args.compress:
-        encoding['af']['least_significant_digit'] = 2
-        encoding['af']['zlib'] = True
-        encoding['hist_q']['least_significant_digit'] = 2
-        encoding['hist_q']['zlib'] = True
-    ds_out.to_netcdf(args.output_file, encoding=encoding)
+    # Input datasets shared by several runs (e.g. the same observations
+    # for many models) are read, converted and subset once, and the
+    # untiled runs are computed together so shared chunks are only read once.
+    # All variables are read together, so the time axis, calendar conversion,
+    # subsetting and regridding are only processed once for each dataset.
+    hist_datasets = {}
+    ref_datasets = {}
+    writes = []
+    stored_files = []
+    for run_num, run in enumerate(runs):
+        logging.info(f'Run {run_num + 1}/{len(runs)}: {run["output_file"]}')
+        output_files = {
+            var: utils.get_variable_outfile(run['output_file'], var, hist_vars) for var in hist_vars
+        }
+        run_vars = hist_vars
+        if args.af_store:
+            af_store_keys = {}
+            run_vars = []
+            for hist_var in hist_vars:
+                af_store_config = get_af_store_config(
+                    args, run, hist_var, ref_var_names[hist_var], var_options[hist_var]
+                )
+                af_store_keys[hist_var] = utils.get_af_store_key(af_store_config)
+                logging.info(f'Adjustment factor store key for {hist_var}: {af_store_keys[hist_var]}')
+                if not utils.fetch_from_af_store(
+                    args.af_store,
+                    af_store_keys[hist_var],
+                    output_files[hist_var],
+                    output_format=args.output_format,
+                ):
+                    run_vars.append(hist_var)
+            if not run_vars:
+                continue
+        if run.get('hist_quantile_file'):
+            ds_hist = None
+            calendar_hist = None
+        else:
+            hist_chunk_time_scale = chunk_time_scales['hist'] if run.get('ref_files') else 1
+            hist_key = (tuple(run['hist_files']), hist_chunk_time_scale)
+            if hist_key not in hist_datasets:
+                hist_datasets[hist_key] = utils.read_data(
+                    run['hist_files'],
+                    hist_vars,
+                    time_bounds=args.hist_time_bounds,
+                    chunk_time_scale=hist_chunk_time_scale,
+                    **hist_read_options,
+                    **read_kwargs,
+                )
+            ds_hist = hist_datasets[hist_key]
+            calendar_hist = type(ds_hist['time'].values[0])
+        if run.get('ref_quantile_file'):
+            ds_ref = None
+        else:
+            ref_chunk_time_scale = chunk_time_scales['ref'] if run.get('hist_files') else 1
+            ref_key = (tuple(run['ref_files']), calendar_hist, ref_chunk_time_scale)
+            if ref_key not in ref_datasets:
+                ref_datasets[ref_key] = utils.read_data(
+                    run['ref_files'],
+                    ref_vars,
+                    time_bounds=args.ref_time_bounds,
+                    lat_bounds=args.lat_bounds,
+                    lon_bounds=args.lon_bounds,
+                    output_calendar=calendar_hist,
+                    chunk_time_scale=ref_chunk_time_scale,
+                    **ref_read_options,
+                    **read_kwargs,
+                )
+            ds_ref = ref_datasets[ref_key]
+        on_spatial_grid = (ds_hist is not None) and ('lat' in ds_hist.dims) and ('lon' in ds_hist.dims)
+        if on_spatial_grid and (ds_ref is not None):
+            ds_hist, ds_ref, spatial_coords = match_grids(
+                ds_hist, ds_ref, hist_vars, ref_vars, spatial_grid=args.spatial_grid
+            )
+
+        for hist_var in run_vars:
+            ref_var = ref_var_names[hist_var]
+            quantile_datasets = {}
+            for name, var in [('hist', hist_var), ('ref', ref_var)]:
+                quantile_file = run.get(f'{name}_quantile_file')
+                if quantile_file:
+                    ds_q = xr.open_dataset(utils.get_variable_outfile(quantile_file, var, hist_vars))
+                    if args.compute_dtype:
+                        ds_q = utils.cast_float_vars(ds_q, args.compute_dtype)
+                    check_quantiles(
+                        ds_q,
+                        var,
+                        args.nquantiles,
+                        time_grouping=args.time_grouping,
+                        ssr=var_options[hist_var]['ssr'],
+                        units=var_options[hist_var]['output_units'],
+                    )
+                    quantile_datasets[f'ds_{name}_q'] = ds_q
+            if args.tile_size:
+                tile_results = utils.process_tiles(
+                    train,
+                    {'ds_hist': ds_hist, 'ds_ref': ds_ref},
+                    args.tile_size,
+                    nworkers=args.tile_workers,
+                    hist_var=hist_var,
+                    ref_var=ref_var,
+                    scaling=var_options[hist_var]['scaling'],
+                    ssr=var_options[hist_var]['ssr'],
+                    **train_kwargs,
+                )
+                tile, ds_tile = next(tile_results)
+                ds_out = utils.get_tile_template(ds_tile, spatial_coords, args.tile_size)
+            else:
+                ds_out = train(
+                    ds_hist,
+                    ds_ref,
+                    hist_var,
+                    ref_var,
+                    var_options[hist_var]['scaling'],
+                    ssr=var_options[hist_var]['ssr'],
+                    **quantile_datasets,
+                    **train_kwargs,
+                )
+
+            with utils.profile_stage('postprocess'):
+                if args.short_history:
+                    unique_dirnames = utils.get_unique_dirnames(
+                        (run.get('hist_files') or []) + (run.get('ref_files') or [])
+                    )
+                else:
+                    unique_dirnames = []
+                ds_out.attrs['history'] = utils.get_new_log(wildcard_prefixes=unique_dirnames)
+                output_file = output_files[hist_var]
+                if args.af_store:
+                    ds_out.attrs['af_store_key'] = af_store_keys[hist_var]
+                    stored_files.append((af_store_keys[hist_var], output_file))
+
+            encoding = get_encoding(ds_out, compress=args.compress, output_format=args.output_format)
+            if args.tile_size:
+                with utils.profile_stage('write'):
+                    utils.create_tiled_outfile(ds_out, output_file, encoding, output_format=args.output_format)
+                    utils.write_tile(output_file, ds_tile, tile, output_format=args.output_format)
+                    for tile, ds_tile in tile_results:
+                        utils.write_tile(output_file, ds_tile, tile, output_format=args.output_format)
+            else:
+                writes.append((ds_out, output_file, encoding))
+    utils.write_outfiles(writes, output_format=args.output_format)
+    for af_store_key, output_file in stored_files:
+        utils.add_to_af_store(
+            args.af_store,
+            af_store_key,
+            output_file,
+            max_size=args.af_store_size,
+            input_format=args.output_format,
+        )
+    if args.profile:
+        first_output_file = utils.get_variable_outfile(runs[0]['output_file'], hist_vars[0], hist_vars)
+        utils.write_profile_report(first_output_file)
 
 
 if __name__ == '__main__':
@@ -181,22 +1046,60 @@ if __name__ == '__main__':
         argument_default=argparse.SUPPRESS,
         formatter_class=argparse.RawDescriptionHelpFormatter
     )          
-    parser.add_argument("hist_var", type=str, help="historical variable to process")
-    parser.add_argument("ref_var", type=str, help="reference variable to process")
-    parser.add_argument("output_file", type=str, help="output file")
+    parser.add_argument(
+        "hist_var",
+        type=str,
+        help="historical variable to process (or a comma separated list of variables)",
+    )
+    parser.add_argument(
+        "ref_var",
+        type=str,
+        help="reference variable to process (or a comma separated list, in the same order as hist_var)",
+    )
+    parser.add_argument(
+        "output_file",
+        type=str,
+        nargs='?',
+        default=None,
+        help="output file (not used with --manifest; must include {var} if there are multiple variables)",
+    )
     parser.add_argument(
         "--hist_files",
         type=str,
         nargs='*',
-        required=True,
-        help="historical data files"
+        default=None,
+        help="historical data files (required unless --manifest or --hist_quantile_file is used)"
     )
     parser.add_argument(
         "--ref_files",
         type=str,
         nargs='*',
-        required=True,
-        help="reference data files"
+        default=None,
+        help="reference data files (required unless --manifest or --ref_quantile_file is used)"
+    )
+    parser.add_argument(
+        "--hist_quantile_file",
+        type=str,
+        default=None,
+        help="Historical quantiles calculated with quantiles.py (used instead of --hist_files; {var} is replaced by the hist_var)",
+    )
+    parser.add_argument(
+        "--ref_quantile_file",
+        type=str,
+        default=None,
+        help="Reference quantiles calculated with quantiles.py (used instead of --ref_files; {var} is replaced by the ref_var)",
+    )
+    parser.add_argument(
+        "--variable_options",
+        type=str,
+        default=None,
+        help="YAML file of per-variable scaling, ssr, units and valid min/max options (see utils.get_variable_options)",
+    )
+    parser.add_argument(
+        "--manifest",
+        type=str,
+        default=None,
+        help="YAML file listing hist_files, ref_files and output_file for each model to train (see read_manifest)",
     )
     parser.add_argument(
         "--isel_hour",
@@ -209,16 +1112,16 @@ if __name__ == '__main__':
         type=str,
         nargs=2,
         metavar=('START_DATE', 'END_DATE'),
-        required=True,
-        help="historical time bounds in YYYY-MM-DD format"
+        default=None,
+        help="historical time bounds in YYYY-MM-DD format (required unless --hist_quantile_file is used)"
     )
     parser.add_argument(
         "--ref_time_bounds",
         type=str,
         nargs=2,
         metavar=('START_DATE', 'END_DATE'),
-        required=True,
-        help="reference time bounds in YYYY-MM-DD format"
+        default=None,
+        help="reference time bounds in YYYY-MM-DD format (required unless --ref_quantile_file is used)"
     )
     parser.add_argument(
         "--lat_bounds",
@@ -297,6 +1200,100 @@ if __name__ == '__main__':
         default=False,
         help='Apply Singularity Stochastic Removal to input data',
     )
+    parser.add_argument(
+        "--quantile_method",
+        type=str,
+        choices=('exact', 'sketch'),
+        default='exact',
+        help=(
+            "Calculate exact quantiles or approximate quantiles from streamed quantile summaries "
+            "(slower; for time series that don't fit in memory)"
+        ),
+    )
+    parser.add_argument(
+        "--sketch_nlevels",
+        type=int,
+        default=201,
+        help="Number of probability levels in the quantile summaries (for --quantile_method sketch)",
+    )
+    parser.add_argument(
+        "--time_chunk_size",
+        type=int,
+        default=1825,
+        help="Number of time steps in each time chunk (for --quantile_method sketch)",
+    )
+    parser.add_argument(
+        "--memory_per_worker",
+        type=str,
+        default=None,
+        help="Memory available to process each data chunk (e.g. 4GB), used to choose lat/lon chunk sizes",
+    )
+    parser.add_argument(
+        "--af_surface",
+        type=str,
+        choices=('linear', 'cubic'),
+        default=None,
+        help="Precompute a smoothed adjustment factor surface for this adjust.py interpolation method",
+    )
+    parser.add_argument(
+        "--af_surface_shape",
+        type=int,
+        nargs=2,
+        metavar=('NQUANTILES', 'NDAYS'),
+        default=(200, 73),
+        help="Number of quantiles and days of the year in the af_surface",
+    )
+    parser.add_argument(
+        "--sparse",
+        action="store_true",
+        default=False,
+        help="Only process the grid cells with valid (non-NaN) data (e.g. land points)",
+    )
+    parser.add_argument(
+        "--sparse_mask_dir",
+        type=str,
+        default=None,
+        help="Save the valid cell mask found by --sparse to this directory and reuse it in later runs on the same grid",
+    )
+    parser.add_argument(
+        "--compute_dtype",
+        type=str,
+        choices=('float32', 'float64'),
+        default=None,
+        help="Data type for the calculations (default is the input data type; float32 halves the memory per chunk)",
+    )
+    parser.add_argument(
+        "--tile_size",
+        type=int,
+        nargs=2,
+        metavar=('NLAT', 'NLON'),
+        default=None,
+        help="Process the lat/lon domain in tiles of this size (in a pool of worker processes)",
+    )
+    parser.add_argument(
+        "--tile_workers",
+        type=int,
+        default=1,
+        help="Number of worker processes (for --tile_size)",
+    )
+    parser.add_argument(
+        "--af_store",
+        type=str,
+        default=None,
+        help="Adjustment factor store directory (reuse stored adjustment factors with the same inputs and options)",
+    )
+    parser.add_argument(
+        "--af_store_size",
+        type=str,
+        default='20GB',
+        help="Maximum size of the adjustment factor store (least recently used files are deleted first)",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        default=False,
+        help="Write the time, memory and dask tasks used by each processing stage to <output file>.profile.json",
+    )
     parser.add_argument(
         "--verbose",
         action="store_true",
@@ -309,15 +1306,31 @@ if __name__ == '__main__':
         default=False,
         help="compress the output data file"
     )
+    parser.add_argument(
+        "--output_format",
+        type=str,
+        choices=('netcdf', 'zarr'),
+        default='netcdf',
+        help="Output file format",
+    )
     parser.add_argument(
         "--short_history",
         action='store_true',
         default=False,
         help="Use wildcards to shorten the file lists in output_file history attribute",
     )
+    utils.add_dask_arguments(parser)
     args = parser.parse_args()
     log_level = logging.INFO if args.verbose else logging.WARNING
     logging.basicConfig(level=log_level)
+    client = utils.start_dask(
+        args.scheduler,
+        n_workers=args.n_workers,
+        threads_per_worker=args.threads_per_worker,
+        memory_limit=args.memory_limit,
+        scheduler_address=args.scheduler_address,
+    )
     with dask.diagnostics.ResourceProfiler() as rprof:
         main(args)
     utils.profiling_stats(rprof)
+    utils.stop_dask(client)
@@ -2,21 +2,37 @@
 
 import sys
 import os
+import time
+import json
+import shutil
+import hashlib
 import logging
+import resource
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
 import cftime
+import dask
+import dask.array
+import dask.callbacks
+import dask.sizeof
+import dask.utils
 import git
+import netCDF4
 import numpy as np
+import pandas as pd
 import xarray as xr
 import xclim as xc
 from xclim import sdba
-from xclim.sdba import nbutils
+from xarray.backends.netCDF4_ import NETCDF4_PYTHON_LOCK
 import xesmf as xe
+import yaml
 
 import cmdline_provenance as cmdprov
 
 
-def get_outfile_encoding(ds, var, time_units=None, compress=False):
+def get_outfile_encoding(ds, var, time_units=None, compress=False, output_format='netcdf'):
     """Define output file encoding."""
 
     encoding = {}
@@ -25,13 +41,145 @@ def get_outfile_encoding(ds, var, time_units=None, compress=False):
         encoding[ds_var] = {'_FillValue': None}
     encoding[var]['dtype'] = 'float32'
     if compress:
-        encoding[var]['zlib'] = True
+        encoding[var].update(get_compression_encoding(output_format=output_format))
+    elif output_format == 'zarr':
+        encoding[var]['compressor'] = None
     if time_units:
         encoding['time']['units'] = time_units.replace('_', ' ')
 
     return encoding
 
 
+def get_compression_encoding(output_format='netcdf', least_significant_digit=None, dtype='float32'):
+    """Define the encoding for a compressed output variable.
+
+    Parameters
+    ----------
+    output_format : {'netcdf', 'zarr'}, default 'netcdf'
+        Output file format
+    least_significant_digit : int, optional
+        Number of decimal places to keep (lossy compression)
+    dtype : str, default 'float32'
+        Data type of the variable (needed for lossy zarr compression)
+
+    Returns
+    -------
+    dict
+    """
+
+    if output_format == 'netcdf':
+        encoding = {'zlib': True}
+        if least_significant_digit is not None:
+            encoding['least_significant_digit'] = least_significant_digit
+    elif output_format == 'zarr':
+        # zarr arrays are compressed (with Blosc) by default
+        encoding = {}
+        if least_significant_digit is not None:
+            import numcodecs
+            encoding['filters'] = [numcodecs.Quantize(digits=least_significant_digit, dtype=dtype)]
+    else:
+        raise ValueError(f'Invalid output format: {output_format}')
+
+    return encoding
+
+
+def write_outfile(ds, outfile, encoding=None, output_format='netcdf', compute=True):
+    """Write a dataset to file.
+
+    Parameters
+    ----------
+    ds : xarray Dataset
+        Dataset to write
+    outfile : str
+        Output file name (or directory name for zarr)
+    encoding : dict, optional
+        Output file encoding (see get_outfile_encoding)
+    output_format : {'netcdf', 'zarr'}, default 'netcdf'
+        Output file format
+    compute : bool, default True
+        Write the data straight away
+        (if False a dask.delayed object is returned, so several files can be written in one compute)
+
+    Notes
+    -----
+    Zarr chunks are written in parallel (one dask task per chunk),
+    so the dask chunks are first made regular (zarr requires
+    equally sized chunks along each dimension, except for the last).
+
+    Packed data (see pack_cells) are scattered back onto the lat/lon grid.
+
+    The netCDF file locks can't be shared with the worker processes of the
+    processes scheduler, so in that case the data are computed by the workers
+    one band of latitudes at a time and written by the main process (see write_bands).
+    The write can't be deferred (compute=False) in that case,
+    so use write_outfiles to write several files in one compute.
+    """
+
+    if 'cell' in ds.dims:
+        ds = unpack_cells(ds)
+        if encoding:
+            encoding = {var: var_encoding for var, var_encoding in encoding.items() if var in ds.variables}
+    if writes_in_main_process(ds, output_format):
+        if not compute:
+            raise ValueError('Invalid arguments: netCDF writes with the processes scheduler must be computed straight away')
+        write_bands([(ds, outfile, encoding)], output_format=output_format)
+        return
+    profile_graph(ds)
+    with profile_stage('write'):
+        if output_format == 'netcdf':
+            delayed_write = ds.to_netcdf(outfile, encoding=encoding, compute=False)
+        elif output_format == 'zarr':
+            ds = ds.unify_chunks()
+            chunks = {dim: sizes[0] for dim, sizes in ds.chunks.items()}
+            if chunks:
+                ds = ds.chunk(chunks)
+            delayed_write = ds.to_zarr(outfile, encoding=encoding, mode='w', compute=False)
+        else:
+            raise ValueError(f'Invalid output format: {output_format}')
+        if compute:
+            compute_collections(delayed_write)
+
+    if not compute:
+        return delayed_write
+
+
+def write_outfiles(outputs, output_format='netcdf'):
+    """Write several datasets to file in one compute.
+
+    Parameters
+    ----------
+    outputs : list
+        Dataset, output file name and encoding (or None) of each output
+    output_format : {'netcdf', 'zarr'}, default 'netcdf'
+        Output file format
+
+    Notes
+    -----
+    Outputs that share part of their dask graph (e.g. the years from split_by_year)
+    only compute the shared tasks once.
+    With the processes scheduler netCDF outputs are computed one band of latitudes
+    at a time across all of the outputs (see write_bands).
+    """
+
+    if (output_format == 'netcdf') and (dask.config.get('scheduler', None) == 'processes'):
+        write_bands(outputs, output_format=output_format)
+        return
+    writes = []
+    for ds, outfile, encoding in outputs:
+        writes.append(write_outfile(ds, outfile, encoding, output_format=output_format, compute=False))
+    with profile_stage('write'):
+        compute_collections(*writes)
+
+
+def writes_in_main_process(ds, output_format):
+    """Check whether the dask data of a dataset have to be written by the main process.
+
+    The netCDF file locks can't be shared with the worker processes of the processes scheduler.
+    """
+
+    return bool(ds.chunks) and (output_format == 'netcdf') and (dask.config.get('scheduler', None) == 'processes')
+
+
 def get_unique_dirnames(file_list):
     """Get a list of unique dirnames from a file list"""
 
@@ -57,6 +205,127 @@ def get_new_log(infile_logs={}, wildcard_prefixes=[]):
     return new_log
 
 
+def add_dask_arguments(parser):
+    """Add the dask scheduler options to the argument parser of a command line program."""
+
+    parser.add_argument(
+        "--scheduler",
+        type=str,
+        choices=('threads', 'processes', 'distributed'),
+        default='threads',
+        help="Dask scheduler (distributed starts a local cluster unless --scheduler_address is given)",
+    )
+    parser.add_argument(
+        "--n_workers",
+        type=int,
+        default=None,
+        help="Number of dask worker threads or processes (default is one per CPU)",
+    )
+    parser.add_argument(
+        "--threads_per_worker",
+        type=int,
+        default=None,
+        help="Number of threads in each worker process (distributed scheduler only)",
+    )
+    parser.add_argument(
+        "--memory_limit",
+        type=str,
+        default=None,
+        help="Memory limit for each worker process (e.g. 8GB; distributed scheduler only)",
+    )
+    parser.add_argument(
+        "--scheduler_address",
+        type=str,
+        default=None,
+        help="Address of an existing dask scheduler to connect to (distributed scheduler only)",
+    )
+
+
+def start_dask(
+    scheduler='threads',
+    n_workers=None,
+    threads_per_worker=None,
+    memory_limit=None,
+    scheduler_address=None,
+):
+    """Set up the dask scheduler.
+
+    Parameters
+    ----------
+    scheduler : {'threads', 'processes', 'distributed'}, default 'threads'
+        Dask scheduler
+    n_workers : int, optional
+        Number of worker threads (threads) or processes (processes and distributed)
+    threads_per_worker : int, optional
+        Number of threads in each worker process (distributed only)
+    memory_limit : str, optional
+        Memory limit for each worker process (e.g. '8GB'; distributed only).
+        Defaults to the system memory divided by the number of workers.
+    scheduler_address : str, optional
+        Connect to an existing scheduler rather than starting a local cluster (distributed only)
+
+    Returns
+    -------
+    client : dask.distributed.Client or None
+        Client for the distributed scheduler (shut it down with stop_dask)
+
+    Notes
+    -----
+    The processes and distributed schedulers avoid the Python global interpreter lock,
+    which limits the threaded scheduler when tasks spend a lot of time in pure Python code.
+    Distributed workers spill data to disk (in the dask temporary-directory)
+    as they approach their memory limit and pause when it is nearly reached,
+    rather than running out of memory.
+    The dask diagnostics (progress bar, profiling and profile reports)
+    only see tasks run by the threads and processes schedulers.
+    """
+
+    if scheduler == 'threads':
+        dask.config.set(scheduler=scheduler, num_workers=n_workers)
+        return None
+    elif scheduler == 'processes':
+        # The netCDF file locks can only be shared with forked worker processes
+        context = 'fork' if sys.platform == 'linux' else 'spawn'
+        dask.config.set({'scheduler': scheduler, 'num_workers': n_workers, 'multiprocessing.context': context})
+        return None
+    elif scheduler != 'distributed':
+        raise ValueError(f'Invalid scheduler: {scheduler}')
+
+    from dask.distributed import Client, LocalCluster
+
+    if scheduler_address:
+        client = Client(scheduler_address)
+    else:
+        cluster = LocalCluster(
+            n_workers=n_workers,
+            threads_per_worker=threads_per_worker,
+            memory_limit=memory_limit if memory_limit else 'auto',
+        )
+        client = Client(cluster)
+    logging.info(f'Dask dashboard: {client.dashboard_link}')
+
+    return client
+
+
+def stop_dask(client):
+    """Shut down the dask client (and local cluster) from start_dask.
+
+    Parameters
+    ----------
+    client : dask.distributed.Client or None
+        Client returned by start_dask
+    """
+
+    if client is None:
+        return
+    cluster = client.cluster
+    client.close()
+    if cluster is not None:
+        # Only set if start_dask started a LocalCluster
+        # (a cluster at a scheduler address is left running)
+        cluster.close()
+
+
 def profiling_stats(rprof):
     """Record profiling information."""
 
@@ -67,63 +336,455 @@ def profiling_stats(rprof):
     logging.info(f'Peak CPU usage: {max_cpus}%')
 
 
-def convert_calendar(ds, output_calendar):
-    """Convert time calendar."""
+PROFILE = None
 
-    valid_calendars = {
-        cftime._cftime.DatetimeGregorian: cftime.DatetimeGregorian,
-        cftime._cftime.DatetimeProlepticGregorian: cftime.DatetimeProlepticGregorian,
-        cftime._cftime.DatetimeNoLeap: cftime._cftime.DatetimeNoLeap,
+PROFILE_STAGES = ['read', 'convert', 'regrid', 'ssr', 'kernel', 'postprocess', 'write']
+
+
+def start_profile(program):
+    """Start recording the time and memory used by each processing stage.
+
+    Parameters
+    ----------
+    program : str
+        Name of the command line program being profiled
+
+    Notes
+    -----
+    Stages are marked with profile_stage and dask collections are computed with compute_collections,
+    so that each dask task can be attributed to the stage that created it.
+    The report is written by write_profile_report.
+    """
+
+    import psutil
+
+    global PROFILE
+    callback = dask.callbacks.Callback(
+        start=profile_start, pretask=profile_pretask, posttask=profile_posttask
+    )
+    callback.register()
+    process = psutil.Process()
+    PROFILE = {
+        'program': program,
+        'callback': callback,
+        'process': process,
+        'stack': [],
+        'stages': {},
+        'graphs': [],
+        'layer_stages': {},
+        'aliases': {},
+        'task_starts': {},
+        'start_time': time.perf_counter(),
+        'start_cpu': time.process_time(),
+        'start_io': get_io_bytes(process),
+        'last_time': time.perf_counter(),
+        'last_cpu': time.process_time(),
     }
 
-    output_calendar_name = str(output_calendar).split('.')[-1][:-2]
-    if output_calendar in valid_calendars:
-        input_calendar_name = str(type(ds['time'].values[0])).split('.')[-1][:-2]
-        output_calendar_name = str(output_calendar).split('.')[-1][:-2]
-        logging.info(f'Convering input {input_calendar_name} calendar to {output_calendar_name}')
-
-        is_noleap = output_calendar == cftime._cftime.DatetimeNoLeap
-        if is_noleap:
-            ds = ds.sel(time=~((ds['time'].dt.month == 2) & (ds['time'].dt.day == 29)))
-
-        new_times = []
-        calendar_func = valid_calendars[output_calendar]
-        for old_time in ds['time'].values:
-            new_time = calendar_func(old_time.year, old_time.month, old_time.day, old_time.hour)
-            new_times.append(new_time)
-        time_attrs = ds['time'].attrs
-        ds = ds.assign_coords({'time': new_times})
-        ds['time'].attrs = time_attrs
-
-        if 'time_bnds' in ds:
-            new_time_bnds = []
-            for old_start, old_end in ds['time_bnds'].values:
-                if is_noleap and (old_start.day == 29) and (old_start.month == 2):
-                    old_start_day = 28
-                    old_start_month = 2
-                else:
-                    old_start_day = old_start.day
-                    old_start_month = old_start.month
-                if is_noleap and (old_end.day == 29) and (old_end.month == 2):
-                    old_end_day = 1
-                    old_end_month = 3
-                else:
-                    old_end_day = old_end.day
-                    old_end_month = old_end.month
-                new_start = calendar_func(old_start.year, old_start_month, old_start_day, old_start.hour)
-                new_end = calendar_func(old_end.year, old_end_month, old_end_day, old_end.hour)
-                time_diff = new_end - new_start
-                assert time_diff == np.timedelta64(1, 'D')
-                new_time_bnds.append([new_start, new_end])
-
-            da_time_bnds = xr.DataArray(
-                new_time_bnds,
-                dims=ds['time_bnds'].dims,
-                coords={"time": ds['time']},
-            )
-            ds['time_bnds'] = da_time_bnds
+
+def get_io_bytes(process):
+    """Get the number of bytes read and written by a process (None if not supported)."""
+
+    if not hasattr(process, 'io_counters'):
+        return None
+    counters = process.io_counters()
+    read_bytes = getattr(counters, 'read_chars', counters.read_bytes)
+    write_bytes = getattr(counters, 'write_chars', counters.write_bytes)
+
+    return read_bytes, write_bytes
+
+
+def get_stage_stats(stage):
+    """Get the profile statistics for a stage (creating them if necessary)."""
+
+    if stage not in PROFILE['stages']:
+        PROFILE['stages'][stage] = {
+            'wall_time': 0.0,
+            'cpu_time': 0.0,
+            'task_time': 0.0,
+            'ntasks': 0,
+            'nbytes': 0,
+            'peak_memory': 0,
+        }
+
+    return PROFILE['stages'][stage]
+
+
+def charge_profile_time():
+    """Add the time since the last stage change to the current stage."""
+
+    now = time.perf_counter()
+    cpu = time.process_time()
+    if PROFILE['stack']:
+        stats = get_stage_stats(PROFILE['stack'][-1])
+        stats['wall_time'] += now - PROFILE['last_time']
+        stats['cpu_time'] += cpu - PROFILE['last_cpu']
+        stats['peak_memory'] = max(stats['peak_memory'], PROFILE['process'].memory_info().rss)
+    PROFILE['last_time'] = now
+    PROFILE['last_cpu'] = cpu
+
+
+@contextlib.contextmanager
+def profile_stage(stage):
+    """Attribute the code run within this context to a processing stage.
+
+    Does nothing unless start_profile has been called.
+    Time is charged to the innermost stage (e.g. SSR applied within the train kernel),
+    and dask graph layers created within the context are annotated with the stage
+    so their tasks can be attributed to it when they are computed.
+
+    Parameters
+    ----------
+    stage : str
+        Stage name (see PROFILE_STAGES)
+    """
+
+    if PROFILE is None:
+        yield
+        return
+    charge_profile_time()
+    PROFILE['stack'].append(stage)
+    try:
+        with dask.annotate(qqscale_stage=stage):
+            yield
+    finally:
+        charge_profile_time()
+        PROFILE['stack'].pop()
+
+
+def profile_graph(obj):
+    """Record the stage that created each layer of a dask graph (if a profile is being recorded).
+
+    This needs to happen before the graph is optimized
+    (e.g. before writing to file, which fuses the tasks into the write tasks).
+    """
+
+    if (PROFILE is None) or (not dask.is_dask_collection(obj)):
+        return
+    graph = obj.__dask_graph__()
+    for name, layer in getattr(graph, 'layers', {}).items():
+        stage = (layer.annotations or {}).get('qqscale_stage')
+        if stage:
+            # Layers recorded before optimization keep their original stage
+            PROFILE['layer_stages'].setdefault(name, stage)
+            for key in layer.get_output_keys():
+                PROFILE['layer_stages'].setdefault(key[0] if isinstance(key, tuple) else key, stage)
+
+
+def profile_collections(collections):
+    """Record the size of each task graph and the stage that created each graph layer."""
+
+    for collection in collections:
+        if not dask.is_dask_collection(collection):
+            continue
+        profile_graph(collection)
+        ntasks, nbytes = get_graph_size(collection)
+        PROFILE['graphs'].append({'ntasks': ntasks, 'embedded_bytes': nbytes})
+
+
+def compute_collections(*collections):
+    """Compute dask collections.
+
+    If a profile is being recorded the size of each task graph
+    and the stage that created each graph layer are recorded first.
+    """
+
+    if PROFILE is not None:
+        profile_collections(collections)
+
+    return dask.compute(*collections)
+
+
+def persist_collections(*collections):
+    """Persist dask collections.
+
+    Unlike compute_collections the results stay chunked
+    (and on the workers, with the distributed scheduler)
+    rather than being gathered into a single array.
+    """
+
+    if PROFILE is not None:
+        profile_collections(collections)
+
+    return dask.persist(*collections)
+
+
+def profile_start(dsk):
+    """Record the keys renamed by graph optimization (dask callback)."""
+
+    for key, value in dsk.items():
+        if isinstance(value, (str, tuple)) and dask.core.ishashable(value) and value in dsk:
+            PROFILE['aliases'][value] = key
+
+
+def profile_pretask(key, dsk, state):
+    """Record the start time of a dask task (dask callback)."""
+
+    PROFILE['task_starts'][key] = time.perf_counter()
+
+
+def profile_posttask(key, result, dsk, state, worker_id):
+    """Attribute the time, output size and memory of a dask task to a stage (dask callback)."""
+
+    start = PROFILE['task_starts'].pop(key, None)
+    if start is None:
+        return
+    original_key = PROFILE['aliases'].get(key, key)
+    name = original_key[0] if isinstance(original_key, tuple) else original_key
+    stats = get_stage_stats(PROFILE['layer_stages'].get(name, 'other'))
+    stats['ntasks'] += 1
+    stats['task_time'] += time.perf_counter() - start
+    stats['nbytes'] += dask.sizeof.sizeof(result)
+    stats['peak_memory'] = max(stats['peak_memory'], PROFILE['process'].memory_info().rss)
+
+
+def stop_profile():
+    """Stop recording a profile and return the report.
+
+    Returns
+    -------
+    report : dict
+    """
+
+    global PROFILE
+    PROFILE['callback'].unregister()
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    report = {
+        'program': PROFILE['program'],
+        'wall_time': time.perf_counter() - PROFILE['start_time'],
+        'cpu_time': time.process_time() - PROFILE['start_cpu'],
+        # ru_maxrss is in kilobytes on Linux (bytes on macOS)
+        'peak_memory': maxrss if sys.platform == 'darwin' else maxrss * 1024,
+        'ntasks': sum(graph['ntasks'] for graph in PROFILE['graphs']),
+        'embedded_bytes': sum(graph['embedded_bytes'] for graph in PROFILE['graphs']),
+        'graphs': PROFILE['graphs'],
+        'stages': PROFILE['stages'],
+    }
+    end_io = get_io_bytes(PROFILE['process'])
+    if end_io:
+        report['read_bytes'] = end_io[0] - PROFILE['start_io'][0]
+        report['write_bytes'] = end_io[1] - PROFILE['start_io'][1]
+    PROFILE = None
+
+    return report
+
+
+def write_profile_report(outfile):
+    """Stop recording a profile and write the report next to an output file.
+
+    Parameters
+    ----------
+    outfile : str
+        Output data file (the report is written to outfile.profile.json)
+    """
+
+    report = stop_profile()
+    report_file = f'{outfile}.profile.json'
+    with open(report_file, 'w') as writer:
+        json.dump(report, writer, indent=2)
+    logging.info(f'Profile report: {report_file}')
+
+
+def get_calendar_name(calendar):
+    """Get the CF name of a calendar.
+
+    Parameters
+    ----------
+    calendar : str, cftime datetime class or numpy.datetime64
+        Calendar name, the type of the time values in a cftime calendar
+        or numpy.datetime64 (i.e. times decoded with use_cftime=False)
+
+    Returns
+    -------
+    str
+    """
+
+    if isinstance(calendar, str):
+        return calendar
+    elif calendar == np.datetime64:
+        return 'proleptic_gregorian'
+    else:
+        return calendar(2000, 1, 1).calendar
+
+
+def is_leap_year(year, calendar):
+    """Check if years (an integer array) are leap years in a calendar."""
+
+    gregorian_leap = ((year % 4) == 0) & (((year % 100) != 0) | ((year % 400) == 0))
+    julian_leap = (year % 4) == 0
+    if calendar in ['noleap', '365_day', '360_day']:
+        return np.zeros(np.shape(year), dtype=bool)
+    elif calendar in ['all_leap', '366_day']:
+        return np.ones(np.shape(year), dtype=bool)
+    elif calendar == 'proleptic_gregorian':
+        return gregorian_leap
+    elif calendar == 'julian':
+        return julian_leap
+    elif calendar in ['standard', 'gregorian']:
+        return np.where(year > 1582, gregorian_leap, julian_leap)
+    else:
+        raise ValueError(f'Invalid calendar: {calendar}')
+
+
+def days_in_month(year, month, calendar):
+    """Number of days in each month for integer arrays of years and months."""
+
+    if calendar == '360_day':
+        return np.full(np.shape(month), 30)
+    month_lengths = np.array([31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+    ndays = month_lengths[month - 1]
+    ndays = ndays + ((month == 2) & is_leap_year(year, calendar))
+
+    return ndays
+
+
+def date_to_days(year, month, day, calendar):
+    """Convert integer arrays of dates to days since 1970-01-01 in a calendar.
+
+    Fixed length calendars are simple multiples of the year and month lengths.
+    The others go through the julian day number of the (proleptic) gregorian
+    or julian calendar (the standard calendar switches at 1582-10-15).
+    """
+
+    if calendar == '360_day':
+        return (year - 1970) * 360 + (month - 1) * 30 + (day - 1)
+    elif calendar in ['noleap', '365_day', 'all_leap', '366_day']:
+        month_lengths = np.array([0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30])
+        year_length = 365
+        if calendar in ['all_leap', '366_day']:
+            month_lengths[2] = 29
+            year_length = 366
+        month_starts = np.cumsum(month_lengths)
+        return (year - 1970) * year_length + month_starts[month - 1] + (day - 1)
+
+    a = (14 - month) // 12
+    y = year + 4800 - a
+    m = month + 12 * a - 3
+    julian_day = day + (153 * m + 2) // 5 + 365 * y + y // 4
+    gregorian_jdn = julian_day - y // 100 + y // 400 - 32045
+    julian_jdn = julian_day - 32083
+    if calendar == 'proleptic_gregorian':
+        jdn = gregorian_jdn
+    elif calendar == 'julian':
+        return julian_jdn - 2440601
+    elif calendar in ['standard', 'gregorian']:
+        is_gregorian = (year * 10000 + month * 100 + day) >= 15821015
+        jdn = np.where(is_gregorian, gregorian_jdn, julian_jdn)
+    else:
+        raise ValueError(f'Invalid calendar: {calendar}')
+
+    return jdn - 2440588
+
+
+def get_date_fields(times):
+    """Get the date fields of times as integer arrays.
+
+    Parameters
+    ----------
+    times : pandas DatetimeIndex or xarray CFTimeIndex
+
+    Returns
+    -------
+    year, month, day, seconds : numpy arrays
+        Year, month, day and seconds since the start of the day
+    """
+
+    year = np.asarray(times.year, dtype=np.int64)
+    month = np.asarray(times.month, dtype=np.int64)
+    day = np.asarray(times.day, dtype=np.int64)
+    seconds = (
+        np.asarray(times.hour, dtype=np.int64) * 3600
+        + np.asarray(times.minute, dtype=np.int64) * 60
+        + np.asarray(times.second, dtype=np.int64)
+    )
+
+    return year, month, day, seconds
+
+
+def seconds_to_times(seconds, calendar):
+    """Convert integer seconds since 1970-01-01 to time values in a calendar.
+
+    Parameters
+    ----------
+    seconds : numpy array
+    calendar : str or numpy.datetime64
+        CF calendar name or numpy.datetime64 (for numpy datetime64 values)
+
+    Returns
+    -------
+    numpy array
+    """
+
+    if calendar == np.datetime64:
+        times = np.datetime64('1970-01-01', 's') + seconds.astype('timedelta64[s]')
+        return times.astype('datetime64[ns]')
+    times = cftime.num2date(
+        seconds,
+        'seconds since 1970-01-01',
+        calendar=get_calendar_name(calendar),
+        only_use_cftime_datetimes=True,
+    )
+
+    return times
+
+
+def convert_calendar(ds, output_calendar):
+    """Convert time calendar.
+
+    Dates that do not exist in the output calendar (e.g. 29 February
+    in a noleap calendar or 31 January in a 360_day calendar) are dropped,
+    and the other dates keep their year, month, day and time of day.
+    The conversion is done on integer seconds since 1970-01-01
+    for the whole time axis at once (see date_to_days).
+
+    Parameters
+    ----------
+    ds : xarray Dataset
+        Input dataset (with cftime or numpy datetime64 times)
+    output_calendar : str, cftime datetime class or numpy.datetime64
+        Output calendar (see get_calendar_name)
+
+    Returns
+    -------
+    xarray Dataset
+    """
+
+    times = ds.indexes['time']
+    if isinstance(times, xr.CFTimeIndex):
+        input_calendar_name = times.calendar
     else:
-        raise ValueError(f'Conversion to {output_calendar_name} not supported')
+        input_calendar_name = 'proleptic_gregorian'
+    output_calendar_name = get_calendar_name(output_calendar)
+    logging.info(f'Convering input {input_calendar_name} calendar to {output_calendar_name}')
+
+    year, month, day, seconds = get_date_fields(times)
+    valid_dates = day <= days_in_month(year, month, output_calendar_name)
+    if not valid_dates.all():
+        ds = ds.isel(time=valid_dates)
+        year, month, day, seconds = [field[valid_dates] for field in [year, month, day, seconds]]
+    new_seconds = date_to_days(year, month, day, output_calendar_name) * 86400 + seconds
+    time_attrs = ds['time'].attrs
+    ds = ds.assign_coords({'time': seconds_to_times(new_seconds, output_calendar)})
+    ds['time'].attrs = time_attrs
+
+    if 'time_bnds' in ds:
+        # Keep the offset of each bound from its time value
+        # (e.g. the upper bound of 28 February is 1 March in a noleap calendar)
+        bnds = ds['time_bnds'].values
+        if isinstance(bnds.flat[0], np.datetime64):
+            bnds_index = pd.DatetimeIndex(bnds.ravel())
+        else:
+            bnds_index = xr.CFTimeIndex(bnds.ravel())
+        bnds_year, bnds_month, bnds_day, bnds_seconds = get_date_fields(bnds_index)
+        old_bnds_seconds = date_to_days(bnds_year, bnds_month, bnds_day, input_calendar_name) * 86400 + bnds_seconds
+        old_bnds_seconds = old_bnds_seconds.reshape(bnds.shape)
+        old_seconds = date_to_days(year, month, day, input_calendar_name) * 86400 + seconds
+        new_bnds_seconds = new_seconds[:, np.newaxis] + (old_bnds_seconds - old_seconds[:, np.newaxis])
+        ds['time_bnds'] = xr.DataArray(
+            seconds_to_times(new_bnds_seconds.ravel(), output_calendar).reshape(bnds.shape),
+            dims=ds['time_bnds'].dims,
+            coords={'time': ds['time']},
+        )
 
     return ds
 
@@ -137,7 +798,7 @@ def joules_to_watts(da):
 
     if (input_units[0] == 'M') or (input_units[0:4] == 'mega'):
         da = da * 1e6
-    seconds_in_day = 60 * 60 * 24
+    seconds_in_day = 60.0 * 60 * 24
     da = da / seconds_in_day
 
     return da
@@ -207,12 +868,19 @@ def read_data(
     isel_hour=None,
     input_units=None,
     output_units=None,
-    lon_chunk_size=None,
+    time_chunk_size=None,
+    memory_per_worker=None,
+    chunk_operation=None,
+    chunk_time_scale=1,
+    nquantiles=100,
     apply_ssr=False,
     use_cftime=True,
     output_calendar=None,
     valid_min=None,
     valid_max=None,
+    sparse=False,
+    sparse_mask_dir=None,
+    compute_dtype=None,
 ):
     """Read and process an input dataset.
 
@@ -220,10 +888,12 @@ def read_data(
     ----------
     infiles : list
         Input files    
-    input_var : str, optional
-        Variable to read from infiles
+    input_var : str or list
+        Variable/s to read from infiles
+        (reading several variables at once means the time axis, calendar conversion
+        and spatial subsetting are only processed once)
     rename_var : str, optional
-        Rename var to value of rename_var
+        Rename var to value of rename_var (single input_var only)
     time_bounds : list, optional
         Time period to extract from infiles [YYYY-MM-DD, YYYY-MM-DD]
     isel_hour : int, optional
@@ -232,132 +902,622 @@ def read_data(
         Latitude bounds: [south bound, north bound] 
     lon_bnds : list, optional
         Longitude bounds: [west bound, east bound]    
-    input_units : str, optional
+    input_units : str or dict, optional
         Units of input data (if not provided will attempt to read file metadata)
-    output_units : str, optional
+    output_units : str or dict, optional
         Desired units for output data (conversion will be applied if necessary)
-    lon_chunk_size : int, optional
-        Put this number of longitudes in each data chunk
+    time_chunk_size : int, optional
+        Put this number of time steps in each data chunk
+        (default is a single time chunk)
+    memory_per_worker : str, optional
+        Memory available to process each chunk (e.g. '4GB').
+        The lat and lon chunk sizes are chosen to fit (see get_chunk_plan).
+    chunk_operation : str, optional
+        Operation the data will be used for (see get_chunk_plan)
+    chunk_time_scale : float, default 1
+        Multiple of the number of time steps to size the chunks for (see get_chunk_plan)
+    nquantiles : int, default 100
+        Number of quantiles the operation will calculate
     apply_ssr : bool, default False
         Apply Singularity Stochastic Removal to the data
     use_cftime : bool, default True
         Use cftime for time axis
     output_calendar : cftime calendar, optional
         Desired calendar for output data
-    valid_min : float, optional
+    valid_min : float or dict, optional
         Clip data to valid minimum value
-    valid_max : float, optional
+    valid_max : float or dict, optional
         Clip data to valid maximum value
+    sparse : bool, default False
+        Pack the grid cells that have valid data into a single cell dimension
+        (see pack_cells; the data are scattered back onto the lat/lon grid by write_outfile)
+    sparse_mask_dir : str, optional
+        Directory for saving and reusing the valid cell masks used by sparse (see get_valid_cells)
+    compute_dtype : str, optional
+        Data type for processing the data (e.g. 'float32')
+        (default is the data type of the input files)
 
     Returns
     -------
     ds : xarray Dataset
 
+    Notes
+    -----
+    When input_var is a list, the input_units, output_units, valid_min
+    and valid_max can be given for each variable as a dictionary
+    with variable names as keys (see get_var_option).
     """
 
-    if len(infiles) == 1:
-        try:
-            ds = xr.open_dataset(infiles[0], use_cftime=use_cftime)
-        except ValueError:
-            ds = xr.open_dataset(infiles[0])
-        ds = drop_vars(ds)
-    else:
-        try:
-            ds = xr.open_mfdataset(infiles, use_cftime=use_cftime, preprocess=drop_vars)
-        except ValueError:
-            ds = xr.open_mfdataset(infiles, preprocess=drop_vars)
-    ds = ds.drop_duplicates(dim='time')
-
-    if rename_var:
-        ds = ds.rename({input_var: rename_var})
-        var = rename_var
-    else:
-        var = input_var
+    with profile_stage('read'):
+        if len(infiles) == 1:
+            try:
+                ds = xr.open_dataset(infiles[0], use_cftime=use_cftime)
+            except ValueError:
+                ds = xr.open_dataset(infiles[0])
+            ds = drop_vars(ds)
+        else:
+            try:
+                ds = xr.open_mfdataset(infiles, use_cftime=use_cftime, preprocess=drop_vars)
+            except ValueError:
+                ds = xr.open_mfdataset(infiles, preprocess=drop_vars)
+        ds = ds.drop_duplicates(dim='time')
+
+        if rename_var:
+            ds = ds.rename({input_var: rename_var})
+            variables = [rename_var]
+        elif isinstance(input_var, str):
+            variables = [input_var]
+        else:
+            variables = list(input_var)
         
-    if 'latitude' in ds.dims:
-        ds = ds.rename({'latitude': 'lat'})
-    if 'longitude' in ds.dims:
-        ds = ds.rename({'longitude': 'lon'})
+        if 'latitude' in ds.dims:
+            ds = ds.rename({'latitude': 'lat'})
+        if 'longitude' in ds.dims:
+            ds = ds.rename({'longitude': 'lon'})
+
+        if time_bounds:
+            start_date, end_date = time_bounds
+            ds = ds.sel({'time': slice(start_date, end_date)})
+
+        if type(isel_hour) == int:
+            ds = ds.isel(time=(ds.time.dt.hour == isel_hour))
+
+        if lat_bounds:
+            ds = subset_lat(ds, lat_bounds)
+        if lon_bounds:
+            ds = subset_lon(ds, lon_bounds)
+
+    with profile_stage('convert'):
+        if output_calendar:
+            input_calendar = type(ds['time'].values[0])
+            if input_calendar != output_calendar:
+                ds = convert_calendar(ds, output_calendar)  
+
+        for var in variables:
+            var_input_units = get_var_option(input_units, var)
+            var_output_units = get_var_option(output_units, var)
+            var_valid_min = get_var_option(valid_min, var)
+            var_valid_max = get_var_option(valid_max, var)
+            if compute_dtype:
+                ds[var] = ds[var].astype(compute_dtype, keep_attrs=True)
+            if var_input_units:
+                ds[var].attrs['units'] = var_input_units
+            if var_output_units:
+                ds[var] = convert_units(ds[var], var_output_units)
+                ds[var].attrs['units'] = var_output_units
+            if (var_valid_min is not None) or (var_valid_max is not None):
+                ds[var] = ds[var].clip(min=var_valid_min, max=var_valid_max, keep_attrs=True)
+            if compute_dtype and (ds[var].dtype != compute_dtype):
+                ds[var] = ds[var].astype(compute_dtype, keep_attrs=True)
+
+    with profile_stage('read'):
+        var = variables[0]
+        chunk_dict = {'time': time_chunk_size if time_chunk_size else -1}
+        if memory_per_worker:
+            chunk_dict.update(get_chunk_plan(
+                ds[var],
+                memory_per_worker,
+                chunk_operation,
+                nquantiles=nquantiles,
+                time_chunk_size=time_chunk_size,
+                time_scale=chunk_time_scale,
+            ))
+        ds = ds.chunk(chunk_dict)
+        if sparse and ('lat' in ds.dims) and ('lon' in ds.dims):
+            ds = pack_cells(ds, get_valid_cells(ds[var], mask_dir=sparse_mask_dir))
+            if memory_per_worker:
+                ds = ds.chunk(get_chunk_plan(
+                    ds[var],
+                    memory_per_worker,
+                    chunk_operation,
+                    nquantiles=nquantiles,
+                    time_chunk_size=time_chunk_size,
+                    time_scale=chunk_time_scale,
+                ))
+        logging.info(f'Array size: {ds[var].shape}')
+        logging.info(f'Chunk size: {ds[var].chunksizes}')
 
-    if time_bounds:
-        start_date, end_date = time_bounds
-        ds = ds.sel({'time': slice(start_date, end_date)})
-
-    if type(isel_hour) == int:
-        ds = ds.isel(time=(ds.time.dt.hour == isel_hour))
-
-    if lat_bounds:
-        ds = subset_lat(ds, lat_bounds)
-    if lon_bounds:
-        ds = subset_lon(ds, lon_bounds)
-
-    if output_calendar:
-        input_calendar = type(ds['time'].values[0])
-        if input_calendar != output_calendar:
-            ds = convert_calendar(ds, output_calendar)  
-
-    if input_units:
-        ds[var].attrs['units'] = input_units
-    if output_units:
-        ds[var] = convert_units(ds[var], output_units)
-        ds[var].attrs['units'] = output_units
-
-    if (valid_min is not None) or (valid_max is not None):
-        ds[var] = ds[var].clip(min=valid_min, max=valid_max, keep_attrs=True)
-
-    chunk_dict = {'time': -1}
-    if lon_chunk_size:
-        chunk_dict['lon'] = lon_chunk_size
-    ds = ds.chunk(chunk_dict)
-    logging.info(f'Array size: {ds[var].shape}')
-    logging.info(f'Chunk size: {ds[var].chunksizes}')
-    
     return ds
 
 
-def apply_ssr(da, threshold='8.64e-4 mm day-1'):
-    """Apply Singularity Stochastic Removal.
+def cast_float_vars(ds, dtype):
+    """Cast the floating point data variables of a dataset to dtype (e.g. 'float32')."""
+
+    for var in ds.data_vars:
+        if np.issubdtype(ds[var].dtype, np.floating):
+            ds[var] = ds[var].astype(dtype, keep_attrs=True)
+
+    return ds
+
+
+def get_var_option(option, var):
+    """Get the value of a read_data option for a particular variable.
+
+    Options given as a dictionary are looked up by variable name
+    (variables not in the dictionary get None),
+    otherwise the option applies to every variable.
+    """
+
+    if isinstance(option, dict):
+        return option.get(var)
+    else:
+        return option
+
+
+def get_variable_options(variables, defaults, options_file=None):
+    """Get the processing options for each variable in a multi-variable run.
 
-    Used to avoid divide by zero errors in the analysis of precipitation data.
-    All near-zero values (i.e. < threshold) are set to a small random non-zero value:
-    0 < value <= threshold
-    
     Parameters
     ----------
-    da : xarray DataArray
-        Input precipitation data
-    threhsold : str, default '8.64e-4 mm day-1'
-        Threshold for near-zero rainfall
+    variables : list
+        Variables to process
+    defaults : dict
+        Default value of each per-variable option (e.g. from the command line)
+    options_file : str, optional
+        YAML file with the option values that differ from the defaults for particular variables.
+        For example:
+
+        pr:
+          scaling: multiplicative
+          ssr: True
+          output_units: mm day-1
+          valid_min: 0
 
     Returns
     -------
-    da_ssr : xarray DataArray
-        Input data with ssr applied
+    dict
+        Options for each variable
+    """
 
-    Reference
-    ---------
-    Vrac, M., Noel, T., & Vautard, R. (2016). Bias correction of precipitation
-    through Singularity Stochastic Removal: Because occurrences matter.
-    Journal of Geophysical Research: Atmospheres, 121(10), 5237–5258.
-    https://doi.org/10.1002/2015JD024511
+    var_options = {var: dict(defaults) for var in variables}
+    if options_file:
+        with open(options_file, 'r') as reader:
+            options_dict = yaml.safe_load(reader)
+        for var, options in options_dict.items():
+            if var not in variables:
+                raise KeyError(f"Invalid variable in variable options file: {var}")
+            for key, value in options.items():
+                if key not in defaults:
+                    raise KeyError(f"Invalid variable option: {key}")
+                var_options[var][key] = value
+
+    return var_options
+
+
+def get_variable_outfile(outfile, var, variables):
+    """Get the output file name for a variable.
+
+    The {var} placeholder in outfile is replaced by the variable name
+    (and is required when there is more than one variable).
     """
 
-    da_ssr = sdba.processing.jitter_under_thresh(da, '8.64e-4 mm day-1')
+    if (len(variables) > 1) and ('{var}' not in outfile):
+        raise ValueError(f'Invalid output file for multiple variables (no {{var}} placeholder): {outfile}')
 
-    return da_ssr
+    return outfile.replace('{var}', var)
 
 
-def reverse_ssr(da_ssr, threshold=8.64e-4):
-    """Reverse Singularity Stochastic Removal.
+def split_by_year(ds, outfile):
+    """Split a dataset into a separate dataset (and output file) for each year.
 
-    SSR is used to avoid divide by zero errors in the analysis of precipitation data.
-    It involves setting near-zero values (i.e. < threshold) to a small non-zero random value: 0 < value <= threshold.
-    This function reverses SSR (commonly at the end of a calculation) by setting all near-zero values (i.e. < threshold) to zero.
-    
     Parameters
     ----------
-    da_ssr : xarray DataArray
-        Input precipitation data (that has had SSR applied)
+    ds : xarray Dataset
+        Dataset with a time dimension
+    outfile : str
+        Output file name with a {year} placeholder (e.g. tasmax_{year}.nc)
+
+    Returns
+    -------
+    dict
+        Dataset for each year keyed by output file name
+
+    Notes
+    -----
+    The datasets are lazy slices of ds, so writing them all in one dask compute
+    (e.g. with write_outfiles) computes each chunk of ds once
+    and writes each year as soon as the chunks it needs have been computed.
+    """
+
+    if '{year}' not in outfile:
+        raise ValueError(f'Invalid output file for splitting by year (no {{year}} placeholder): {outfile}')
+    split_datasets = {}
+    for year, ds_year in ds.groupby(ds['time'].dt.year):
+        split_datasets[outfile.replace('{year}', str(year))] = ds_year
+
+    return split_datasets
+
+
+def get_graph_size(obj):
+    """Get the number of tasks and the size of the data embedded in a dask graph.
+
+    Embedded data are numpy arrays stored in the graph itself
+    (e.g. an in-memory array used by every task),
+    which are copied to every worker that needs them.
+
+    Parameters
+    ----------
+    obj : dask collection (e.g. a dask backed xarray Dataset)
+
+    Returns
+    -------
+    ntasks : int
+    nbytes : int
+    """
+
+    graph = obj.__dask_graph__()
+    nbytes = sum(value.nbytes for value in graph.values() if isinstance(value, np.ndarray))
+
+    return len(graph), nbytes
+
+
+def get_chunk_plan(da, memory_per_worker, operation, nquantiles=100, time_chunk_size=None, time_scale=1):
+    """Choose lat and lon chunk sizes that fit within a memory budget.
+
+    Parameters
+    ----------
+    da : xarray DataArray
+        Input data
+    memory_per_worker : str or int
+        Memory available to process each chunk (e.g. '4GB' or a number of bytes)
+    operation : {'quantiles', 'train', 'train_window', 'train_sketch',
+                 'adjust', 'adjust_linear', 'adjust_stream'}
+        Operation the chunks will be used for
+    nquantiles : int, default 100
+        Number of quantiles the operation will calculate
+    time_chunk_size : int, optional
+        Number of time steps in each chunk (default is a single time chunk)
+    time_scale : float, default 1
+        Size the chunks for this multiple of the number of time steps
+        (e.g. training holds a chunk of the hist and ref data in memory together,
+        so each is sized on their combined length; see train.get_chunk_time_scale)
+
+    Returns
+    -------
+    dict
+        Chunk sizes for the lat and lon dimensions
+        (or the cell dimension of packed data; see pack_cells)
+
+    Notes
+    -----
+    The peak memory used to process a chunk is estimated as the size of the input chunk
+    multiplied by an operation dependent factor
+    (measured using tracemalloc for float32 and float64 data, rounded up),
+    plus the quantile arrays (e.g. af and hist_q) for each grid point.
+    Chunks span whole rows of longitude where possible.
+    """
+
+    memory_factors = {
+        'quantiles': 3,
+        'train': 3,
+        'train_window': 7,
+        'train_sketch': 17,
+        'adjust': 11,
+        'adjust_linear': 20,
+        'adjust_stream': 22,
+    }
+    if operation not in memory_factors:
+        raise ValueError(f'Invalid chunk operation: {operation}')
+    packed = 'cell' in da.dims
+    if not ((('lat' in da.dims) and ('lon' in da.dims)) or packed):
+        return {}
+
+    memory_per_worker = dask.utils.parse_bytes(memory_per_worker)
+    ntimes = min(time_chunk_size, da.sizes['time']) if time_chunk_size else da.sizes['time']
+    quantile_bytes = 4 * nquantiles * 12 * 8
+    bytes_per_point = memory_factors[operation] * ntimes * time_scale * da.dtype.itemsize + quantile_bytes
+    npoints = max(int(memory_per_worker // bytes_per_point), 1)
+    if packed:
+        cell_chunk_size = min(npoints, da.sizes['cell'])
+        nchunks = int(np.ceil(da.sizes['cell'] / cell_chunk_size))
+        logging.info(
+            f'Chunk plan for {operation} ({memory_per_worker / 1e9:.1f}GB per worker): '
+            f'{cell_chunk_size} cells x {ntimes} time steps per chunk, {nchunks} spatial chunks'
+        )
+        return {'cell': cell_chunk_size}
+    nlat = da.sizes['lat']
+    nlon = da.sizes['lon']
+    lon_chunk_size = min(npoints, nlon)
+    lat_chunk_size = min(max(npoints // nlon, 1), nlat)
+
+    nchunks = int(np.ceil(nlat / lat_chunk_size) * np.ceil(nlon / lon_chunk_size))
+    chunk_memory = lat_chunk_size * lon_chunk_size * bytes_per_point
+    logging.info(
+        f'Chunk plan for {operation} ({memory_per_worker / 1e9:.1f}GB per worker): '
+        f'{lat_chunk_size} lat x {lon_chunk_size} lon x {ntimes} time steps per chunk, '
+        f'{nchunks} spatial chunks, estimated peak memory {chunk_memory / 1e6:.0f}MB per chunk'
+    )
+    if npoints == 1 and bytes_per_point > memory_per_worker:
+        logging.warning(
+            f'A single grid point needs about {bytes_per_point / 1e6:.0f}MB for {operation} '
+            '(try a smaller time chunk size)'
+        )
+
+    return {'lat': lat_chunk_size, 'lon': lon_chunk_size}
+
+
+def get_valid_cells(da, mask_dir=None):
+    """Find the lat/lon grid cells with at least one valid (non-NaN) value.
+
+    Finding the cells means reading all of da,
+    so if mask_dir is given the mask is saved there
+    (keyed by a hash of the variable name and the lat/lon coordinates)
+    and later calls for the same variable and grid read the saved mask instead.
+
+    Parameters
+    ----------
+    da : xarray DataArray
+        Input data with time, lat and lon dimensions
+    mask_dir : str, optional
+        Directory for saved masks
+
+    Returns
+    -------
+    xarray DataArray
+        Boolean mask with dimensions (lat, lon)
+    """
+
+    if mask_dir:
+        sha = hashlib.sha256(str(da.name).encode())
+        for coord in ['lat', 'lon']:
+            values = np.ascontiguousarray(da[coord].values, dtype=np.float64)
+            sha.update(f'{coord}{values.shape}'.encode())
+            sha.update(values.tobytes())
+        mask_file = os.path.join(mask_dir, f'mask_{sha.hexdigest()}.nc')
+    if mask_dir and os.path.isfile(mask_file):
+        logging.info(f'Using saved valid cell mask: {mask_file}')
+        with xr.open_dataset(mask_file) as ds_mask:
+            mask = ds_mask['mask'].load().astype(bool)
+    else:
+        mask = da.notnull().any('time').transpose('lat', 'lon')
+        mask, = compute_collections(mask)
+        if mask_dir:
+            os.makedirs(mask_dir, exist_ok=True)
+            temp_file = f'{mask_file}.{os.getpid()}.tmp'
+            mask.astype('int8').to_dataset(name='mask').to_netcdf(temp_file)
+            os.replace(temp_file, mask_file)
+            logging.info(f'Saved valid cell mask: {mask_file}')
+    ncells = int(mask.sum())
+    logging.info(f'{ncells} of {mask.size} grid cells ({ncells / mask.size:.0%}) have valid data')
+
+    return mask
+
+
+def pack_cells(ds, mask):
+    """Pack the valid grid cells of a dataset into a single cell dimension.
+
+    The cell dimension has a lat/lon MultiIndex whose levels
+    keep the full lat and lon coordinates, so the data can be
+    scattered back onto the original grid (see unpack_cells).
+
+    Parameters
+    ----------
+    ds : xarray Dataset
+        Dataset with lat and lon dimensions
+    mask : xarray DataArray
+        Boolean mask of the cells to keep with dimensions (lat, lon) (see get_valid_cells)
+
+    Returns
+    -------
+    xarray Dataset
+    """
+
+    ds = ds.stack({'cell': ('lat', 'lon')})
+    ds = ds.isel({'cell': np.flatnonzero(mask.values.ravel())})
+
+    return ds
+
+
+def pack_like(ds, ds_packed):
+    """Pack the grid cells of a dataset to match a packed dataset (see pack_cells).
+
+    If ds_packed is chunked, ds is read in rows of latitude and
+    packed into the same cell chunks (rather than being loaded all at once).
+    """
+
+    cell_chunks = ds_packed.chunksizes.get('cell') if ds_packed.chunks else None
+    if cell_chunks:
+        ds = ds.chunk({'lat': max(cell_chunks[0] // ds.sizes['lon'], 1)})
+    ds = ds.stack({'cell': ('lat', 'lon')})
+    positions = ds.indexes['cell'].get_indexer(ds_packed.indexes['cell'])
+    if (positions < 0).any():
+        raise ValueError('Invalid grid: the packed cells are not all on the grid of the dataset')
+    ds = ds.isel({'cell': positions})
+    if cell_chunks:
+        ds = ds.chunk({'cell': cell_chunks})
+
+    return ds
+
+
+def get_cell_grid(ds):
+    """Get the full lat/lon grid of a packed dataset (see pack_cells)."""
+
+    lat, lon = ds.indexes['cell'].levels
+    grid = xr.Dataset(coords={
+        'lat': ('lat', np.asarray(lat), ds['lat'].attrs),
+        'lon': ('lon', np.asarray(lon), ds['lon'].attrs),
+    })
+
+    return grid
+
+
+def scatter_cells(data, positions, size):
+    """Scatter numpy data for some cells (the last axis) into an array of NaNs.
+
+    Parameters
+    ----------
+    data : numpy ndarray
+        Data with cells on the last axis
+    positions : numpy ndarray
+        Position of each cell along the last axis of the output
+    size : int
+        Length of the last axis of the output
+
+    Returns
+    -------
+    numpy ndarray
+    """
+
+    dtype = np.promote_types(data.dtype, np.float32)
+    result = np.full(data.shape[:-1] + (size,), np.nan, dtype=dtype)
+    result[..., positions] = data
+
+    return result
+
+
+def unpack_cells(ds):
+    """Scatter a packed dataset (see pack_cells) back onto its lat/lon grid.
+
+    Grid cells that were not packed are filled with NaN.
+    The lat and lon dimensions take the place of the cell dimension
+    in the dimension order of each variable.
+
+    Dask arrays are scattered in bands of whole latitude rows
+    (with about as many grid cells as a packed chunk), so the unpacked chunks
+    are no larger than the packed chunks plus the missing cells in the same rows.
+    """
+
+    grid = get_cell_grid(ds)
+    nlat = grid.sizes['lat']
+    nlon = grid.sizes['lon']
+    full_index = pd.MultiIndex.from_product([grid['lat'].values, grid['lon'].values])
+    positions = full_index.get_indexer(ds.indexes['cell'])
+    if np.any(np.diff(positions) < 0):
+        order = np.argsort(positions)
+        ds = ds.isel({'cell': order})
+        positions = positions[order]
+    cell_chunk_size = ds.chunksizes['cell'][0] if ds.chunks else positions.size
+    band_size = max(cell_chunk_size // nlon, 1)
+
+    packed_vars = [var for var in ds.data_vars if 'cell' in ds[var].dims]
+    ds_unpacked = ds.drop_dims('cell').assign_coords(
+        {'lat': grid['lat'], 'lon': grid['lon']}
+    )
+    for var in packed_vars:
+        dims = ds[var].dims
+        index = dims.index('cell')
+        da = ds[var].transpose(..., 'cell')
+        if not da.chunks:
+            data = scatter_cells(da.values, positions, nlat * nlon)
+        else:
+            bands = []
+            for lat_start in range(0, nlat, band_size):
+                lat_stop = min(lat_start + band_size, nlat)
+                start, stop = np.searchsorted(positions, [lat_start * nlon, lat_stop * nlon])
+                size = (lat_stop - lat_start) * nlon
+                band = da.data[..., start:stop].rechunk({da.ndim - 1: -1})
+                bands.append(band.map_blocks(
+                    scatter_cells,
+                    positions[start:stop] - lat_start * nlon,
+                    size,
+                    chunks=band.chunks[:-1] + ((size,),),
+                    dtype=np.promote_types(da.dtype, np.float32),
+                ))
+            data = dask.array.concatenate(bands, axis=-1)
+        data = data.reshape(data.shape[:-1] + (nlat, nlon))
+        da_unpacked = xr.DataArray(
+            data,
+            dims=da.dims[:-1] + ('lat', 'lon'),
+            coords={coord: da[coord] for coord in da.coords if 'cell' not in da[coord].dims},
+            attrs=da.attrs,
+        )
+        ds_unpacked[var] = da_unpacked.transpose(*dims[:index], 'lat', 'lon', *dims[index + 1:])
+
+    return ds_unpacked
+
+
+def match_cells(ds, ds_grid, variable=None):
+    """Put a dataset on the (packed or unpacked) spatial grid of another dataset.
+
+    Parameters
+    ----------
+    ds : xarray Dataset
+        Dataset with lat and lon dimensions or packed cells (see pack_cells)
+    ds_grid : xarray Dataset or DataArray
+        Dataset on the target grid (if packed, ds is packed to match)
+    variable : str or list, optional
+        Variable/s to regrid if the grids differ (see regrid)
+
+    Returns
+    -------
+    xarray Dataset
+    """
+
+    if 'cell' in ds.dims:
+        ds = unpack_cells(ds)
+    grid = get_cell_grid(ds_grid) if 'cell' in ds_grid.dims else ds_grid
+    if (len(ds['lat']) != len(grid['lat'])) or (len(ds['lon']) != len(grid['lon'])):
+        ds = regrid(ds, grid, variable=variable)
+    if 'cell' in ds_grid.dims:
+        ds = pack_like(ds, ds_grid)
+
+    return ds
+
+
+def apply_ssr(da, threshold='8.64e-4 mm day-1'):
+    """Apply Singularity Stochastic Removal.
+
+    Used to avoid divide by zero errors in the analysis of precipitation data.
+    All near-zero values (i.e. < threshold) are set to a small random non-zero value:
+    0 < value <= threshold
+    
+    Parameters
+    ----------
+    da : xarray DataArray
+        Input precipitation data
+    threhsold : str, default '8.64e-4 mm day-1'
+        Threshold for near-zero rainfall
+
+    Returns
+    -------
+    da_ssr : xarray DataArray
+        Input data with ssr applied
+
+    Reference
+    ---------
+    Vrac, M., Noel, T., & Vautard, R. (2016). Bias correction of precipitation
+    through Singularity Stochastic Removal: Because occurrences matter.
+    Journal of Geophysical Research: Atmospheres, 121(10), 5237–5258.
+    https://doi.org/10.1002/2015JD024511
+    """
+
+    with profile_stage('ssr'):
+        da_ssr = sdba.processing.jitter_under_thresh(da, '8.64e-4 mm day-1')
+
+    return da_ssr
+
+
+def reverse_ssr(da_ssr, threshold=8.64e-4):
+    """Reverse Singularity Stochastic Removal.
+
+    SSR is used to avoid divide by zero errors in the analysis of precipitation data.
+    It involves setting near-zero values (i.e. < threshold) to a small non-zero random value: 0 < value <= threshold.
+    This function reverses SSR (commonly at the end of a calculation) by setting all near-zero values (i.e. < threshold) to zero.
+    
+    Parameters
+    ----------
+    da_ssr : xarray DataArray
+        Input precipitation data (that has had SSR applied)
     threhsold : float, default 8.64e-4 mm
         Threshold for near-zero rainfall
 
@@ -374,38 +1534,688 @@ def reverse_ssr(da_ssr, threshold=8.64e-4):
     https://doi.org/10.1002/2015JD024511
     """
 
-    da_no_ssr = da_ssr.where(da_ssr >= threshold, 0.0)
+    with profile_stage('ssr'):
+        da_no_ssr = da_ssr.where(da_ssr >= threshold, 0.0)
 
     return da_no_ssr
 
 
+def get_group_index(times, timescale='monthly'):
+    """Get the group index of each time step.
+
+    Parameters
+    ----------
+    times : xarray DataArray
+        Time axis
+    timescale : {'monthly', 'annual'}, default 'monthly'
+        Time grouping
+
+    Returns
+    -------
+    group_index : numpy ndarray
+        Group index (0, 1, 2, ...) for each time step
+    group_coords : dict
+        Coordinates for the group dimension ({} if there is no grouping)
+    """
+
+    if timescale == 'monthly':
+        group_index = times.dt.month.values - 1
+        group_coords = {'month': np.arange(1, 13)}
+    elif timescale == 'annual':
+        group_index = np.zeros(times.size, dtype=int)
+        group_coords = {}
+    else:
+        raise ValueError(f'Invalid timescale: {timescale}')
+
+    return group_index, group_coords
+
+
+def sorted_quantiles(sorted_data, nvalid, quantiles):
+    """Calculate quantiles from data that has been sorted along the last axis.
+
+    Replicates the linear interpolation used by the numba implementation
+    of np.nanquantile (and hence xclim.sdba.nbutils.quantile),
+    so the results are identical to those calculated by xclim.
+
+    Parameters
+    ----------
+    sorted_data : numpy ndarray
+        Data sorted along the last axis (NaNs at the end)
+    nvalid : numpy ndarray
+        Number of non-NaN values along the last axis of sorted_data
+    quantiles : numpy ndarray
+        Quantiles to calculate
+
+    Returns
+    -------
+    numpy ndarray
+        Quantiles along the last axis
+    """
+
+    percentiles = np.asarray(quantiles, dtype=sorted_data.dtype).astype(np.float64) * 100.0
+    nvalid = nvalid[..., np.newaxis]
+    rank = 1 + (nvalid - 1) * (percentiles / 100.0)
+    lower_index = np.floor(rank)
+    weight = rank - lower_index
+    lower_index = np.clip(lower_index.astype(int) - 1, 0, None)
+    upper_index = np.minimum(lower_index + 1, np.clip(nvalid - 1, 0, None))
+    lower = np.take_along_axis(sorted_data, lower_index, axis=-1).astype(np.float64)
+    upper = np.take_along_axis(sorted_data, upper_index, axis=-1).astype(np.float64)
+    result = lower * (1 - weight) + upper * weight
+    result = np.where(nvalid == 1, lower, result)
+    result = np.where(nvalid == 0, np.nan, result)
+
+    return result.astype(sorted_data.dtype)
+
+
+def sort_by_group(data, group_index, ngroups):
+    """Sort data along the last axis within each group.
+
+    Parameters
+    ----------
+    data : numpy ndarray
+        Input data (time is the last axis)
+    group_index : numpy ndarray
+        Group index (0, 1, 2, ...) for each time step
+    ngroups : int
+        Number of groups
+
+    Returns
+    -------
+    sorted_data : numpy ndarray
+        Data reordered so each group is contiguous and sorted (NaNs at the end of each group)
+    bounds : numpy ndarray
+        Start and end index of each group along the last axis
+    nvalid : numpy ndarray
+        Number of non-NaN values in each group (group is the last axis)
+    """
+
+    order = np.argsort(group_index, kind='stable')
+    bounds = np.concatenate([[0], np.cumsum(np.bincount(group_index, minlength=ngroups))])
+    sorted_data = data[..., order]
+    nvalid = np.empty(data.shape[:-1] + (ngroups,), dtype=int)
+    for group in range(ngroups):
+        start, end = bounds[group], bounds[group + 1]
+        sorted_data[..., start:end] = np.sort(sorted_data[..., start:end], axis=-1)
+        nvalid[..., group] = np.count_nonzero(~np.isnan(sorted_data[..., start:end]), axis=-1)
+
+    return sorted_data, bounds, nvalid
+
+
+def rolling_window(data, group_index, window, positions=None):
+    """Stack a centred rolling window of time steps along the time axis.
+
+    Time steps beyond the ends of the time axis are filled with NaN.
+
+    If positions is given the window rolls along a longer time axis
+    (e.g. the union of the hist and ref time axes, as in xclim)
+    that the data only partly covers.
+    positions is then the index of each time step of data on that axis
+    and group_index is the group of each time step on that axis.
+    """
+
+    half_window = window // 2
+    if positions is None:
+        ntimes = data.shape[-1]
+        pad_width = [(0, 0)] * (data.ndim - 1) + [(half_window, window - half_window - 1)]
+        padded_data = np.pad(data, pad_width, constant_values=np.nan)
+        windowed_data = np.concatenate(
+            [padded_data[..., offset:offset + ntimes] for offset in range(window)],
+            axis=-1,
+        )
+        windowed_group_index = np.tile(group_index, window)
+        return windowed_data, windowed_group_index
+
+    windowed_data = []
+    windowed_group_index = []
+    for offset in range(window):
+        # Each time step is in the window of the time steps either side of it
+        # (including those the data don't cover)
+        centres = positions - offset + half_window
+        in_axis = (centres >= 0) & (centres < len(group_index))
+        windowed_data.append(np.where(in_axis, data, np.nan))
+        windowed_group_index.append(group_index[np.clip(centres, 0, len(group_index) - 1)])
+
+    return np.concatenate(windowed_data, axis=-1), np.concatenate(windowed_group_index)
+
+
+def grouped_quantiles(data, group_index, ngroups, quantiles, window=1, positions=None):
+    """Calculate quantiles for each group in a single pass over numpy data.
+
+    Parameters
+    ----------
+    data : numpy ndarray
+        Input data (time is the last axis)
+    group_index : numpy ndarray
+        Group index (0, 1, 2, ...) for each time step
+    ngroups : int
+        Number of groups
+    quantiles : numpy ndarray
+        Quantiles to calculate
+    window : int, default 1
+        Include a centred rolling window of time steps around each
+        time step in its group (as per xclim.sdba.Grouper)
+    positions : numpy ndarray, optional
+        Roll the window along a longer time axis (see rolling_window)
+
+    Returns
+    -------
+    numpy ndarray
+        Quantiles with dimensions (..., group, quantiles)
+    """
+
+    if window > 1:
+        data, group_index = rolling_window(data, group_index, window, positions=positions)
+
+    sorted_data, bounds, nvalid = sort_by_group(data, group_index, ngroups)
+    result = np.empty(data.shape[:-1] + (ngroups, len(quantiles)), dtype=data.dtype)
+    for group in range(ngroups):
+        start, end = bounds[group], bounds[group + 1]
+        result[..., group, :] = sorted_quantiles(
+            sorted_data[..., start:end], nvalid[..., group], quantiles
+        )
+
+    return result
+
+
+def percentile_ranks(data):
+    """Calculate percentage ranks along the last axis of numpy data.
+
+    Equal values are assigned the average of the ranks they span
+    and NaNs are returned as NaN (as per xarray.DataArray.rank with pct=True).
+    The ranks have the precision of the data (float32 or float64).
+    """
+
+    order = np.argsort(data, axis=-1, kind='stable')
+    sorted_data = np.take_along_axis(data, order, axis=-1)
+    nvalid = np.count_nonzero(~np.isnan(data), axis=-1)[..., np.newaxis]
+    ntimes = data.shape[-1]
+    index = np.broadcast_to(np.arange(ntimes), data.shape)
+
+    tie_start = np.ones(data.shape, dtype=bool)
+    tie_start[..., 1:] = sorted_data[..., 1:] != sorted_data[..., :-1]
+    first_rank = np.maximum.accumulate(np.where(tie_start, index, 0), axis=-1)
+    tie_end = np.ones(data.shape, dtype=bool)
+    tie_end[..., :-1] = tie_start[..., 1:]
+    last_rank = np.flip(
+        np.minimum.accumulate(np.flip(np.where(tie_end, index, ntimes), axis=-1), axis=-1),
+        axis=-1,
+    )
+
+    # (rows that are all NaN have no valid values and are masked below)
+    sorted_ranks = ((first_rank + last_rank) / 2 + 1) / np.where(nvalid > 0, nvalid, 1)
+    sorted_ranks = np.where(np.isnan(sorted_data), np.nan, sorted_ranks)
+    ranks = np.empty(data.shape, dtype=np.result_type(data.dtype, np.float32))
+    np.put_along_axis(ranks, order, sorted_ranks, axis=-1)
+
+    return ranks
+
+
+def searchsorted_rows(sorted_data, values, side='right'):
+    """Find the indices where values would be inserted into sorted_data, row by row.
+
+    Equivalent to np.searchsorted(sorted_data[i], values[i], side=side)
+    for every row i (the last axis), fully vectorised over rows.
+    """
+
+    sorted_data, values = broadcast_rows(sorted_data, values)
+    ndata = sorted_data.shape[-1]
+    nvalues = values.shape[-1]
+    if side == 'right':
+        combined = np.concatenate([sorted_data, values], axis=-1)
+        order = np.argsort(combined, axis=-1, kind='stable')
+        is_data = order < ndata
+        value_index = order - ndata
+    elif side == 'left':
+        combined = np.concatenate([values, sorted_data], axis=-1)
+        order = np.argsort(combined, axis=-1, kind='stable')
+        is_data = order >= nvalues
+        value_index = order
+    else:
+        raise ValueError(f'Invalid side: {side}')
+    counts = np.cumsum(is_data, axis=-1)
+    value_index = value_index[~is_data].reshape(values.shape)
+    value_counts = counts[~is_data].reshape(values.shape)
+    result = np.empty(values.shape, dtype=int)
+    np.put_along_axis(result, value_index, value_counts, axis=-1)
+
+    return result
+
+
+def broadcast_rows(*arrays):
+    """Broadcast arrays against each other on all but the last axis."""
+
+    shape = np.broadcast_shapes(*[array.shape[:-1] for array in arrays])
+
+    return [np.broadcast_to(array, shape + array.shape[-1:]) for array in arrays]
+
+
+def interp_rows(x, xp, fp, side='right', index=None):
+    """One-dimensional linear interpolation along the last axis, row by row.
+
+    Equivalent to np.interp(x[i], xp[i], fp[i]) for every row i
+    (xp must be increasing along the last axis and
+    values beyond the ends of xp are given the end values of fp).
+    Where x is equal to repeated values in xp, the result is
+    the last (side='right') or first (side='left') matching value of fp.
+
+    The result of searchsorted_rows(xp, x, side=side)
+    can be provided as index if it is already known.
+    """
+
+    fp = np.asarray(fp)
+    if fp.ndim == 1:
+        x, xp = broadcast_rows(x, xp)
+    else:
+        x, xp, fp = broadcast_rows(x, xp, fp)
+    npoints = xp.shape[-1]
+    if index is None:
+        index = searchsorted_rows(xp, x, side=side)
+    upper = np.clip(index, 1, npoints - 1)
+    lower = upper - 1
+    x_lower = np.take_along_axis(xp, lower, axis=-1)
+    x_upper = np.take_along_axis(xp, upper, axis=-1)
+    if fp.ndim == 1:
+        f_lower = fp[lower]
+        f_upper = fp[upper]
+    else:
+        f_lower = np.take_along_axis(fp, lower, axis=-1)
+        f_upper = np.take_along_axis(fp, upper, axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weight = np.clip((x - x_lower) / (x_upper - x_lower), 0, 1)
+    above = (x >= x_upper) if side == 'right' else (x > x_lower)
+    weight = np.where(x_upper > x_lower, weight, np.where(above, 1.0, 0.0))
+    weight = np.where(np.isnan(x), np.nan, weight)
+
+    return f_lower + weight * (f_upper - f_lower)
+
+
+def summary_cdf(x, values, levels):
+    """Evaluate the CDF of a quantile summary, row by row.
+
+    Where x is equal to repeated summary values (i.e. tied data)
+    the CDF is the midpoint of the jump.
+    """
+
+    cdf_left = interp_rows(x, values, levels, side='left')
+    cdf_right = interp_rows(x, values, levels, side='right')
+
+    return (cdf_left + cdf_right) / 2
+
+
+def quantile_summary(data, group_index, ngroups, nlevels, window=1):
+    """Summarise the distribution of each group of numpy data.
+
+    The summary for each group is the values at nlevels evenly spaced
+    probability levels from 0 to 1 and the number of non-NaN values.
+    The cumulative distribution function (CDF) of a summary is
+    the linear interpolation between those values,
+    with the i-th smallest of n values at probability (i + 0.5) / n.
+
+    Parameters
+    ----------
+    data : numpy ndarray
+        Input data (time is the last axis)
+    group_index : numpy ndarray
+        Group index (0, 1, 2, ...) for each time step
+    ngroups : int
+        Number of groups
+    nlevels : int
+        Number of probability levels
+    window : int, default 1
+        Include a centred rolling window of time steps around each
+        time step in its group (as per xclim.sdba.Grouper)
+
+    Returns
+    -------
+    values : numpy ndarray
+        Summary values with dimensions (..., group, levels)
+    counts : numpy ndarray
+        Number of non-NaN values with dimensions (..., group)
+    """
+
+    if window > 1:
+        data, group_index = rolling_window(data, group_index, window)
+
+    levels = np.linspace(0, 1, nlevels)
+    sorted_data, bounds, nvalid = sort_by_group(data, group_index, ngroups)
+    values = np.empty(data.shape[:-1] + (ngroups, nlevels), dtype=data.dtype)
+    for group in range(ngroups):
+        start, end = bounds[group], bounds[group + 1]
+        group_nvalid = nvalid[..., group, np.newaxis]
+        last_index = np.clip(group_nvalid - 1, 0, None)
+        position = np.clip(group_nvalid * levels - 0.5, 0, last_index)
+        lower_index = np.floor(position).astype(int)
+        upper_index = np.minimum(lower_index + 1, last_index)
+        weight = position - lower_index
+        group_data = sorted_data[..., start:end]
+        if group_data.shape[-1] == 0:
+            values[..., group, :] = np.nan
+            continue
+        lower = np.take_along_axis(group_data, lower_index, axis=-1)
+        upper = np.take_along_axis(group_data, upper_index, axis=-1)
+        group_values = lower + weight * (upper - lower)
+        values[..., group, :] = np.where(group_nvalid == 0, np.nan, group_values)
+
+    return values, nvalid
+
+
+def merge_quantile_summaries(values, counts):
+    """Merge quantile summaries.
+
+    The CDF of the merged summary is the count weighted average
+    of the (piecewise linear) CDFs of the input summaries,
+    which is sampled back onto the same probability levels.
+    It is accumulated in a single sweep over the sorted values of all the summaries
+    by treating each summary as a piecewise constant density
+    plus point masses where it has repeated values
+    (so jumps due to tied data are preserved).
+    Groups are merged one at a time to limit the size of temporary arrays.
+
+    Parameters
+    ----------
+    values : numpy ndarray
+        Summary values with dimensions (..., summary, group, levels)
+    counts : numpy ndarray
+        Number of non-NaN values with dimensions (..., summary, group)
+
+    Returns
+    -------
+    values : numpy ndarray
+        Merged summary values with dimensions (..., group, levels)
+    counts : numpy ndarray
+        Merged number of non-NaN values with dimensions (..., group)
+    """
+
+    ngroups = values.shape[-2]
+    merged_values = np.empty(values.shape[:-3] + values.shape[-2:], dtype=values.dtype)
+    merged_counts = np.empty(counts.shape[:-2] + counts.shape[-1:], dtype=counts.dtype)
+    for group in range(ngroups):
+        merged_values[..., group, :], merged_counts[..., group] = merge_summary_group(
+            values[..., group, :], counts[..., group]
+        )
+
+    return merged_values, merged_counts
+
+
+def merge_summary_group(values, counts):
+    """Merge the quantile summaries of a single group.
+
+    values has dimensions (..., summary, levels) and counts (..., summary).
+    """
+
+    dtype = values.dtype
+    values = values.astype(np.float64)
+    nsummaries, nlevels = values.shape[-2:]
+    levels = np.linspace(0, 1, nlevels)
+    total_counts = counts.sum(axis=-1)
+
+    # Empty (all NaN) summaries are moved out of the way to the largest value
+    valid = ~np.isnan(values)
+    fill_value = np.max(np.where(valid, values, -np.inf), axis=(-2, -1), keepdims=True)
+    fill_value = np.where(np.isfinite(fill_value), fill_value, 0)
+    values = np.where(valid, values, fill_value)
+
+    interval_mass = (counts / (nlevels - 1))[..., np.newaxis]
+    interval_width = np.diff(values, axis=-1)
+    point_mass = interval_width == 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        density = np.where(point_mass, 0, interval_mass / interval_width)
+    density_change = np.diff(density, axis=-1, prepend=0, append=0)
+    jump = np.zeros(values.shape)
+    jump[..., :-1] = np.where(point_mass, interval_mass, 0)
+
+    # Each summary is already sorted, so a stable sort (which merges sorted runs)
+    # is much faster than the default, and the sort order is applied
+    # to all the arrays with a single flat index
+    nknots = nsummaries * nlevels
+    knots_shape = values.shape[:-2] + (nknots,)
+    order = np.argsort(values.reshape(knots_shape), axis=-1, kind='stable')
+    nrows = int(np.prod(knots_shape[:-1]))
+    flat_order = order + (np.arange(nrows) * nknots).reshape(knots_shape[:-1] + (1,))
+    knots = values.ravel()[flat_order]
+    density_change = density_change.ravel()[flat_order]
+    jump = jump.ravel()[flat_order]
+    density = np.cumsum(density_change, axis=-1)
+    cdf = np.zeros(knots_shape[:-1] + (2 * nknots,))
+    np.cumsum(density[..., :-1] * np.diff(knots, axis=-1) + jump[..., :-1], axis=-1, out=cdf[..., 2::2])
+    cdf[..., 1::2] = cdf[..., 0::2] + jump
+    repeated_knots = np.empty(cdf.shape)
+    repeated_knots[..., 0::2] = knots
+    repeated_knots[..., 1::2] = knots
+    knots = repeated_knots
+    cdf /= np.maximum(total_counts, 1)[..., np.newaxis]
+    cdf = np.maximum.accumulate(cdf, axis=-1)
+
+    level_index = np.clip(np.ceil(cdf * (nlevels - 1)).astype(int), 0, nlevels - 1)
+    row_offset = (np.arange(nrows) * nlevels).reshape(cdf.shape[:-1] + (1,))
+    level_counts = np.bincount((level_index + row_offset).ravel(), minlength=nrows * nlevels)
+    n_at_or_below = np.cumsum(level_counts.reshape(cdf.shape[:-1] + (nlevels,)), axis=-1)
+    merged_values = interp_rows(
+        np.broadcast_to(levels, cdf.shape[:-1] + (nlevels,)), cdf, knots, index=n_at_or_below
+    )
+    merged_values = np.where(total_counts[..., np.newaxis] == 0, np.nan, merged_values)
+
+    return merged_values.astype(dtype), total_counts
+
+
+def summary_ranks(data, values, counts, group_index):
+    """Calculate percentage ranks of numpy data from quantile summaries.
+
+    Approximates the ranks of percentile_ranks (within each group)
+    using the CDF of the quantile summary of each group.
+
+    Parameters
+    ----------
+    data : numpy ndarray
+        Input data (time is the last axis)
+    values : numpy ndarray
+        Summary values with dimensions (..., group, levels)
+    counts : numpy ndarray
+        Number of non-NaN values with dimensions (..., group)
+    group_index : numpy ndarray
+        Group index (0, 1, 2, ...) for each time step
+
+    Returns
+    -------
+    numpy ndarray
+    """
+
+    nlevels = values.shape[-1]
+    levels = np.linspace(0, 1, nlevels)
+    ranks = np.full(data.shape, np.nan, dtype=np.result_type(data.dtype, np.float32))
+    for group in np.unique(group_index):
+        times = group_index == group
+        cdf = summary_cdf(data[..., times], values[..., group, :], levels)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ranks[..., times] = cdf + 0.5 / counts[..., group, np.newaxis]
+
+    return ranks
+
+
+def summary_quantiles(values, counts, quantiles):
+    """Calculate quantiles of numpy data from quantile summaries.
+
+    Uses the same definition of the quantiles as np.nanquantile
+    (i.e. the i-th smallest of n values is quantile i / (n - 1)).
+
+    Parameters
+    ----------
+    values : numpy ndarray
+        Summary values with dimensions (..., group, levels)
+    counts : numpy ndarray
+        Number of non-NaN values with dimensions (..., group)
+    quantiles : numpy ndarray
+        Quantiles to calculate
+
+    Returns
+    -------
+    numpy ndarray
+        Quantiles with dimensions (..., group, quantiles)
+    """
+
+    nlevels = values.shape[-1]
+    levels = np.linspace(0, 1, nlevels)
+    nvalid = counts[..., np.newaxis]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        probabilities = ((nvalid - 1) * np.asarray(quantiles, dtype=np.float64) + 0.5) / nvalid
+    probabilities = np.nan_to_num(probabilities)
+    index = np.floor(probabilities * (nlevels - 1)).astype(int) + 1
+    result = interp_rows(probabilities, levels, values, index=index)
+    result = np.where(nvalid == 0, np.nan, result)
+
+    return result.astype(values.dtype)
+
+
+def get_quantile_summary(da, nlevels=201, timescale='monthly', window=1, split_every=4):
+    """Get quantile summaries in a single streaming pass over the time chunks of da.
+
+    A summary is calculated for each time chunk
+    and the summaries are then merged in a tree
+    (so only one time chunk of data needs to be in memory at a time).
+
+    Parameters
+    ----------
+    da : xarray DataArray
+        Input data
+    nlevels : int, default 201
+        Number of probability levels in each summary
+    timescale : {'monthly', 'annual'}, default 'monthly'
+        Time grouping
+    window : int, default 1
+        Include a centred rolling window of time steps around each
+        time step in its group (windows do not extend across time chunks)
+    split_every : int, default 4
+        Number of summaries to merge at a time
+
+    Returns
+    -------
+    values : xarray DataArray
+        Summary values with dimensions (..., group, levels)
+        (the rank_error_bound attribute is an upper bound on
+        the error in the CDF of the summary)
+    counts : xarray DataArray
+        Number of non-NaN values with dimensions (..., group)
+
+    Notes
+    -----
+    The summaries are approximate.
+    Linear interpolation between the values of a time chunk
+    is in error by at most 0.5 / n (in probability)
+    for a group with n values in the time chunk
+    (the bound takes n to be the number of time steps in the group and its windows,
+    so it does not account for missing values), and each time the CDF is sampled onto the probability levels
+    (once for each time chunk and once for each level of the merge tree)
+    the error can increase by at most 1 / (nlevels - 1).
+    """
+
+    group_index, group_coords = get_group_index(da['time'], timescale)
+    group_dims = list(group_coords.keys())
+    ngroups = len(group_coords[group_dims[0]]) if group_dims else 1
+    output_sizes = {'group': ngroups, 'levels': nlevels}
+    if da.chunks:
+        time_chunks = da.chunks[da.get_axis_num('time')]
+    else:
+        time_chunks = (da.sizes['time'],)
+
+    summaries = []
+    min_count = np.inf
+    start = 0
+    for size in time_chunks:
+        chunk_group_index = group_index[start:start + size]
+        if window > 1:
+            # Each group also includes the time steps in the window
+            # around its own time steps (within the time chunk)
+            in_chunk, windowed_group_index = rolling_window(np.ones(size), chunk_group_index, window)
+            chunk_counts = np.bincount(windowed_group_index[~np.isnan(in_chunk)], minlength=ngroups)
+        else:
+            chunk_counts = np.bincount(chunk_group_index, minlength=ngroups)
+        min_count = min(min_count, chunk_counts[chunk_counts > 0].min())
+        values, counts = xr.apply_ufunc(
+            quantile_summary,
+            da.isel({'time': slice(start, start + size)}),
+            kwargs={
+                'group_index': chunk_group_index,
+                'ngroups': ngroups,
+                'nlevels': nlevels,
+                'window': window,
+            },
+            input_core_dims=[['time']],
+            output_core_dims=[['group', 'levels'], ['group']],
+            dask='parallelized',
+            output_dtypes=[da.dtype, int],
+            dask_gufunc_kwargs={'output_sizes': output_sizes},
+        )
+        summaries.append((values, counts))
+        start += size
+
+    nmerges = 0
+    while len(summaries) > 1:
+        nmerges += 1
+        merged_summaries = []
+        for index in range(0, len(summaries), split_every):
+            batch = summaries[index:index + split_every]
+            if len(batch) == 1:
+                merged_summaries.append(batch[0])
+                continue
+            values = xr.concat([values for values, counts in batch], dim='summary')
+            counts = xr.concat([counts for values, counts in batch], dim='summary')
+            if values.chunks:
+                values = values.chunk({'summary': -1})
+                counts = counts.chunk({'summary': -1})
+            merged_summaries.append(
+                xr.apply_ufunc(
+                    merge_quantile_summaries,
+                    values,
+                    counts,
+                    input_core_dims=[['summary', 'group', 'levels'], ['summary', 'group']],
+                    output_core_dims=[['group', 'levels'], ['group']],
+                    dask='parallelized',
+                    output_dtypes=[da.dtype, int],
+                )
+            )
+        summaries = merged_summaries
+
+    values, counts = summaries[0]
+    values = values.assign_coords({'levels': np.linspace(0, 1, nlevels)})
+    values.attrs['rank_error_bound'] = 0.5 / min_count + (1 + nmerges) / (nlevels - 1)
+
+    return values, counts
+
+
 def get_quantiles(da, quantiles, timescale='monthly'):
     """Get quantiles.
 
     Required because sdba.EmpiricalQuantileMapping.train only
-    outputs hist_q and not others like ref_q.    
+    outputs hist_q and not others like ref_q.
+
+    The data for each grid point are sorted once and split into groups
+    (e.g. months) so all quantiles for every group are calculated
+    in a single blockwise pass.
     """
 
-    if timescale == 'monthly':
-        months = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12]
-        q_list = []
-        for month in months:
-            mth = nbutils.quantile(da[da['time'].dt.month == month], quantiles, ['time'])
-            q_list.append(mth)
-        da_q = xr.concat(q_list, dim='month')
-        da_q.coords['month'] = months
-        try:
-            da_q = da_q.transpose('quantiles', 'month', 'lat', 'lon')
-        except ValueError:
-            da_q = da_q.transpose('quantiles', 'month')
-    elif timescale == 'annual':
-        da_q = nbutils.quantile(da, quantiles, ['time'])
-        try:
-            da_q = da_q.transpose('quantiles', 'lat', 'lon')
-        except ValueError:
-            pass
+    group_index, group_coords = get_group_index(da['time'], timescale)
+    group_dims = list(group_coords.keys())
+    ngroups = len(group_coords[group_dims[0]]) if group_dims else 1
+
+    da_q = xr.apply_ufunc(
+        grouped_quantiles,
+        da,
+        kwargs={'group_index': group_index, 'ngroups': ngroups, 'quantiles': quantiles},
+        input_core_dims=[['time']],
+        output_core_dims=[['group', 'quantiles']],
+        dask='parallelized',
+        output_dtypes=[da.dtype],
+        dask_gufunc_kwargs={'output_sizes': {'group': ngroups, 'quantiles': len(quantiles)}},
+        keep_attrs=True,
+    )
+    if group_dims:
+        da_q = da_q.rename({'group': group_dims[0]})
     else:
-        raise ValueError('Invalid timescale: {timescale}')
+        da_q = da_q.squeeze('group', drop=True)
+    da_q = da_q.assign_coords({'quantiles': quantiles, **group_coords})
+    spatial_dims = [dim for dim in ['lat', 'lon'] if dim in da_q.dims]
+    da_q = da_q.transpose('quantiles', *group_dims, *spatial_dims, ...)
 
     da_q.attrs['standard_name'] = 'Quantiles'
     da_q.attrs['long_name'] = 'Quantiles'
@@ -413,7 +2223,160 @@ def get_quantiles(da, quantiles, timescale='monthly'):
     return da_q
 
 
-def regrid(ds, ds_grid, variable=None, method='bilinear'):
+def get_regrid_key(ds, ds_grid, method):
+    """Create a key (hash) that identifies a regridding operation.
+
+    The key depends on the source and target grid coordinates
+    (including cell bounds and the xesmf mask variable, if present) and the regridding method.
+    """
+
+    sha = hashlib.sha256(method.encode())
+    for grid in [ds, ds_grid]:
+        for coord in ['lat', 'lon', 'lat_b', 'lon_b', 'mask']:
+            if coord in grid.coords or coord in getattr(grid, 'data_vars', {}):
+                values = np.ascontiguousarray(grid[coord].values, dtype=np.float64)
+                sha.update(f'{coord}{values.shape}'.encode())
+                sha.update(values.tobytes())
+
+    return sha.hexdigest()
+
+
+def prune_cache(cache_dir, max_size, keep=None):
+    """Delete the least recently used files from a cache until it fits max_size.
+
+    Used for the regridding weight cache and the adjustment factor store
+    (only the netCDF files in cache_dir are considered).
+
+    Parameters
+    ----------
+    cache_dir : str
+        Cache directory
+    max_size : str or int
+        Maximum total size of the cache (e.g. '20GB' or a number of bytes)
+    keep : str, optional
+        File that should never be deleted (e.g. the one just created)
+    """
+
+    max_size = dask.utils.parse_bytes(max_size)
+    cache_files = [
+        os.path.join(cache_dir, filename)
+        for filename in os.listdir(cache_dir) if filename.endswith('.nc')
+    ]
+    cache_files.sort(key=os.path.getmtime)
+    total_size = sum(os.path.getsize(cache_file) for cache_file in cache_files)
+    for cache_file in cache_files:
+        if total_size <= max_size:
+            break
+        if cache_file == keep:
+            continue
+        total_size = total_size - os.path.getsize(cache_file)
+        os.remove(cache_file)
+        logging.info(f'Removed least recently used cache file: {cache_file}')
+
+
+def get_af_store_key(config):
+    """Create a key (hash) that identifies an adjustment factor calculation.
+
+    Parameters
+    ----------
+    config : dict
+        Everything that determines the adjustment factors
+        (input files, time bounds, variables, scaling, time grouping, etc).
+        Values must be JSON serialisable.
+    """
+
+    config_json = json.dumps(config, sort_keys=True)
+
+    return hashlib.sha256(config_json.encode()).hexdigest()
+
+
+def get_af_store_file(af_store, key):
+    """Get the adjustment factor file for a key in an adjustment factor store.
+
+    Accessing a file marks it as recently used (see prune_cache).
+    """
+
+    store_file = os.path.join(af_store, f'{key}.nc')
+    if not os.path.isfile(store_file):
+        raise ValueError(f'Invalid adjustment factor store key: {key} (not in {af_store})')
+    os.utime(store_file)
+
+    return store_file
+
+
+def fetch_from_af_store(af_store, key, outfile, output_format='netcdf'):
+    """Copy stored adjustment factors to an output file.
+
+    Returns
+    -------
+    bool
+        False if the key is not in the store
+    """
+
+    try:
+        store_file = get_af_store_file(af_store, key)
+    except ValueError:
+        return False
+    logging.info(f'Using stored adjustment factors: {store_file}')
+    if output_format == 'netcdf':
+        shutil.copyfile(store_file, outfile)
+    else:
+        with xr.open_dataset(store_file) as ds:
+            write_outfile(ds, outfile, output_format=output_format)
+
+    return True
+
+
+def add_to_af_store(af_store, key, infile, max_size='20GB', input_format='netcdf'):
+    """Add an adjustment factor file to an adjustment factor store.
+
+    Parameters
+    ----------
+    af_store : str
+        Adjustment factor store directory
+    key : str
+        Store key (see get_af_store_key)
+    infile : str
+        Adjustment factor file
+    max_size : str or int, default '20GB'
+        Maximum size of the store (least recently used files are deleted first)
+    input_format : {'netcdf', 'zarr'}, default 'netcdf'
+        Format of infile (files are always stored as netCDF)
+    """
+
+    os.makedirs(af_store, exist_ok=True)
+    store_file = os.path.join(af_store, f'{key}.nc')
+    temp_file = f'{store_file}.{os.getpid()}.tmp'
+    if input_format == 'netcdf':
+        shutil.copyfile(infile, temp_file)
+    else:
+        with xr.open_dataset(infile, engine='zarr') as ds:
+            for var in ds.variables:
+                ds[var].encoding = {}
+            ds.to_netcdf(temp_file)
+    os.replace(temp_file, store_file)
+    logging.info(f'Stored adjustment factors: {store_file}')
+    prune_cache(af_store, max_size, keep=store_file)
+
+
+def get_regrid_cache_dir():
+    """Get the directory for caching regridding weights.
+
+    This is the QQSCALE_REGRID_CACHE environment variable if it is set
+    (an empty value turns the cache off, in which case an empty string is returned),
+    otherwise qqscale/regrid_weights in the user cache directory
+    (XDG_CACHE_HOME or ~/.cache).
+    """
+
+    cache_dir = os.environ.get('QQSCALE_REGRID_CACHE')
+    if cache_dir is None:
+        cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+        cache_dir = os.path.join(cache_home, 'qqscale', 'regrid_weights')
+
+    return cache_dir
+
+
+def regrid(ds, ds_grid, variable=None, method='bilinear', cache_dir=None, cache_size=None):
     """Regrid data
     
     Parameters
@@ -422,10 +2385,18 @@ def regrid(ds, ds_grid, variable=None, method='bilinear'):
         Dataset to be regridded
     ds_grid : xarray Dataset
         Dataset containing target horizontal grid
-    variable : str, optional
-        Variable to restore attributes for
+    variable : str or list, optional
+        Variable/s to restore attributes for
     method : str, default bilinear
         Method for regridding
+    cache_dir : str, optional
+        Directory for caching regridding weights
+        (an empty string turns the cache off).
+        Defaults to get_regrid_cache_dir (i.e. the QQSCALE_REGRID_CACHE environment variable
+        or a per-user cache directory).
+    cache_size : str, optional
+        Maximum size of the cache (least recently used weights are deleted first).
+        Defaults to the QQSCALE_REGRID_CACHE_SIZE environment variable or 20GB.
     
     Returns
     -------
@@ -433,15 +2404,42 @@ def regrid(ds, ds_grid, variable=None, method='bilinear'):
     
     """
     
-    global_attrs = ds.attrs
-    if variable:
-        var_attrs = ds[variable].attrs        
-    regridder = xe.Regridder(ds, ds_grid, method)
-    ds = regridder(ds)
-    ds.attrs = global_attrs
-    if variable:
-        ds[variable].attrs = var_attrs
-    
+    with profile_stage('regrid'):
+        global_attrs = ds.attrs
+        variables = [variable] if isinstance(variable, str) else variable
+        if variables:
+            var_attrs = {var: ds[var].attrs for var in variables}
+        if cache_dir is None:
+            cache_dir = get_regrid_cache_dir()
+        if cache_size is None:
+            cache_size = os.environ.get('QQSCALE_REGRID_CACHE_SIZE', '20GB')
+        if cache_dir:
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+            except OSError as error:
+                logging.warning(f'Not caching regridding weights (cannot create {cache_dir}: {error})')
+                cache_dir = None
+        if cache_dir:
+            weights_file = os.path.join(cache_dir, get_regrid_key(ds, ds_grid, method) + '.nc')
+            if os.path.isfile(weights_file):
+                logging.info(f'Using cached regridding weights: {weights_file}')
+                regridder = xe.Regridder(ds, ds_grid, method, weights=weights_file)
+                os.utime(weights_file)
+            else:
+                regridder = xe.Regridder(ds, ds_grid, method)
+                temp_file = f'{weights_file}.{os.getpid()}.tmp'
+                regridder.to_netcdf(temp_file)
+                os.replace(temp_file, weights_file)
+                logging.info(f'Cached regridding weights: {weights_file}')
+                prune_cache(cache_dir, cache_size, keep=weights_file)
+        else:
+            regridder = xe.Regridder(ds, ds_grid, method)
+        ds = regridder(ds)
+        ds.attrs = global_attrs
+        if variables:
+            for var in variables:
+                ds[var].attrs = var_attrs[var]
+
     return ds
 
 
@@ -539,3 +2537,384 @@ def subset_lon(ds, lon_bnds):
 
     return ds
 
+
+
+def get_tiles(ds, tile_size):
+    """Split the lat/lon domain of a dataset into tiles.
+
+    Parameters
+    ----------
+    ds : xarray Dataset
+        Dataset with lat and lon dimensions
+    tile_size : tuple
+        Number of latitudes and longitudes in each tile
+
+    Returns
+    -------
+    list
+        Index (i.e. for ds.isel) of each tile, e.g. {'lat': slice(0, 50), 'lon': slice(0, 50)}
+    """
+
+    nlat_tile, nlon_tile = tile_size
+    if (nlat_tile < 1) or (nlon_tile < 1):
+        raise ValueError(f'Invalid tile size: {tile_size}')
+    nlat = len(ds['lat'])
+    nlon = len(ds['lon'])
+    tiles = []
+    for lat_start in range(0, nlat, nlat_tile):
+        for lon_start in range(0, nlon, nlon_tile):
+            tiles.append({
+                'lat': slice(lat_start, min(lat_start + nlat_tile, nlat)),
+                'lon': slice(lon_start, min(lon_start + nlon_tile, nlon)),
+            })
+
+    return tiles
+
+
+def process_tile(func, tile_datasets, kwargs):
+    """Apply a function to one tile of some datasets.
+
+    The tile is computed with the synchronous dask scheduler
+    (parallelism comes from running many tiles at once).
+
+    Returns
+    -------
+    ds : xarray Dataset
+        Computed result of func(**tile_datasets, **kwargs)
+    wall_time : float
+        Time taken to process the tile (seconds)
+    """
+
+    start_time = time.perf_counter()
+    with dask.config.set(scheduler='synchronous'):
+        ds, = compute_collections(func(**tile_datasets, **kwargs))
+    wall_time = time.perf_counter() - start_time
+
+    return ds, wall_time
+
+
+def process_tiles(func, datasets, tile_size, nworkers=1, **kwargs):
+    """Apply a function to each lat/lon tile of some datasets in a pool of worker processes.
+
+    Parameters
+    ----------
+    func : function
+        Function that takes the datasets as keyword arguments
+        (plus kwargs) and returns an xarray Dataset (e.g. train.train)
+    datasets : dict
+        Input xarray Datasets (all on the same lat/lon grid) keyed by argument name
+    tile_size : tuple
+        Number of latitudes and longitudes in each tile
+    nworkers : int, default 1
+        Number of worker processes
+
+    Yields
+    ------
+    tile : dict
+        Index of the tile (see get_tiles)
+    ds : xarray Dataset
+        Computed result for the tile
+
+    Notes
+    -----
+    Tiles are yielded in the order they are completed.
+    Each worker is a fresh (spawned) process, so func must be importable.
+    Each tile is sliced from the datasets (and its dask graph culled) in the parent process,
+    so a worker is only sent the tasks and data needed for its tile
+    rather than the full domain graph (e.g. regridding weights for the whole grid).
+    """
+
+    tiles = get_tiles(list(datasets.values())[0], tile_size)
+    ntiles = len(tiles)
+    logging.info(f'Processing {ntiles} tiles of size {tuple(tile_size)} with {nworkers} workers')
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=nworkers, mp_context=context) as executor:
+        futures = {}
+        for tile in tiles:
+            tile_datasets = dask.optimize(*[ds.isel(tile) for ds in datasets.values()])
+            tile_datasets = dict(zip(datasets.keys(), tile_datasets))
+            futures[executor.submit(process_tile, func, tile_datasets, kwargs)] = tile
+        for count, future in enumerate(as_completed(futures), start=1):
+            tile = futures[future]
+            ds, wall_time = future.result()
+            lat_slice = tile['lat']
+            lon_slice = tile['lon']
+            logging.info(
+                f'Tile {count}/{ntiles} (lat {lat_slice.start}:{lat_slice.stop}, '
+                f'lon {lon_slice.start}:{lon_slice.stop}) wall time: {wall_time:.1f}s'
+            )
+            yield tile, ds
+
+
+def is_tiled(da):
+    """Check whether a variable is split into lat/lon tiles."""
+
+    return ('lat' in da.dims) and ('lon' in da.dims)
+
+
+def get_tile_template(ds_tile, spatial_coords, tile_size):
+    """Create an (empty) full domain dataset with the same structure as a tile result.
+
+    Parameters
+    ----------
+    ds_tile : xarray Dataset
+        Result for one tile
+    spatial_coords : dict
+        Full domain lat and lon coordinates
+    tile_size : tuple
+        Number of latitudes and longitudes in each tile
+
+    Returns
+    -------
+    xarray Dataset
+        Variables with lat and lon dimensions are empty dask arrays
+        (with one chunk per tile)
+    """
+
+    tiled_vars = [var for var in ds_tile.data_vars if is_tiled(ds_tile[var])]
+    ds_template = ds_tile.drop_vars(tiled_vars + ['lat', 'lon'])
+    ds_template = ds_template.assign_coords(spatial_coords)
+    nlat_tile, nlon_tile = tile_size
+    tile_chunks = {'lat': nlat_tile, 'lon': nlon_tile}
+    for var in tiled_vars:
+        dims = ds_tile[var].dims
+        shape = [ds_template.sizes[dim] for dim in dims]
+        chunks = [tile_chunks.get(dim, -1) for dim in dims]
+        data = dask.array.empty(shape, dtype=ds_tile[var].dtype, chunks=chunks)
+        ds_template[var] = (dims, data, ds_tile[var].attrs)
+
+    return ds_template
+
+
+def create_tiled_outfile(ds_template, outfile, encoding, output_format='netcdf'):
+    """Create an output file that tile results can be written to.
+
+    Everything except the data variables with lat and lon dimensions
+    is written straight away.
+    For netCDF output those variables are created (but not filled) with netCDF4,
+    while for zarr output only their metadata is written (i.e. compute=False).
+
+    Parameters
+    ----------
+    ds_template : xarray Dataset
+        Full domain template (see get_tile_template)
+    outfile : str
+        Output file name
+    encoding : dict
+        Output file encoding (see get_outfile_encoding)
+    output_format : {'netcdf', 'zarr'}, default 'netcdf'
+        Output file format
+    """
+
+    if output_format == 'zarr':
+        ds_template.to_zarr(outfile, encoding=encoding, mode='w', compute=False)
+        return
+    elif output_format != 'netcdf':
+        raise ValueError(f'Invalid output format: {output_format}')
+
+    tiled_vars = [var for var in ds_template.data_vars if is_tiled(ds_template[var])]
+    untiled_encoding = {var: encoding[var] for var in encoding if var not in tiled_vars}
+    ds_template.drop_vars(tiled_vars).to_netcdf(outfile, encoding=untiled_encoding)
+    with netCDF4.Dataset(outfile, 'a') as ncfile:
+        for var in tiled_vars:
+            var_encoding = encoding.get(var, {})
+            fill_value = var_encoding.get('_FillValue', False)
+            ncvar = ncfile.createVariable(
+                var,
+                var_encoding.get('dtype', ds_template[var].dtype),
+                ds_template[var].dims,
+                zlib=var_encoding.get('zlib', False),
+                chunksizes=var_encoding.get('chunksizes'),
+                least_significant_digit=var_encoding.get('least_significant_digit'),
+                fill_value=False if fill_value is None else fill_value,
+            )
+            ncvar.setncatts(ds_template[var].attrs)
+
+
+def write_tile(outfile, ds_tile, tile, output_format='netcdf', lock=None):
+    """Write a tile result to its region of an output file.
+
+    Parameters
+    ----------
+    outfile : str
+        Output file name (see create_tiled_outfile)
+    ds_tile : xarray Dataset
+        Result for the tile
+    tile : dict
+        Index of the tile (see get_tiles)
+    output_format : {'netcdf', 'zarr'}, default 'netcdf'
+        Output file format
+    lock : optional
+        Lock to hold while writing netCDF data
+        (the netCDF and HDF5 libraries aren't thread safe,
+        so this is needed if other threads might be reading netCDF files)
+    """
+
+    tiled_vars = [var for var in ds_tile.data_vars if is_tiled(ds_tile[var])]
+    if output_format == 'zarr':
+        ds_region = ds_tile[tiled_vars]
+        untiled_coords = [coord for coord in ds_region.coords if not is_tiled(ds_region[coord])]
+        ds_region.drop_vars(untiled_coords).to_zarr(outfile, region=tile)
+    elif output_format == 'netcdf':
+        with lock if lock else contextlib.nullcontext():
+            with netCDF4.Dataset(outfile, 'a') as ncfile:
+                for var in tiled_vars:
+                    ncvar = ncfile[var]
+                    region = tuple(tile.get(dim, slice(None)) for dim in ncvar.dimensions)
+                    ncvar[region] = ds_tile[var].transpose(*ncvar.dimensions).values
+    else:
+        raise ValueError(f'Invalid output format: {output_format}')
+
+
+def get_write_bands(ds, nworkers):
+    """Group the lat chunks of a dataset into bands for write_outfile_async.
+
+    Each band includes enough chunks to keep nworkers busy.
+
+    Returns
+    -------
+    list
+        Index (i.e. for ds.isel) of each band, e.g. {'lat': slice(0, 50), 'lon': slice(0, 144)}
+    """
+
+    lat_chunks = ds.chunks['lat']
+    nlon_chunks = len(ds.chunks['lon'])
+    chunks_per_band = max(int(np.ceil(nworkers / nlon_chunks)), 1)
+    bounds = np.cumsum((0,) + lat_chunks)
+    bands = []
+    for start in range(0, len(lat_chunks), chunks_per_band):
+        stop = min(start + chunks_per_band, len(lat_chunks))
+        bands.append({
+            'lat': slice(int(bounds[start]), int(bounds[stop])),
+            'lon': slice(0, len(ds['lon'])),
+        })
+
+    return bands
+
+
+def get_band_chunksizes(da, target_size='4MB'):
+    """Choose netCDF chunk sizes for a variable written in bands (see write_outfile_async).
+
+    The lat and lon chunk sizes match the dask chunks,
+    so that each band only writes whole netCDF chunks
+    (partially written chunks have to be decompressed, updated and compressed again).
+    The other dimensions are chunked to give chunks of about target_size.
+
+    Returns
+    -------
+    list
+        Chunk size for each dimension of da
+    """
+
+    spatial_chunksizes = {'lat': da.chunks[da.get_axis_num('lat')][0], 'lon': da.chunks[da.get_axis_num('lon')][0]}
+    spatial_bytes = spatial_chunksizes['lat'] * spatial_chunksizes['lon'] * da.dtype.itemsize
+    remaining_size = max(dask.utils.parse_bytes(target_size) // spatial_bytes, 1)
+    chunksizes = []
+    for dim in da.dims:
+        if dim in spatial_chunksizes:
+            chunksizes.append(spatial_chunksizes[dim])
+        else:
+            chunksizes.append(int(min(remaining_size, da.sizes[dim])))
+            remaining_size = max(remaining_size // da.sizes[dim], 1)
+
+    return chunksizes
+
+
+def write_outfile_async(ds, outfile, encoding, output_format='netcdf', queue_size=2):
+    """Write a dataset to file, writing each band of latitudes while the next is computed.
+
+    The variables with lat and lon dimensions are computed one band of chunks at a time
+    (see get_write_bands) and each computed band is handed to a background writer thread,
+    so the compression and writing of one band can overlap with the computation of the next.
+    The writer holds the netCDF lock while it compresses and writes a band
+    (the netCDF and HDF5 libraries aren't thread safe),
+    so tasks that read netCDF input files wait for the write to finish.
+    The overlap is therefore limited to the tasks that don't read input files.
+
+    Parameters
+    ----------
+    ds : xarray Dataset
+        Dataset to write
+    outfile : str
+        Output file name (or directory name for zarr)
+    encoding : dict
+        Output file encoding (see get_outfile_encoding)
+    output_format : {'netcdf', 'zarr'}, default 'netcdf'
+        Output file format
+    queue_size : int, default 2
+        Maximum number of computed bands waiting to be written
+        (limits the memory used by bands that have not been written yet)
+    """
+
+    write_bands([(ds, outfile, encoding)], output_format=output_format, queue_size=queue_size)
+
+
+def write_bands(outputs, output_format='netcdf', queue_size=2):
+    """Write datasets to file one band of latitudes at a time (see write_outfile_async).
+
+    Each band of all the outputs is computed in one compute,
+    so outputs that share part of their dask graph (e.g. the years from split_by_year)
+    only compute the shared tasks once.
+    The bands are written by a thread of the main process,
+    so this also works with the processes scheduler.
+
+    Parameters
+    ----------
+    outputs : list
+        Dataset, output file name and encoding (or None) of each output
+    output_format : {'netcdf', 'zarr'}, default 'netcdf'
+        Output file format
+    queue_size : int, default 2
+        Maximum number of computed bands waiting to be written
+    """
+
+    if queue_size < 1:
+        raise ValueError(f'Invalid write queue size: {queue_size}')
+
+    band_groups = {}
+    for ds, outfile, encoding in outputs:
+        if 'cell' in ds.dims:
+            ds = unpack_cells(ds)
+        encoding = {var: dict(var_encoding) for var, var_encoding in (encoding or {}).items() if var in ds.variables}
+        tiled_vars = [var for var in ds.data_vars if is_tiled(ds[var])]
+        if (not tiled_vars) or (not ds.chunks):
+            # Small enough to compute in one go (no lat/lon variables) or not computed at all
+            if ds.chunks:
+                ds, = compute_collections(ds)
+            write_outfile(ds, outfile, encoding, output_format=output_format)
+            continue
+        profile_graph(ds)
+        ds = ds.unify_chunks()
+        band_groups.setdefault((ds.chunks['lat'], ds.chunks['lon']), []).append((ds, outfile, encoding, tiled_vars))
+
+    nworkers = dask.config.get('num_workers', None) or os.cpu_count()
+    for band_outputs in band_groups.values():
+        with profile_stage('write'):
+            bands = get_write_bands(band_outputs[0][0], nworkers)
+            for ds, outfile, encoding, tiled_vars in band_outputs:
+                if output_format == 'netcdf':
+                    for var in tiled_vars:
+                        encoding.setdefault(var, {})
+                        if 'chunksizes' not in encoding[var]:
+                            encoding[var]['chunksizes'] = get_band_chunksizes(ds[var])
+                logging.info(f'Writing {outfile} in {len(bands)} bands')
+                create_tiled_outfile(ds, outfile, encoding, output_format=output_format)
+            with ThreadPoolExecutor(max_workers=1) as writer:
+                pending = []
+                for band in bands:
+                    ds_bands = compute_collections(
+                        *[ds[tiled_vars].isel(band) for ds, outfile, encoding, tiled_vars in band_outputs]
+                    )
+                    if len(pending) >= queue_size:
+                        pending.pop(0).result()
+                    outfiles = [outfile for ds, outfile, encoding, tiled_vars in band_outputs]
+                    pending.append(writer.submit(write_band, outfiles, ds_bands, band, output_format))
+                for future in pending:
+                    future.result()
+
+
+def write_band(outfiles, ds_bands, band, output_format):
+    """Write a computed band of each output (see write_bands)."""
+
+    for outfile, ds_band in zip(outfiles, ds_bands):
+        write_tile(outfile, ds_band, band, output_format=output_format, lock=NETCDF4_PYTHON_LOCK)